@@ -0,0 +1,111 @@
+"""
+Archival of old jobs and their submissions, to keep the jobs and submissions tables and their indexes small.
+
+A submission is archived when all of its jobs are finished or cancelled and were created before the cutoff. It is moved
+with its jobs to archived_submissions and archived_jobs, in batches of one transaction each, so rows are only locked
+for as long as a batch takes. The read endpoints look in the archive as well (see Submission.list_details and
+Job.list_details). Creating a new job for an archived submission moves it back first.
+
+The newest submission and the submission of the newest job are never archived: SQLite, and InnoDB on MariaDB 10.1
+after a restart, hand out max(id) + 1 as the next id, which would reuse the id of an archived row if the rows with the
+highest ids were moved away.
+
+Events older than the cutoff are deleted from the event log in batches as well, and so are expired idempotency keys.
+
+Run with `manage.py archive run`.
+"""
+
+import time
+
+from sqlalchemy import func, or_
+
+import constants
+from models import archived_jobs, archived_submissions, db, Event, IdempotencyKey, Job, Submission
+
+ARCHIVABLE_STATUSES = [constants.JobStatus.finished, constants.JobStatus.cancelled]
+
+
+def _move(source, target, criterion):
+    columns = [column.name for column in source.columns]
+    db.session.execute(target.insert().from_select(columns, source.select().where(criterion)))
+    return db.session.execute(source.delete().where(criterion)).rowcount
+
+
+# The submissions that hold the highest submission and job ids, which must stay to keep ids from being reused.
+def newest_submission_ids():
+    return {
+        db.session.query(func.max(Submission.id)).scalar(),
+        db.session.query(Job.submission_id).filter(Job.id == db.session.query(func.max(Job.id)).as_scalar()).scalar(),
+    }
+
+
+# Archives the given submissions that can be archived. Returns how many were archived.
+def archive_batch(submission_ids, cutoff):
+    submission_ids = [submission_id for submission_id, in db.session.query(Submission.id)
+                      .filter(Submission.id.in_(submission_ids)).with_for_update()]
+    blocked = {submission_id for submission_id, in db.session.query(Job.submission_id).filter(
+        Job.submission_id.in_(submission_ids),
+        or_(~Job.status.in_(ARCHIVABLE_STATUSES), Job.creation_time >= cutoff),
+    )} | newest_submission_ids()
+    submission_ids = [submission_id for submission_id in submission_ids if submission_id not in blocked]
+    archived = 0
+    if submission_ids:
+        _move(Job.__table__, archived_jobs, Job.submission_id.in_(submission_ids))
+        archived = _move(Submission.__table__, archived_submissions, Submission.id.in_(submission_ids))
+    db.session.commit()
+    return archived
+
+
+# Archives every submission that can be archived, batch_size at a time, sleeping for pause seconds between batches.
+def archive(cutoff, batch_size, pause=0):
+    archived = 0
+    last_submission_id = 0
+    while True:
+        submission_ids = [submission_id for submission_id, in db.session.query(Job.submission_id).filter(
+            Job.submission_id > last_submission_id,
+            Job.status.in_(ARCHIVABLE_STATUSES),
+            Job.creation_time < cutoff,
+        ).distinct().order_by(Job.submission_id).limit(batch_size)]
+        db.session.commit()
+        if not submission_ids:
+            return archived
+        last_submission_id = submission_ids[-1]
+        archived += archive_batch(submission_ids, cutoff)
+        if pause:
+            time.sleep(pause)
+
+
+# Deletes events from before the cutoff, batch_size at a time, except for the newest one so that its sequence number is
+# not handed out again (see above). Returns how many were deleted.
+def prune_events(cutoff, batch_size):
+    deleted = 0
+    newest = db.session.query(func.max(Event.id)).as_scalar()
+    while True:
+        event_ids = [event_id for event_id, in db.session.query(Event.id).filter(Event.time < cutoff, Event.id < newest)
+                     .order_by(Event.id).limit(batch_size)]
+        if not event_ids:
+            db.session.commit()
+            return deleted
+        deleted += Event.query.filter(Event.id.in_(event_ids)).delete(synchronize_session=False)
+        db.session.commit()
+
+
+# Deletes idempotency keys from before the cutoff, batch_size at a time. Returns how many were deleted.
+def prune_idempotency_keys(cutoff, batch_size):
+    deleted = 0
+    while True:
+        key_ids = [key_id for key_id, in db.session.query(IdempotencyKey.id)
+                   .filter(IdempotencyKey.creation_time < cutoff).order_by(IdempotencyKey.id).limit(batch_size)]
+        if not key_ids:
+            db.session.commit()
+            return deleted
+        deleted += IdempotencyKey.query.filter(IdempotencyKey.id.in_(key_ids)).delete(synchronize_session=False)
+        db.session.commit()
+
+
+# Moves an archived submission and its jobs back, without committing. Returns whether it was archived.
+def restore_submission(submission_id):
+    if not _move(archived_submissions, Submission.__table__, archived_submissions.c.id == submission_id):
+        return False
+    _move(archived_jobs, Job.__table__, archived_jobs.c.submission_id == submission_id)
+    return True
@@ -5,6 +5,7 @@ from collections import deque
 
 import digitalocean
 from dotenv import load_dotenv, find_dotenv
+from prometheus_client import Gauge, start_http_server
 
 from main import app
 from models import APIKey, Job
@@ -17,6 +18,12 @@ MAX_JURIES = 10
 
 DIGITALOCEAN_API_TOKEN = os.getenv('DIGITALOCEAN_API_TOKEN', '')
 
+# Port to expose autoscaler metrics on, 0 to disable.
+AUTOSCALE_METRICS_PORT = int(os.getenv('AUTOSCALE_METRICS_PORT', 0))
+
+JURY_COUNT = Gauge('judge_autoscale_juries', 'Juries currently managed by the autoscaler.')
+ENQUEUED_JOBS = Gauge('judge_autoscale_enqueued_jobs', 'Claimable jobs seen on the last autoscaler tick.')
+
 # TODO: Add stop command for jury systemd service
 USER_DATA_TEMPLATE = '''#!/bin/bash
 
@@ -133,6 +140,7 @@ jury_count = cloud.get_current_jury_count()
 def tick():
     global jury_count
     enqueued_jobs = get_enqueued_jobs()
+    ENQUEUED_JOBS.set(enqueued_jobs)
     load_index.update(enqueued_jobs)
     load_index.update_jury_count(jury_count)
     optimal_change = load_index.optimal_change()
@@ -156,7 +164,11 @@ def tick():
             logger.info('Destroyed {} juries.'.format(destroyed))
         else:
             logger.info('Not enough juries to destroy!')
+    JURY_COUNT.set(jury_count)
+
 
+if AUTOSCALE_METRICS_PORT:
+    start_http_server(AUTOSCALE_METRICS_PORT)
 
 if cloud.get_current_jury_count() == 0:
     logger.info('Spinning up 1 jury because none previously existed.')
@@ -0,0 +1,305 @@
+"""
+Micro-benchmarks for hot paths in the judge.
+
+    python bench.py serialization --jobs 10000
+    python bench.py hydration --submissions 5000
+    python bench.py progress_writes --jobs 100 --test-cases 20
+    python bench.py compression --submissions 5000
+    python bench.py scheduling --jobs 20000 --juries 8 --load 0.9
+
+Each benchmark prints the best wall time over --repeat runs for every variant it compares, except scheduling, which
+simulates a judging queue and prints the wait times that every SCHEDULING_COST_WEIGHT would give.
+"""
+
+import argparse
+import heapq
+import random
+import timeit
+import tracemalloc
+from datetime import datetime, timedelta
+
+from flask import json
+from sqlalchemy import event
+
+import constants
+import redis_store
+import util
+from main import app
+from models import APIKey, db, Job, JOB_DETAIL_ATTRS, Problem, Submission, serialize_job
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def report(name, func, repeat, number=1):
+    best = min(timeit.repeat(func, repeat=repeat, number=number)) / number
+    print('{:<40} {:>10.2f}ms'.format(name, best * 1000))
+    return best
+
+
+def report_memory(name, func):
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    print('{:<40} {:>10.2f}MB peak'.format(name, peak / 2 ** 20))
+    return peak
+
+
+def populate(n_submissions, jobs_per_submission, seed=0):
+    rng = random.Random(seed)
+    db.create_all()
+    problem = Problem(id=1, test_cases=10, time_limit=1, memory_limit=256000, generator_code='',
+                      generator_language='python3', grader_code='', grader_language='python3')
+    db.session.add(problem)
+    for i in range(n_submissions):
+        submission = Submission.create(code='print({})'.format(rng.random()), language='python3', uid=i % 100,
+                                       gid=i % 30, problem=problem, commit=False)
+        for _ in range(jobs_per_submission):
+            Job.create(submission=submission, commit=False)
+    db.session.commit()
+    db.session.remove()
+
+
+def make_jobs(n, seed=0):
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    jobs = []
+    for i in range(n):
+        status = rng.choice(list(constants.JobStatus))
+        job = Job(
+            id=i + 1,
+            submission_id=i + 1,
+            creation_time=now - timedelta(seconds=rng.randint(0, 3600)),
+            status=status,
+        )
+        if status != constants.JobStatus.queued:
+            job.claim_time = now
+            job.last_ran_case = rng.randint(0, 20)
+            job.execution_time = rng.random()
+            job.execution_memory = rng.randint(1000, 256000)
+        if status == constants.JobStatus.finished:
+            job.completion_time = now
+            job.verdict = rng.choice(list(constants.JobVerdict))
+        jobs.append(job)
+    return jobs
+
+
+@benchmark
+def serialization(args):
+    jobs = make_jobs(args.jobs)
+
+    def baseline():
+        return json.dumps([util.get_attrs(job, JOB_DETAIL_ATTRS, include_none=False) for job in jobs],
+                          cls=util.JSONEncoder)
+
+    def compiled():
+        return json.dumps([job.generate_details() for job in jobs], cls=util.JSONEncoder)
+
+    def compiled_orjson():
+        return util.fast_json_dumps([job.generate_details() for job in jobs])
+
+    with app.test_request_context():
+        assert baseline() == compiled()
+        report('get_attrs + JSONEncoder (current)', baseline, args.repeat)
+        report('compiled serializer + JSONEncoder', compiled, args.repeat)
+        if util.orjson is not None:
+            assert json.loads(compiled_orjson()) == json.loads(baseline())
+            report('compiled serializer + orjson', compiled_orjson, args.repeat)
+        else:
+            print('orjson not installed, skipping fast JSON path')
+
+
+@benchmark
+def hydration(args):
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.database_uri
+    with app.app_context():
+        populate(args.submissions, args.jobs_per_submission)
+
+        def orm_submissions():
+            result = [submission.generate_details() for submission in Submission.query.all()]
+            db.session.remove()
+            return result
+
+        def tuple_submissions():
+            return Submission.list_details()
+
+        def orm_jobs():
+            result = [job.generate_details() for job in Job.query.join(Job.submission).filter_by(problem_id=1).all()]
+            db.session.remove()
+            return result
+
+        def tuple_jobs():
+            return [serialize_job(job) for job in Job.query_details().join(Job.submission)
+                    .filter(Submission.problem_id == 1)]
+
+        report('submissions list, ORM objects', orm_submissions, args.repeat)
+        report('submissions list, column tuples', tuple_submissions, args.repeat)
+        report_memory('submissions list, ORM objects', orm_submissions)
+        report_memory('submissions list, column tuples', tuple_submissions)
+        report('jobs list, ORM objects', orm_jobs, args.repeat)
+        report('jobs list, column tuples', tuple_jobs, args.repeat)
+        report_memory('jobs list, ORM objects', orm_jobs)
+        report_memory('jobs list, column tuples', tuple_jobs)
+
+
+@benchmark
+def progress_writes(args):
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.database_uri
+    with app.app_context():
+        if redis_store.get_redis() is None:
+            import fakeredis
+            app.extensions['redis'] = fakeredis.FakeStrictRedis()
+        populate(0, 0)
+        Problem.query.get(1).test_cases = args.test_cases
+        jury_key = APIKey.new(perm_jury=True).key
+        client = app.test_client()
+
+        job_updates = []
+
+        def count_job_updates(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('UPDATE jobs'):
+                job_updates.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', count_job_updates)
+
+        for flush_interval in [0, args.flush_interval]:
+            app.config['PROGRESS_FLUSH_INTERVAL'] = flush_interval
+            problem = Problem.query.get(1)
+            for _ in range(args.jobs):
+                Submission.create_with_new_job(code='print(1)', language='python3', problem=problem)
+            db.session.remove()
+
+            del job_updates[:]
+            for _ in range(args.jobs):
+                claim = json.loads(client.post('/jobs/claim', headers={'api_key': jury_key}).data.decode('utf-8'))
+                for case in range(1, args.test_cases + 1):
+                    data = {'verification_code': claim['verification_code'], 'execution_time': 0.1,
+                            'execution_memory': 1024, 'last_ran_case': case}
+                    if case == args.test_cases:
+                        data['verdict'] = 'AC'
+                    client.post('/jobs/{}/submit'.format(claim['id']), headers={'api_key': jury_key}, data=data)
+            print('{:<40} {:>10.2f} job UPDATEs per job'.format(
+                'flush interval {}s'.format(flush_interval), len(job_updates) / args.jobs))
+
+
+@benchmark
+def compression(args):
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.database_uri
+    with app.app_context():
+        populate(args.submissions, 1)
+        submissions = Submission.list_details()
+
+    encoders = [('json', lambda: util.fast_json_dumps(submissions) if util.orjson is not None
+                 else json.dumps(submissions, cls=util.JSONEncoder).encode('utf-8')),
+                ('msgpack', lambda: util.msgpack_dumps(submissions))]
+    print('{:<40} {:>12}'.format('submissions list', 'bytes'))
+    for name, encode in encoders:
+        data = encode()
+        print('{:<40} {:>12}'.format(name, len(data)))
+        report('{} encode'.format(name), encode, args.repeat)
+        for encoding in util.COMPRESSION_ENCODINGS:
+            print('{:<40} {:>12}'.format('{} + {}'.format(name, encoding), len(util.compress(data, encoding))))
+            report('{} + {} encode'.format(name, encoding), lambda: util.compress(encode(), encoding), args.repeat)
+
+
+# (test cases, time limit, share of submissions) of the problems in the simulated contest.
+SIMULATED_PROBLEMS = [(3, 1, 0.8), (10, 2, 0.15), (50, 5, 0.05)]
+
+
+def percentile(values, p):
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+@benchmark
+def scheduling(args):
+    rng = random.Random(args.seed)
+    problems = rng.choices(SIMULATED_PROBLEMS, [share for _, _, share in SIMULATED_PROBLEMS], k=args.jobs)
+    # Every case takes 10-60% of the time limit, and the estimate is the mean (as from Job.estimate_runtime).
+    runtimes = [sum(rng.uniform(0.1, 0.6) * time_limit for _ in range(test_cases))
+                for test_cases, time_limit, _ in problems]
+    estimates = [test_cases * 0.35 * time_limit for test_cases, time_limit, _ in problems]
+    arrival_rate = args.load * args.juries / (sum(runtimes) / len(runtimes))
+    arrivals = []
+    now = 0
+    for _ in range(args.jobs):
+        now += rng.expovariate(arrival_rate)
+        arrivals.append(now)
+
+    start = datetime(2020, 1, 1)
+    print('{:<12} {:>9} {:>9} {:>9} {:>9} {:>12} {:>12}'.format(
+        'weight', 'mean', 'p50', 'p95', 'p99', 'mean short', 'max long'))
+    for weight in args.weights:
+        keys = [Job.calculate_schedule_key(start + timedelta(seconds=arrival), estimate, weight)
+                for arrival, estimate in zip(arrivals, estimates)]
+        waits = simulate(arrivals, runtimes, keys, args.juries)
+        short = [wait for wait, problem in zip(waits, problems) if problem is SIMULATED_PROBLEMS[0]]
+        long = [wait for wait, problem in zip(waits, problems) if problem is SIMULATED_PROBLEMS[-1]]
+        ordered = sorted(waits)
+        print('{:<12} {:>8.1f}s {:>8.1f}s {:>8.1f}s {:>8.1f}s {:>11.1f}s {:>11.1f}s'.format(
+            'fifo' if weight == 0 else weight, sum(waits) / len(waits), percentile(ordered, 0.5),
+            percentile(ordered, 0.95), percentile(ordered, 0.99), sum(short) / max(len(short), 1), max(long or [0])))
+
+
+# Returns the queue wait of every job, when juries always claim the queued job with the lowest key.
+def simulate(arrivals, runtimes, keys, juries):
+    waits = [0] * len(arrivals)
+    free_at = [0.0] * juries
+    queue = []
+    next_job = 0
+    while next_job < len(arrivals) or queue:
+        if not queue and arrivals[next_job] > free_at[0]:  # an idle jury waits for the next job
+            heapq.heapreplace(free_at, arrivals[next_job])
+            continue
+        while next_job < len(arrivals) and arrivals[next_job] <= free_at[0]:
+            heapq.heappush(queue, (keys[next_job], next_job))
+            next_job += 1
+        _, job = heapq.heappop(queue)
+        waits[job] = free_at[0] - arrivals[job]
+        heapq.heapreplace(free_at, free_at[0] + runtimes[job])
+    return waits
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run judge micro-benchmarks.')
+    parser.add_argument('--repeat', type=int, default=5)
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    serialization_parser = subparsers.add_parser('serialization', help='serialize a list of jobs to JSON')
+    serialization_parser.add_argument('--jobs', type=int, default=10000)
+
+    hydration_parser = subparsers.add_parser('hydration', help='list endpoints with ORM objects vs column tuples')
+    hydration_parser.add_argument('--submissions', type=int, default=5000)
+    hydration_parser.add_argument('--jobs-per-submission', type=int, default=2)
+    hydration_parser.add_argument('--database-uri', default='sqlite://')
+
+    compression_parser = subparsers.add_parser('compression', help='response size and CPU cost per encoding')
+    compression_parser.add_argument('--submissions', type=int, default=5000)
+    compression_parser.add_argument('--database-uri', default='sqlite://')
+
+    progress_parser = subparsers.add_parser('progress_writes', help='SQL writes per judged job')
+    progress_parser.add_argument('--jobs', type=int, default=100)
+    progress_parser.add_argument('--test-cases', type=int, default=20)
+    progress_parser.add_argument('--flush-interval', type=float, default=5)
+    progress_parser.add_argument('--database-uri', default='sqlite://')
+
+    scheduling_parser = subparsers.add_parser('scheduling', help='simulated queue waits per scheduling weight')
+    scheduling_parser.add_argument('--jobs', type=int, default=20000)
+    scheduling_parser.add_argument('--juries', type=int, default=8)
+    scheduling_parser.add_argument('--load', type=float, default=0.9, help='jury utilization')
+    scheduling_parser.add_argument('--weights', type=float, nargs='+', default=[0, 1, 3, 10, 30])
+    scheduling_parser.add_argument('--seed', type=int, default=0)
+
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+"""
+Content-addressed blob store on the judge's local disk, used to share files produced by juries, such as compiled
+artifacts and generated test data, so that other juries can download them instead of producing them again.
+
+Blobs are stored under their SHA-256 digest. Refs give blobs stable names (e.g. an artifact key) and point at a digest.
+The store is bounded by BLOB_STORE_MAX_BYTES: it keeps a running total of its size, and when a write takes it over the
+limit, the least recently used blobs (by mtime, which is touched on every lookup) are removed until it fits again. The
+total is recounted from disk on the first write and on every eviction, so blobs written by other processes are
+eventually counted too. Refs to evicted blobs are dropped when they are next read.
+"""
+
+import hashlib
+import os
+import re
+import tempfile
+
+from flask import current_app
+
+import metrics
+
+DIGEST_RE = re.compile(r'^[0-9a-f]{64}$')
+CHUNK_SIZE = 64 * 1024
+
+
+def init_app(app):
+    app.extensions['blobstore'] = BlobStore(app.config['BLOB_DIR'], app.config['BLOB_STORE_MAX_BYTES'])
+
+
+def get_blobstore():
+    return current_app.extensions['blobstore']
+
+
+def is_digest(value):
+    return DIGEST_RE.match(value) is not None
+
+
+class BlobStore:
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.size = None  # Unknown until the first write
+
+    def _blob_path(self, digest):
+        return os.path.join(self.root, 'blobs', digest[:2], digest)
+
+    def _ref_path(self, name):
+        return os.path.join(self.root, 'refs', hashlib.sha256(name.encode('utf-8')).hexdigest())
+
+    def _write(self, path, chunks):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    # Returns the path of the blob, or None if it is not in the store.
+    def get(self, digest):
+        path = self._blob_path(digest)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    # Stores the contents of stream and returns (digest, size).
+    def put(self, stream):
+        hasher = hashlib.sha256()
+        size = 0
+        tmp_dir = os.path.join(self.root, 'tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                    hasher.update(chunk)
+                    size += len(chunk)
+                    f.write(chunk)
+            digest = hasher.hexdigest()
+            path = self._blob_path(digest)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            is_new = not os.path.exists(path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        if self.size is not None and is_new:
+            self.size += size
+        if self.size is None or self.size > self.max_bytes:
+            self.evict()
+        return digest, size
+
+    def get_ref(self, name):
+        try:
+            with open(self._ref_path(name)) as f:
+                digest = f.read()
+        except FileNotFoundError:
+            return None
+        if self.get(digest) is None:
+            self.delete_ref(name)
+            return None
+        return digest
+
+    def set_ref(self, name, digest):
+        self._write(self._ref_path(name), [digest.encode('ascii')])
+
+    def delete_ref(self, name):
+        try:
+            os.unlink(self._ref_path(name))
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        blobs = []
+        total = 0
+        for dirpath, _, filenames in os.walk(os.path.join(self.root, 'blobs')):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                blobs.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        self.size = total
+        if total <= self.max_bytes:
+            return
+        blobs.sort()
+        for _, size, path in blobs:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                continue
+            metrics.BLOB_EVICTIONS.inc()
+            self.size -= size
+            if self.size <= self.max_bytes:
+                break
@@ -0,0 +1,57 @@
+"""
+Cross-process invalidation of the per-process caches (util.LRUCache) over Redis pub/sub.
+
+Caches that can go stale are registered under a name. invalidate() drops the key locally and publishes it, and every
+process running the judge drops it from its own copy when the message arrives. While a process is disconnected from
+Redis it may miss messages, so it clears its registered caches whenever it (re)subscribes.
+
+Running more than one process needs Redis anyway, for the Socket.IO message queue; without it, invalidate() only acts
+locally.
+"""
+
+import json
+import threading
+import time
+
+import redis_store
+
+CHANNEL = 'judge:cache-invalidations'
+
+caches = {}
+
+
+def register(name, cache):
+    caches[name] = cache
+    return cache
+
+
+def invalidate(name, key):
+    caches[name].invalidate(key)
+    redis = redis_store.get_redis()
+    if redis is not None:
+        redis.publish(CHANNEL, json.dumps([name, key]))
+
+
+def init_app(app):
+    if app.extensions['redis'] is not None:
+        threading.Thread(target=_listen, args=(app,), daemon=True).start()
+
+
+def _listen(app):
+    while True:
+        try:
+            pubsub = app.extensions['redis'].pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(CHANNEL)
+            for cache in caches.values():
+                cache.clear()
+            for message in pubsub.listen():
+                _apply(message)
+        except Exception:
+            app.logger.warning('Cache invalidation listener failed, resubscribing', exc_info=True)
+            time.sleep(1)
+
+
+def _apply(message):
+    name, key = json.loads(message['data'].decode('utf-8'))
+    if name in caches:
+        caches[name].invalidate(key)
@@ -26,7 +26,64 @@ class JudgeConfig:
         self._load_secret_key()
         self.SQLALCHEMY_DATABASE_URI = self._get_test_database_uri() if testing else self._get_database_uri()
         self.SQLALCHEMY_TRACK_MODIFICATIONS = False
+        # Read replica for GET requests and Socket.IO snapshots, see replica.py. Unset to read from the primary only.
+        self.REPLICA_DATABASE_URI = os.getenv('REPLICA_DATABASE_URI', '')
+        self.REPLICA_MAX_LAG = float(os.getenv('REPLICA_MAX_LAG', 5))  # seconds
+        self.REPLICA_LAG_CHECK_INTERVAL = float(os.getenv('REPLICA_LAG_CHECK_INTERVAL', 1))  # seconds
         self.REDIS_URI = self._get_redis_uri()
+        # Seconds between checks that a jury connected over the Socket.IO jury protocol still has an active key.
+        self.JURY_KEY_CHECK_INTERVAL = float(os.getenv('JURY_KEY_CHECK_INTERVAL', 30))
+        # Bearer token that Prometheus sends to scrape /metrics; master API keys are accepted too. See metrics.py.
+        self.METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+        self.QUEUE_BACKEND = os.getenv('QUEUE_BACKEND', 'sql')  # 'sql' or 'redis', see queues.py
+        # Default for problems without a supersede_policy: 'none', 'cancel' or 'deprioritize', see Job.supersede.
+        self.SUPERSEDE_POLICY = os.getenv('SUPERSEDE_POLICY', 'none')
+        self.SUPERSEDE_DELAY = float(os.getenv('SUPERSEDE_DELAY', 300))  # seconds a deprioritized job is pushed back
+        # Admission control, see ratelimit.py: submissions per minute and burst per contestant and per API key (rate 0
+        # to disable), and the most jobs that may be queued (0 for no limit).
+        self.CONTESTANT_SUBMISSION_RATE = float(os.getenv('CONTESTANT_SUBMISSION_RATE', 0))
+        self.CONTESTANT_SUBMISSION_BURST = int(os.getenv('CONTESTANT_SUBMISSION_BURST', 10))
+        self.API_KEY_SUBMISSION_RATE = float(os.getenv('API_KEY_SUBMISSION_RATE', 0))
+        self.API_KEY_SUBMISSION_BURST = int(os.getenv('API_KEY_SUBMISSION_BURST', 100))
+        self.MAX_QUEUED_JOBS = int(os.getenv('MAX_QUEUED_JOBS', 0))
+        # Load shedding, see shedding.py: requests of a class running at once per process (0 for no limit), and the
+        # statement timeout for reader queries in seconds (0 for none).
+        self.READER_CONCURRENCY = int(os.getenv('READER_CONCURRENCY', 0))
+        self.WRITER_CONCURRENCY = int(os.getenv('WRITER_CONCURRENCY', 0))
+        self.JURY_CONCURRENCY = int(os.getenv('JURY_CONCURRENCY', 0))
+        self.READER_STATEMENT_TIMEOUT = float(os.getenv('READER_STATEMENT_TIMEOUT', 0))
+        # Seconds of extra queueing per second of a job's expected runtime, 0 for first come, first served. See
+        # Job.calculate_schedule_key, and `bench.py scheduling` to compare weights.
+        self.SCHEDULING_COST_WEIGHT = float(os.getenv('SCHEDULING_COST_WEIGHT', 0))
+        # Hand jobs that have run for longer than their time limit on every test case plus HEDGE_MARGIN seconds to a
+        # second jury when no job is queued; the first verdict wins. See Job.claim_hedge.
+        self.HEDGE_STRAGGLERS = bool(int(os.getenv('HEDGE_STRAGGLERS', 0)))
+        self.HEDGE_MARGIN = float(os.getenv('HEDGE_MARGIN', 30))
+        # Seconds between writes of a running job's progress to SQL, 0 to write every update. Needs Redis; see
+        # progress.py for how buffered reports see cancellations late.
+        self.PROGRESS_FLUSH_INTERVAL = float(os.getenv('PROGRESS_FLUSH_INTERVAL', 0))
+
+        # Submissions whose jobs all finished or were cancelled this many days ago are archived by
+        # `manage.py archive run`, see archive.py.
+        self.ARCHIVE_AFTER_DAYS = float(os.getenv('ARCHIVE_AFTER_DAYS', 30))
+        self.ARCHIVE_BATCH_SIZE = int(os.getenv('ARCHIVE_BATCH_SIZE', 500))
+        # Hours an Idempotency-Key is remembered for, see idempotency.py. Expired keys are deleted by `archive run`.
+        self.IDEMPOTENCY_KEY_TTL = float(os.getenv('IDEMPOTENCY_KEY_TTL', 24))
+
+        # Local blob store for files shared between juries, see blobstore.py.
+        self.BLOB_DIR = os.getenv('BLOB_DIR', str(self.app_root / 'blobs'))
+        self.BLOB_STORE_MAX_BYTES = int(os.getenv('BLOB_STORE_MAX_BYTES', 10 * 2 ** 30))
+
+        # Use orjson for API responses when it is installed. Its output is compact and not ASCII-escaped, so it differs
+        # byte for byte from Flask's; only enable it if no client depends on the exact bytes.
+        self.FAST_JSON = bool(int(os.getenv('FAST_JSON', 0)))
+        # Compress API responses of at least COMPRESSION_MIN_SIZE bytes with zstd or gzip, as the client accepts.
+        self.COMPRESS_RESPONSES = bool(int(os.getenv('COMPRESS_RESPONSES', 1)))
+        self.COMPRESSION_MIN_SIZE = int(os.getenv('COMPRESSION_MIN_SIZE', 1024))
+
+        self.PROFILE_DIR = os.getenv('PROFILE_DIR', str(self.app_root / 'profiles'))
+        self.PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', 0))
+        self.SLOW_QUERY_THRESHOLD = float(os.getenv('SLOW_QUERY_THRESHOLD', 0))  # seconds, 0 to disable
 
         if testing:
             self.TESTING = True
@@ -1,6 +1,8 @@
 import pytest
 
 import main
+import models
+import ratelimit
 from config import JudgeConfig
 from main import db as app_db
 
@@ -26,12 +28,18 @@ def client(app, request_context):
     return app.test_client()
 
 
-@pytest.fixture(scope='class')
+@pytest.fixture(scope='function')
 def db(request, app):
     app_db.reflect()  # Weird hack
     app_db.drop_all()
 
     app_db.create_all()
+    # Ids are reused once the tables are recreated.
+    models.job_problem_version_ids.clear()
+    models.problem_version_limits.clear()
+    models.problem_version_ids.clear()
+    models.runtime_estimates.clear()
+    ratelimit.local_buckets.clear()
 
     def teardown():
         app_db.session.close()
@@ -52,7 +60,7 @@ def request_context(request, app):
     request.addfinalizer(teardown)
 
 
-@pytest.fixture(scope='class')
+@pytest.fixture(scope='function')
 def session(request, db):
     connection = db.engine.connect()
     transaction = connection.begin()
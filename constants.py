@@ -14,6 +14,13 @@ class JobStatus(enum.Enum):
     finished = 'finished'
 
 
+# What happens to a contestant's queued jobs for a problem when they submit to it again, see Job.supersede.
+class SupersedePolicy(enum.Enum):
+    none = 'none'
+    cancel = 'cancel'
+    deprioritize = 'deprioritize'
+
+
 class JobVerdict(enum.Enum):
     accepted = 'AC'
     ran = 'RAN'
@@ -0,0 +1,73 @@
+"""
+Idempotency keys for the endpoints that create submissions and jobs.
+
+A client that sends an Idempotency-Key header (up to 64 characters, unique per API key) can retry a request that timed
+out without creating a second submission or job. The response is stored under the key in the same transaction as what
+the request created, so either both are written or neither is. A retry with the same key gets the stored response
+back without anything being created, queued or rate limited; a key that is reused for a different path or different
+form data is rejected with 422. When two requests with the same key race, the unique index lets only one of them
+commit and the other replays its response.
+
+Keys older than IDEMPOTENCY_KEY_TTL hours count as absent, so a retry with one creates anew; `manage.py archive run`
+deletes them in bulk.
+"""
+
+from datetime import datetime, timedelta
+
+from flask import current_app, g, json, request
+from sqlalchemy.exc import IntegrityError
+
+import util
+from models import db, IdempotencyKey
+
+HEADER = 'Idempotency-Key'
+MAX_LENGTH = 64
+
+
+def get_key():
+    return request.headers.get(HEADER)
+
+
+def hash_request():
+    return util.hash_code(json.dumps(sorted(request.form.items(multi=True))))
+
+
+# Returns the response to replay for the request's key, or None if the request has no key or its key is new.
+def replay():
+    key = get_key()
+    if key is None:
+        return None
+    if not key or len(key) > MAX_LENGTH:
+        return 400, '{} must be 1 to {} characters long.'.format(HEADER, MAX_LENGTH)
+    stored = IdempotencyKey.query.filter_by(api_key_id=g.api_key.id, key=key).first()
+    if stored is None:
+        return None
+    if stored.creation_time < datetime.utcnow() - timedelta(hours=current_app.config['IDEMPOTENCY_KEY_TTL']):
+        # Deleted right away, as the new key is inserted under the same name before the session would delete it.
+        db.session.delete(stored)
+        db.session.flush()
+        return None
+    if stored.path != request.path or stored.request_hash != hash_request():
+        return 422, '{} was already used for a different request.'.format(HEADER)
+    return stored.status, json.loads(stored.response)
+
+
+# Stores the response to the request under its key, if it has one, and commits it along with the rest of the session.
+# Returns None once committed, or the response to replay if a request with the same key committed first; nothing of
+# this request is written then.
+def commit(status, response):
+    key = get_key()
+    if key is None:
+        db.session.commit()
+        return None
+    db.session.add(IdempotencyKey(api_key_id=g.api_key.id, key=key, path=request.path, request_hash=hash_request(),
+                                  status=status, response=json.dumps(response)))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        replayed = replay()
+        if replayed is None:
+            raise
+        return replayed
+    return None
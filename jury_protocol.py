@@ -0,0 +1,108 @@
+"""
+Jury protocol over Socket.IO, an alternative to the HTTP jury endpoints for long-running juries.
+
+A jury connects to the /jury namespace with its API key, in the Socket.IO auth payload or the api_key header. The key
+is checked when connecting, and then again at most every JURY_KEY_CHECK_INTERVAL seconds rather than on every message;
+a jury whose key was deactivated or lost its jury permission is then answered with a 403 and disconnected. Every
+message in either direction is a single msgpack-encoded map, sent as binary. Requests are answered through Socket.IO
+acknowledgements with {'status': <HTTP status code>, ...}:
+
+- claim {toolchain?}: {'status': 200, 'job': <same as POST /jobs/claim>}, or 204 if there is no work. A jury that
+  got a 204 is sent job_available (without a payload) when a job is queued, and should then claim again.
+- progress {id, verification_code, last_ran_case, execution_time, execution_memory, verdict?}: same as
+  POST /jobs/<id>/submit; {'status': 200} or {'status': <error>, 'message': ...}.
+- release {id, verification_code}: same as POST /jobs/<id>/release.
+
+While it runs a job, a jury is sent job_cancelled {id} if the job is cancelled.
+
+Every jury waiting for work is woken up by job_available and only one of them gets the job; the rest get a 204 and
+keep waiting.
+"""
+
+import time
+
+import msgpack
+from flask import current_app, request, session
+from flask_socketio import disconnect, join_room, leave_room
+from werkzeug.exceptions import HTTPException
+
+import metrics
+import views
+from models import APIKey, db
+from sockets import JURY_NAMESPACE, JURY_WAITING_ROOM, socketio
+
+
+def jury_event(name):
+    def decorator(func):
+        @socketio.on(name, namespace=JURY_NAMESPACE)
+        def handler(payload=None):
+            if 'jury_key_id' not in session or not check_jury_key():
+                disconnect()
+                return msgpack.packb({'status': 403})
+            metrics.JURY_MESSAGES.labels(event=name).inc()
+            message = msgpack.unpackb(payload) if payload else {}
+            try:
+                return msgpack.packb(func(message))
+            except HTTPException as e:
+                return msgpack.packb({'status': e.code})
+            except (KeyError, TypeError, ValueError):
+                return msgpack.packb({'status': 400})
+
+        return handler
+
+    return decorator
+
+
+def check_jury_key():
+    if time.monotonic() - session['jury_key_check_time'] < current_app.config['JURY_KEY_CHECK_INTERVAL']:
+        return True
+    if not db.session.query(APIKey.query.filter_by(id=session['jury_key_id'], active=True, perm_jury=True).exists()) \
+            .scalar():
+        return False
+    session['jury_key_check_time'] = time.monotonic()
+    return True
+
+
+def result(status, body):
+    if status == 200 or body is None:
+        return {'status': status}
+    return {'status': status, 'message': body}
+
+
+@socketio.on('connect', namespace=JURY_NAMESPACE)
+def connect(auth=None):
+    key = (auth or {}).get('api_key') or request.headers.get('api_key')
+    api_key = APIKey.query.filter_by(key=key, active=True, perm_jury=True).first() if key else None
+    if api_key is None:
+        return False
+    # Flask-SocketIO keeps the session for the lifetime of the connection.
+    session['jury_key_id'] = api_key.id
+    session['jury_key_check_time'] = time.monotonic()
+
+
+@jury_event('claim')
+def claim(message):
+    details = views.claim_job('jury-{}'.format(session['jury_key_id']), message.get('toolchain'))
+    if details is None:
+        join_room(JURY_WAITING_ROOM)
+        return {'status': 204}
+    leave_room(JURY_WAITING_ROOM)
+    join_room('jury_job_{}'.format(details['id']))
+    return {'status': 200, 'job': details}
+
+
+@jury_event('progress')
+def progress(message):
+    job_id = int(message['id'])
+    status, body = views.submit_job(job_id, message)
+    if status != 200 or message.get('verdict'):
+        leave_room('jury_job_{}'.format(job_id))
+    return result(status, body)
+
+
+@jury_event('release')
+def release(message):
+    job_id = int(message['id'])
+    status, body = views.release_job(job_id, int(message['verification_code']))
+    leave_room('jury_job_{}'.format(job_id))
+    return result(status, body)
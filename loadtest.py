@@ -0,0 +1,366 @@
+"""
+Contest load generator for the judge API.
+
+Simulates contestants creating submissions, juries running the claim/submit/verdict cycle (over HTTP, or over the
+Socket.IO jury protocol with --jury-protocol socketio) and front-ends polling job and submission details (and, when
+python-socketio's client is installed, subscribing to them over Socket.IO).
+Every simulated actor gets its own seeded random generator, so runs with the same arguments issue the same mix of
+requests.
+
+Run the judge separately, e.g. for a local SQLite + Redis setup:
+
+    DATABASE_URI=sqlite:////tmp/judge.db REDIS_URI=redis://localhost gunicorn --worker-class eventlet main:app
+
+and then point the load generator at it:
+
+    DATABASE_URI=sqlite:////tmp/judge.db python loadtest.py --init-db --create-keys --judge-url http://localhost:8000
+
+To see how throughput scales with the number of judge processes, run the same load against
+docker-compose.scale.yml with --scale judge=1, 2, 4, ... and compare the reports. The judge scales per container
+only (one gunicorn worker each), and this comparison has not been run yet, so there are no numbers to go by.
+
+--create-keys and --init-db talk to DATABASE_URI directly; pass --reader-key and --jury-key instead to run against a
+judge whose database is not reachable.
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from collections import defaultdict
+
+import requests
+
+try:
+    import msgpack
+    import socketio as socketio_client
+except ImportError:
+    socketio_client = None
+
+CODE_TEMPLATE = 'print({})\n'
+LANGUAGES = ['python3', 'cxx', 'java']
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.queue_waits = []
+        self.jobs_created = {}
+        self.jobs_finished = 0
+        self.socketio_events = 0
+
+    def record(self, endpoint, elapsed, ok):
+        with self.lock:
+            self.latencies[endpoint].append(elapsed)
+            if not ok:
+                self.errors[endpoint] += 1
+
+    def job_created(self, job_id, submission_id):
+        with self.lock:
+            self.jobs_created[job_id] = (time.time(), submission_id)
+
+    def job_claimed(self, job_id):
+        with self.lock:
+            created = self.jobs_created.get(job_id)
+            if created:
+                self.queue_waits.append(time.time() - created[0])
+
+    def job_finished(self):
+        with self.lock:
+            self.jobs_finished += 1
+
+    def recent_jobs(self, n):
+        with self.lock:
+            return list(self.jobs_created.items())[-n:]
+
+    def report(self, duration):
+        result = {'duration': duration, 'endpoints': {}}
+        total = 0
+        for endpoint, latencies in sorted(self.latencies.items()):
+            total += len(latencies)
+            result['endpoints'][endpoint] = {
+                'requests': len(latencies),
+                'errors': self.errors[endpoint],
+                'throughput': len(latencies) / duration,
+                'p50': percentile(latencies, 0.5),
+                'p99': percentile(latencies, 0.99),
+            }
+        result['throughput'] = total / duration
+        result['jobs_created'] = len(self.jobs_created)
+        result['jobs_finished'] = self.jobs_finished
+        result['queue_wait'] = {'p50': percentile(self.queue_waits, 0.5), 'p99': percentile(self.queue_waits, 0.99)}
+        result['socketio_events'] = self.socketio_events
+        return result
+
+
+class Actor(threading.Thread):
+    def __init__(self, args, stats, index, deadline):
+        super().__init__(daemon=True)
+        self.args = args
+        self.stats = stats
+        self.random = random.Random('{}-{}-{}'.format(args.seed, type(self).__name__, index))
+        self.index = index
+        self.deadline = deadline
+        self.session = requests.Session()
+
+    def call(self, method, endpoint, path, api_key, **kwargs):
+        start_time = time.perf_counter()
+        try:
+            response = self.session.request(method, self.args.judge_url + path, headers={'api_key': api_key},
+                                            timeout=self.args.timeout, **kwargs)
+        except requests.RequestException:
+            self.stats.record(endpoint, time.perf_counter() - start_time, False)
+            return None
+        self.stats.record(endpoint, time.perf_counter() - start_time, response.status_code < 500)
+        return response
+
+    def think(self, mean):
+        time.sleep(min(self.random.expovariate(1 / mean), max(0, self.deadline - time.time())))
+
+    def run(self):
+        while time.time() < self.deadline:
+            self.step()
+
+
+class Contestant(Actor):
+    def step(self):
+        response = self.call('POST', 'POST /submissions', '/submissions', self.args.reader_key, data={
+            'problem_id': self.args.problem_id,
+            'uid': self.index,
+            'gid': self.index // 3,
+            'language': self.random.choice(LANGUAGES),
+            'code': CODE_TEMPLATE.format(self.random.random()),
+        })
+        if response is not None and response.status_code == 201:
+            body = response.json()
+            self.stats.job_created(body['job_id'], body['id'])
+        self.think(self.args.contestant_think_time)
+
+
+class Jury(Actor):
+    def step(self):
+        response = self.call('POST', 'POST /jobs/claim', '/jobs/claim', self.args.jury_key)
+        if response is None or response.status_code != 200:
+            self.think(self.args.jury_poll_interval)
+            return
+
+        job = response.json()
+        self.stats.job_claimed(job['id'])
+        path = '/jobs/{}/submit'.format(job['id'])
+        for case in range(1, self.args.test_cases + 1):
+            time.sleep(self.random.uniform(0, 2 * self.args.case_time))
+            data = {
+                'verification_code': job['verification_code'],
+                'execution_time': self.random.uniform(0, self.args.case_time),
+                'execution_memory': self.random.randint(1000, 64000),
+                'last_ran_case': case,
+            }
+            if case == self.args.test_cases:
+                data['verdict'] = self.random.choice(['AC', 'WA'])
+            response = self.call('POST', 'POST /jobs/<id>/submit', path, self.args.jury_key, data=data)
+            if response is None or response.status_code != 200:
+                return
+        self.stats.job_finished()
+
+
+# Runs the same loop as Jury over the Socket.IO jury protocol (see jury_protocol.py).
+class SocketJury(Actor):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.job_available = threading.Event()
+        self.socket = socketio_client.Client()
+        self.socket.on('job_available', self.job_available.set, namespace='/jury')
+        self.socket.connect(self.args.judge_url, namespaces=['/jury'], auth={'api_key': self.args.jury_key})
+
+    def call(self, event, **message):
+        start_time = time.perf_counter()
+        try:
+            response = msgpack.unpackb(self.socket.call(event, msgpack.packb(message), namespace='/jury',
+                                                        timeout=self.args.timeout))
+        except socketio_client.exceptions.TimeoutError:
+            self.stats.record('WS ' + event, time.perf_counter() - start_time, False)
+            return None
+        self.stats.record('WS ' + event, time.perf_counter() - start_time, response['status'] < 500)
+        return response
+
+    def step(self):
+        self.job_available.clear()
+        response = self.call('claim')
+        if response is None or response['status'] != 200:
+            self.job_available.wait(max(0, self.deadline - time.time()))
+            return
+
+        job = response['job']
+        self.stats.job_claimed(job['id'])
+        for case in range(1, self.args.test_cases + 1):
+            time.sleep(self.random.uniform(0, 2 * self.args.case_time))
+            report = {
+                'id': job['id'],
+                'verification_code': job['verification_code'],
+                'execution_time': self.random.uniform(0, self.args.case_time),
+                'execution_memory': self.random.randint(1000, 64000),
+                'last_ran_case': case,
+            }
+            if case == self.args.test_cases:
+                report['verdict'] = self.random.choice(['AC', 'WA'])
+            response = self.call('progress', **report)
+            if response is None or response['status'] != 200:
+                return
+        self.stats.job_finished()
+
+    def run(self):
+        super().run()
+        self.socket.disconnect()
+
+
+class Poller(Actor):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.socket = None
+        self.subscribed = set()
+        if self.args.socketio and socketio_client is not None:
+            self.socket = socketio_client.Client()
+            self.socket.on('job_updated', self.on_event)
+            self.socket.on('job_init', self.on_event)
+            self.socket.connect(self.args.judge_url)
+
+    def on_event(self, *args):
+        with self.stats.lock:
+            self.stats.socketio_events += 1
+
+    def step(self):
+        recent = self.stats.recent_jobs(self.args.poll_window)
+        if recent:
+            job_id, (_, submission_id) = self.random.choice(recent)
+            self.call('GET', 'GET /jobs/<id>', '/jobs/{}'.format(job_id), self.args.reader_key)
+            self.call('GET', 'GET /submissions/<id>', '/submissions/{}'.format(submission_id), self.args.reader_key)
+            if self.socket is not None and job_id not in self.subscribed:
+                self.subscribed.add(job_id)
+                self.socket.emit('sub_job', job_id)
+        self.think(self.args.poll_interval)
+
+    def run(self):
+        super().run()
+        if self.socket is not None:
+            self.socket.disconnect()
+
+
+def create_keys(args):
+    from main import app
+    from models import APIKey
+    with app.app_context():
+        args.reader_key = APIKey.new(name='loadtest-reader', perm_reader=True).key
+        args.jury_key = APIKey.new(name='loadtest-jury', perm_jury=True).key
+
+
+def init_db():
+    from main import app
+    from models import db
+    with app.app_context():
+        db.create_all()
+
+
+def create_problem(args):
+    response = requests.post(args.judge_url + '/problems', headers={'api_key': args.reader_key}, data={
+        'id': args.problem_id,
+        'test_cases': args.test_cases,
+        'time_limit': 1,
+        'memory_limit': 256000,
+        'generator_code': 'print(1)',
+        'generator_language': 'python3',
+        'grader_code': 'print(1)',
+        'grader_language': 'python3',
+    }, timeout=args.timeout)
+    if response.status_code not in (201, 409):
+        raise RuntimeError('Could not create problem: {}'.format(response.status_code))
+
+
+def run(args):
+    if args.init_db:
+        init_db()
+    if args.create_keys:
+        create_keys(args)
+    if not args.reader_key or not args.jury_key:
+        raise SystemExit('Need --reader-key and --jury-key, or --create-keys.')
+    create_problem(args)
+
+    stats = Stats()
+    start_time = time.time()
+    deadline = start_time + args.duration
+    actors = [Contestant(args, stats, i, deadline) for i in range(args.contestants)]
+    if args.jury_protocol == 'socketio':
+        if socketio_client is None:
+            raise SystemExit('--jury-protocol socketio needs python-socketio and msgpack.')
+        actors += [SocketJury(args, stats, i, deadline) for i in range(args.juries)]
+    else:
+        actors += [Jury(args, stats, i, deadline) for i in range(args.juries)]
+    actors += [Poller(args, stats, i, deadline) for i in range(args.pollers)]
+    for actor in actors:
+        actor.start()
+    for actor in actors:
+        actor.join()
+    return stats.report(time.time() - start_time)
+
+
+def format_seconds(value):
+    return '-' if value is None else '{:.1f}ms'.format(value * 1000)
+
+
+def print_report(report):
+    print('{:<28} {:>9} {:>7} {:>9} {:>9} {:>9}'.format('endpoint', 'requests', 'errors', 'req/s', 'p50', 'p99'))
+    for endpoint, row in report['endpoints'].items():
+        print('{:<28} {:>9} {:>7} {:>9.1f} {:>9} {:>9}'.format(endpoint, row['requests'], row['errors'],
+                                                              row['throughput'], format_seconds(row['p50']),
+                                                              format_seconds(row['p99'])))
+    print()
+    print('total throughput: {:.1f} req/s'.format(report['throughput']))
+    print('jobs created: {}, finished: {}'.format(report['jobs_created'], report['jobs_finished']))
+    print('queue wait p50: {}, p99: {}'.format(format_seconds(report['queue_wait']['p50']),
+                                               format_seconds(report['queue_wait']['p99'])))
+    print('socket.io events received: {}'.format(report['socketio_events']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate a contest against a running judge.')
+    parser.add_argument('--judge-url', default='http://localhost:5000')
+    parser.add_argument('--reader-key')
+    parser.add_argument('--jury-key')
+    parser.add_argument('--create-keys', action='store_true', help='create API keys directly in DATABASE_URI')
+    parser.add_argument('--init-db', action='store_true', help='create missing tables in DATABASE_URI')
+    parser.add_argument('--problem-id', type=int, default=900000)
+    parser.add_argument('--test-cases', type=int, default=10)
+    parser.add_argument('--contestants', type=int, default=50)
+    parser.add_argument('--juries', type=int, default=5)
+    parser.add_argument('--pollers', type=int, default=10)
+    parser.add_argument('--duration', type=float, default=60, help='seconds')
+    parser.add_argument('--contestant-think-time', type=float, default=5, help='mean seconds between submissions')
+    parser.add_argument('--case-time', type=float, default=0.05, help='mean seconds per simulated test case')
+    parser.add_argument('--jury-poll-interval', type=float, default=0.5)
+    parser.add_argument('--poll-interval', type=float, default=1)
+    parser.add_argument('--poll-window', type=int, default=100, help='how many recent jobs pollers pick from')
+    parser.add_argument('--no-socketio', dest='socketio', action='store_false')
+    parser.add_argument('--jury-protocol', choices=['http', 'socketio'], default='http')
+    parser.add_argument('--timeout', type=float, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+
+    report = run(args)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == '__main__':
+    main()
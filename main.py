@@ -2,7 +2,13 @@ import os
 
 from flask import Flask
 
+import blobstore
+import cache_bus
 import config
+import jury_protocol  # registers the /jury Socket.IO namespace
+import queues
+import redis_store
+import replica
 import util
 import views
 from models import db
@@ -15,6 +21,11 @@ app.config.from_object(config.JudgeConfig(app_root=self_path))
 app.json_encoder = util.JSONEncoder
 
 db.init_app(app)
+redis_store.init_app(app)
+queues.init_app(app)
+blobstore.init_app(app)
+cache_bus.init_app(app)
+replica.init_app(app)
 if app.config['ENABLE_SOCKETIO']:
     socketio.init_app(app, message_queue=app.config['REDIS_URI'])
 
@@ -1,6 +1,10 @@
+from datetime import datetime, timedelta
+
 from flask_migrate import Migrate, MigrateCommand
 from flask_script import Manager, Server
 
+import archive
+import queues
 import util
 from main import app
 from models import db, APIKey
@@ -28,5 +32,31 @@ def generate(name=None, jury=False, reader=False, master=False):
 
 manager.add_command('api_key', api_key_manager)
 
+queue_manager = Manager()
+
+
+@queue_manager.command
+def rebuild():
+    with app.app_context():
+        queues.get_queue().rebuild()
+
+manager.add_command('queue', queue_manager)
+
+archive_manager = Manager()
+
+
+@archive_manager.command
+def run(days=None, batch_size=None, pause=0):
+    with app.app_context():
+        cutoff = datetime.utcnow() - timedelta(days=float(days or app.config['ARCHIVE_AFTER_DAYS']))
+        batch_size = int(batch_size or app.config['ARCHIVE_BATCH_SIZE'])
+        archived = archive.archive(cutoff, batch_size, float(pause))
+        pruned = archive.prune_events(cutoff, batch_size)
+        key_cutoff = datetime.utcnow() - timedelta(hours=app.config['IDEMPOTENCY_KEY_TTL'])
+        expired = archive.prune_idempotency_keys(key_cutoff, batch_size)
+    print('Archived {} submissions, deleted {} events and {} idempotency keys.'.format(archived, pruned, expired))
+
+manager.add_command('archive', archive_manager)
+
 if __name__ == '__main__':
     manager.run()
@@ -0,0 +1,137 @@
+"""
+Prometheus metrics for the judge.
+
+Metrics are exposed in the text exposition format at /metrics, to scrapers that send METRICS_TOKEN as a bearer token
+(Authorization: Bearer <token>) or a master API key in the api_key header. When gunicorn runs more than one worker,
+each worker keeps its own counters, so PROMETHEUS_MULTIPROC_DIR must point at a directory shared by all of the workers
+and emptied before they start (gunicorn_config.py takes care of this). /metrics then aggregates the values of every
+worker.
+
+Queue depth is not tracked incrementally; it is counted from the database, at most once every QUEUE_DEPTH_TTL seconds
+per process however often /metrics is scraped.
+"""
+
+import os
+import time
+
+from flask import g, has_app_context
+from prometheus_client import CollectorRegistry, Counter, Histogram, REGISTRY, generate_latest, multiprocess
+from prometheus_client.core import GaugeMetricFamily
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import constants
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Judging a job takes anywhere from a second to several minutes, so the job histograms use wider buckets than the
+# request ones.
+JOB_BUCKETS = (0.5, 1, 2.5, 5, 10, 15, 30, 60, 120, 300, 600, 1800, float('inf'))
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89, float('inf'))
+QUEUE_DEPTH_TTL = 10  # seconds
+
+REQUEST_LATENCY = Histogram('judge_request_latency_seconds', 'Time spent handling an API request.', ['endpoint'])
+REQUESTS = Counter('judge_requests_total', 'API requests handled.', ['endpoint', 'status'])
+REQUEST_DB_QUERIES = Histogram('judge_request_db_queries', 'Database queries issued while handling an API request.',
+                               ['endpoint'], buckets=QUERY_COUNT_BUCKETS)
+REQUEST_DB_TIME = Histogram('judge_request_db_seconds', 'Time spent in the database while handling an API request.',
+                            ['endpoint'])
+
+JOB_QUEUE_WAIT = Histogram('judge_job_queue_wait_seconds', 'Time from job creation to claim.', buckets=JOB_BUCKETS)
+JOB_RUN_TIME = Histogram('judge_job_run_seconds', 'Time from job claim to completion.', buckets=JOB_BUCKETS)
+
+SOCKETIO_EMITS = Counter('judge_socketio_emits_total', 'Socket.IO events emitted.', ['event'])
+JURY_MESSAGES = Counter('judge_jury_messages_total', 'Messages received from juries over the Socket.IO jury protocol.',
+                        ['event'])
+CALLBACKS = Counter('judge_callbacks_total', 'Job callbacks fired.', ['result'])
+
+ARTIFACT_LOOKUPS = Counter('judge_artifact_lookups_total', 'Compiled artifact lookups on job claims.', ['result'])
+TEST_DATA_LOOKUPS = Counter('judge_test_data_lookups_total', 'Generated test data lookups on job claims.', ['result'])
+BLOB_EVICTIONS = Counter('judge_blob_evictions_total', 'Blobs evicted from the blob store to stay within its size bound.')
+
+JOBS_SUPERSEDED = Counter('judge_jobs_superseded_total', 'Queued jobs cancelled or deprioritized by a resubmission.',
+                          ['policy'])
+RUNNING_JOBS_CANCELLED = Counter('judge_running_jobs_cancelled_total', 'Jobs cancelled while claimed by a jury.')
+# Estimated as the worst case for the remaining test cases: their count times the problem's time limit.
+JURY_SECONDS_SAVED = Counter('judge_jury_seconds_saved_total',
+                             'Estimated jury time saved by telling juries about cancelled jobs.')
+HEDGES_ISSUED = Counter('judge_hedges_issued_total', 'Straggling jobs handed to a second jury.')
+HEDGES_WON = Counter('judge_hedges_won_total', 'Hedged jobs whose verdict came from the second jury.')
+SUBMISSIONS_REJECTED = Counter('judge_submissions_rejected_total',
+                               'Submissions and jobs rejected by admission control.', ['reason'])
+REQUESTS_SHED = Counter('judge_requests_shed_total', 'API requests shed under overload.', ['request_class', 'reason'])
+READ_ROUTING = Counter('judge_read_routing_total', 'Read-only requests by the database they were routed to.',
+                       ['target', 'reason'])
+
+
+def _multiprocess_dir():
+    return os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+
+
+# Query timing, shared with the slow query log (profiling.py). The start time is kept on the statement's execution
+# context rather than the connection, so a statement that fails, which gets no after_cursor_execute, leaves nothing
+# behind on a pooled connection.
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.query_start_time = time.perf_counter()
+
+
+# Seconds the statement took; only valid in after_cursor_execute.
+def query_elapsed(context):
+    if not hasattr(context, 'query_elapsed'):
+        context.query_elapsed = time.perf_counter() - context.query_start_time
+    return context.query_elapsed
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is None or not hasattr(context, 'query_start_time'):
+        return
+    elapsed = query_elapsed(context)
+    if has_app_context():
+        g.query_count = g.get('query_count', 0) + 1
+        g.query_time = g.get('query_time', 0.0) + elapsed
+
+
+def reset_query_stats():
+    g.query_count = 0
+    g.query_time = 0.0
+
+
+def observe_request(endpoint, status_code, elapsed):
+    endpoint = endpoint or 'none'
+    REQUEST_LATENCY.labels(endpoint=endpoint).observe(elapsed)
+    REQUESTS.labels(endpoint=endpoint, status=status_code).inc()
+    REQUEST_DB_QUERIES.labels(endpoint=endpoint).observe(g.get('query_count', 0))
+    REQUEST_DB_TIME.labels(endpoint=endpoint).observe(g.get('query_time', 0.0))
+
+
+class QueueDepthCollector:
+    def __init__(self, count_by_status):
+        self.count_by_status = count_by_status
+        self.counts = None
+        self.count_time = 0.0
+
+    def collect(self):
+        if self.counts is None or time.monotonic() - self.count_time > QUEUE_DEPTH_TTL:
+            self.counts = dict(self.count_by_status())
+            self.count_time = time.monotonic()
+        counts = self.counts
+        family = GaugeMetricFamily('judge_queue_depth', 'Jobs currently in each status.', labels=['status'])
+        for status in constants.JobStatus:
+            family.add_metric([status.value], counts.get(status, 0))
+        yield family
+
+
+def generate(queue_depth):
+    if _multiprocess_dir():
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+
+    scrape_registry = CollectorRegistry()
+    scrape_registry.register(queue_depth)
+
+    return generate_latest(registry) + generate_latest(scrape_registry)
@@ -0,0 +1,22 @@
+"""Add version to jobs
+
+Revision ID: 3b1f0c6a2d45
+Revises: 4798d390f029
+Create Date: 2026-10-19 10:12:31.402113
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3b1f0c6a2d45'
+down_revision = '4798d390f029'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('jobs', sa.Column('version', sa.Integer(), nullable=False, server_default='1'))
+
+
+def downgrade():
+    op.drop_column('jobs', 'version')
@@ -0,0 +1,69 @@
+"""Add archive tables for old jobs and submissions
+
+Revision ID: 5d8b3e61f2a7
+Revises: 9e4a7f3c51b8
+Create Date: 2026-10-19 18:21:40.502317
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5d8b3e61f2a7'
+down_revision = '9e4a7f3c51b8'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# The enum types already exist for the jobs table.
+def existing_enum(name, *values):
+    return sa.Enum(*values, name=name).with_variant(postgresql.ENUM(*values, name=name, create_type=False),
+                                                    'postgresql')
+
+
+def upgrade():
+    op.create_table('archived_submissions',
+                    sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+                    sa.Column('uid', sa.Integer(), nullable=True),
+                    sa.Column('gid', sa.Integer(), nullable=True),
+                    sa.Column('time', sa.DateTime(), nullable=False),
+                    sa.Column('problem_id', sa.Integer(), nullable=False),
+                    sa.Column('code', sa.UnicodeText(), nullable=False),
+                    sa.Column('language', sa.Unicode(length=10), nullable=False),
+                    sa.PrimaryKeyConstraint('id')
+                    )
+    op.create_index('ix_archived_submissions_problem_id_uid', 'archived_submissions', ['problem_id', 'uid'],
+                    unique=False)
+    op.create_index('ix_archived_submissions_uid', 'archived_submissions', ['uid'], unique=False)
+    op.create_index('ix_archived_submissions_gid', 'archived_submissions', ['gid'], unique=False)
+    op.create_table('archived_jobs',
+                    sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+                    sa.Column('submission_id', sa.Integer(), nullable=True),
+                    sa.Column('creation_time', sa.DateTime(), nullable=True),
+                    sa.Column('status', existing_enum('jobstatus', 'queued', 'cancelled', 'started',
+                                                      'awaiting_verdict', 'finished'), nullable=False),
+                    sa.Column('claim_time', sa.DateTime(), nullable=True),
+                    sa.Column('completion_time', sa.DateTime(), nullable=True),
+                    sa.Column('verification_code', sa.Integer(), nullable=True),
+                    sa.Column('last_ran_case', sa.Integer(), nullable=True),
+                    sa.Column('execution_time', sa.Float(), nullable=True),
+                    sa.Column('execution_memory', sa.Integer(), nullable=True),
+                    sa.Column('verdict', existing_enum('jobverdict', 'accepted', 'ran', 'invalid_source',
+                                                       'wrong_answer', 'time_limit_exceeded', 'memory_limit_exceeded',
+                                                       'runtime_error', 'illegal_syscall', 'compilation_error',
+                                                       'judge_error'), nullable=True),
+                    sa.Column('callback_url', sa.UnicodeText(), nullable=True),
+                    sa.Column('version', sa.Integer(), nullable=False),
+                    sa.Column('problem_version_id', sa.Integer(), nullable=True),
+                    sa.PrimaryKeyConstraint('id')
+                    )
+    op.create_index('ix_archived_jobs_submission_id', 'archived_jobs', ['submission_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_archived_jobs_submission_id', table_name='archived_jobs')
+    op.drop_table('archived_jobs')
+    op.drop_index('ix_archived_submissions_gid', table_name='archived_submissions')
+    op.drop_index('ix_archived_submissions_uid', table_name='archived_submissions')
+    op.drop_index('ix_archived_submissions_problem_id_uid', table_name='archived_submissions')
+    op.drop_table('archived_submissions')
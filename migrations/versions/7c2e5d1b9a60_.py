@@ -0,0 +1,27 @@
+"""Add per-problem supersede policies
+
+Revision ID: 7c2e5d1b9a60
+Revises: 3b1f0c6a2d45
+Create Date: 2026-10-19 14:02:18.630517
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7c2e5d1b9a60'
+down_revision = '3b1f0c6a2d45'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    supersede_policy = sa.Enum('none', 'cancel', 'deprioritize', name='supersedepolicy')
+    supersede_policy.create(op.get_bind(), checkfirst=True)
+    op.add_column('problems', sa.Column('supersede_policy', supersede_policy, nullable=True))
+    op.create_index('ix_submissions_problem_id_uid', 'submissions', ['problem_id', 'uid'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_submissions_problem_id_uid', table_name='submissions')
+    op.drop_column('problems', 'supersede_policy')
+    sa.Enum(name='supersedepolicy').drop(op.get_bind(), checkfirst=True)
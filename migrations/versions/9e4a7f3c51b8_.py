@@ -0,0 +1,54 @@
+"""Add problem versions and pin jobs to them
+
+Revision ID: 9e4a7f3c51b8
+Revises: 7c2e5d1b9a60
+Create Date: 2026-10-19 16:47:05.118934
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9e4a7f3c51b8'
+down_revision = '7c2e5d1b9a60'
+
+from alembic import op
+import sqlalchemy as sa
+
+VERSION_COLUMNS = 'test_cases, time_limit, memory_limit, generator_code, generator_language, grader_code, ' \
+                  'grader_language, source_verifier_code, source_verifier_language'
+
+
+def upgrade():
+    op.create_table('problem_versions',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('problem_id', sa.Integer(), nullable=False),
+                    sa.Column('creation_time', sa.DateTime(), nullable=False),
+                    sa.Column('test_cases', sa.Integer(), nullable=False),
+                    sa.Column('time_limit', sa.Float(), nullable=False),
+                    sa.Column('memory_limit', sa.Integer(), nullable=False),
+                    sa.Column('generator_code', sa.UnicodeText(), nullable=False),
+                    sa.Column('generator_language', sa.Unicode(length=10), nullable=False),
+                    sa.Column('grader_code', sa.UnicodeText(), nullable=False),
+                    sa.Column('grader_language', sa.Unicode(length=10), nullable=False),
+                    sa.Column('source_verifier_code', sa.UnicodeText(), nullable=True),
+                    sa.Column('source_verifier_language', sa.Unicode(length=10), nullable=True),
+                    sa.ForeignKeyConstraint(['problem_id'], ['problems.id'], ),
+                    sa.PrimaryKeyConstraint('id')
+                    )
+    op.create_index(op.f('ix_problem_versions_problem_id'), 'problem_versions', ['problem_id'], unique=False)
+    op.add_column('jobs', sa.Column('problem_version_id', sa.Integer(), nullable=True))
+    op.create_foreign_key('jobs_problem_version_id_fkey', 'jobs', 'problem_versions', ['problem_version_id'], ['id'])
+
+    # Existing jobs are pinned to a snapshot of their problem as it is now.
+    op.execute('INSERT INTO problem_versions (problem_id, creation_time, {0}) '
+               'SELECT id, last_modified, {0} FROM problems'.format(VERSION_COLUMNS))
+    op.execute('UPDATE jobs SET problem_version_id = ('
+               'SELECT problem_versions.id FROM problem_versions '
+               'JOIN submissions ON submissions.problem_id = problem_versions.problem_id '
+               'WHERE submissions.id = jobs.submission_id)')
+
+
+def downgrade():
+    op.drop_constraint('jobs_problem_version_id_fkey', 'jobs', type_='foreignkey')
+    op.drop_column('jobs', 'problem_version_id')
+    op.drop_index(op.f('ix_problem_versions_problem_id'), table_name='problem_versions')
+    op.drop_table('problem_versions')
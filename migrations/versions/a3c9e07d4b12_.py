@@ -0,0 +1,32 @@
+"""Add the event log
+
+Revision ID: a3c9e07d4b12
+Revises: 5d8b3e61f2a7
+Create Date: 2026-10-19 19:05:12.774031
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a3c9e07d4b12'
+down_revision = '5d8b3e61f2a7'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('events',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('time', sa.DateTime(), nullable=False),
+                    sa.Column('name', sa.Unicode(length=32), nullable=False),
+                    sa.Column('job_id', sa.Integer(), nullable=True),
+                    sa.Column('submission_id', sa.Integer(), nullable=True),
+                    sa.Column('data', sa.UnicodeText(), nullable=True),
+                    sa.PrimaryKeyConstraint('id')
+                    )
+    op.create_index(op.f('ix_events_time'), 'events', ['time'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_events_time'), table_name='events')
+    op.drop_table('events')
@@ -0,0 +1,37 @@
+"""Add idempotency keys
+
+Revision ID: b58d2c7e9f13
+Revises: e2b61f8a4c90
+Create Date: 2026-10-19 21:47:05.912376
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b58d2c7e9f13'
+down_revision = 'e2b61f8a4c90'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('idempotency_keys',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('api_key_id', sa.Integer(), nullable=False),
+                    sa.Column('key', sa.String(length=64), nullable=False),
+                    sa.Column('creation_time', sa.DateTime(), nullable=False),
+                    sa.Column('path', sa.Unicode(length=256), nullable=False),
+                    sa.Column('request_hash', sa.String(length=64), nullable=False),
+                    sa.Column('status', sa.Integer(), nullable=False),
+                    sa.Column('response', sa.UnicodeText(), nullable=True),
+                    sa.ForeignKeyConstraint(['api_key_id'], ['apikeys.id'], ),
+                    sa.PrimaryKeyConstraint('id')
+                    )
+    op.create_index('ix_idempotency_keys_api_key_id_key', 'idempotency_keys', ['api_key_id', 'key'], unique=True)
+    op.create_index(op.f('ix_idempotency_keys_creation_time'), 'idempotency_keys', ['creation_time'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_idempotency_keys_creation_time'), table_name='idempotency_keys')
+    op.drop_index('ix_idempotency_keys_api_key_id_key', table_name='idempotency_keys')
+    op.drop_table('idempotency_keys')
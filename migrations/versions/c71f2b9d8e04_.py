@@ -0,0 +1,26 @@
+"""Add per-problem submission rate limits and index job statuses
+
+Revision ID: c71f2b9d8e04
+Revises: a3c9e07d4b12
+Create Date: 2026-10-19 19:48:33.210965
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c71f2b9d8e04'
+down_revision = 'a3c9e07d4b12'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('problems', sa.Column('submission_rate', sa.Float(), nullable=True))
+    op.add_column('problems', sa.Column('submission_burst', sa.Integer(), nullable=True))
+    op.create_index(op.f('ix_jobs_status'), 'jobs', ['status'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_jobs_status'), table_name='jobs')
+    op.drop_column('problems', 'submission_burst')
+    op.drop_column('problems', 'submission_rate')
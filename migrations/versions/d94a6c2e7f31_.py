@@ -0,0 +1,50 @@
+"""Add job schedule keys
+
+Revision ID: d94a6c2e7f31
+Revises: c71f2b9d8e04
+Create Date: 2026-10-19 20:31:58.640172
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'd94a6c2e7f31'
+down_revision = 'c71f2b9d8e04'
+
+from datetime import timezone
+
+from alembic import op
+import sqlalchemy as sa
+
+BATCH_SIZE = 10000
+
+
+# Existing jobs are scheduled first come, first served. The keys are computed in Python, because creation times are
+# naive UTC and the database's own conversions (e.g. MySQL's UNIX_TIMESTAMP) use the session time zone.
+def backfill(table_name):
+    jobs = sa.table(table_name, sa.column('id', sa.Integer), sa.column('creation_time', sa.DateTime),
+                    sa.column('schedule_key', sa.Float))
+    connection = op.get_bind()
+    update = jobs.update().where(jobs.c.id == sa.bindparam('job_id')).values(schedule_key=sa.bindparam('key'))
+    last_id = 0
+    while True:
+        rows = connection.execute(sa.select([jobs.c.id, jobs.c.creation_time]).where(jobs.c.id > last_id)
+                                  .order_by(jobs.c.id).limit(BATCH_SIZE)).fetchall()
+        if not rows:
+            break
+        connection.execute(update, [{'job_id': job_id, 'key': creation_time.replace(tzinfo=timezone.utc).timestamp()}
+                                    for job_id, creation_time in rows])
+        last_id = rows[-1][0]
+
+
+def upgrade():
+    op.add_column('jobs', sa.Column('schedule_key', sa.Float(), nullable=True))
+    op.add_column('archived_jobs', sa.Column('schedule_key', sa.Float(), nullable=True))
+    backfill('jobs')
+    backfill('archived_jobs')
+    op.create_index(op.f('ix_jobs_schedule_key'), 'jobs', ['schedule_key'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_jobs_schedule_key'), table_name='jobs')
+    op.drop_column('archived_jobs', 'schedule_key')
+    op.drop_column('jobs', 'schedule_key')
@@ -0,0 +1,26 @@
+"""Add job hedges
+
+Revision ID: e2b61f8a4c90
+Revises: d94a6c2e7f31
+Create Date: 2026-10-19 21:12:40.318204
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e2b61f8a4c90'
+down_revision = 'd94a6c2e7f31'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    for table in ['jobs', 'archived_jobs']:
+        op.add_column(table, sa.Column('hedge_verification_code', sa.Integer(), nullable=True))
+        op.add_column(table, sa.Column('hedge_claim_time', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    for table in ['jobs', 'archived_jobs']:
+        op.drop_column(table, 'hedge_claim_time')
+        op.drop_column(table, 'hedge_verification_code')
@@ -1,14 +1,40 @@
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+import json
+from operator import itemgetter
+import random
+import time
 from util import partial
 
-from flask_sqlalchemy import SQLAlchemy
 import requests
-from sqlalchemy import and_, or_
+from flask import current_app
+from sqlalchemy import and_, func, or_
+from sqlalchemy.sql.visitors import replacement_traverse
 
+import cache_bus
 import constants
+import metrics
+import replica
 import util
 
-db = SQLAlchemy()
+db = replica.RoutingSQLAlchemy()
+
+# Runtime estimates for scheduling are based on this many recent finished jobs, and recomputed after this many seconds.
+RUNTIME_SAMPLE_SIZE = 100
+RUNTIME_ESTIMATE_TTL = 300
+
+# Most events returned by one Event.list_details call, and how long it waits for a gap in the sequence to be filled.
+EVENTS_LIMIT = 1000
+EVENT_GAP_TIMEOUT = timedelta(seconds=10)
+
+# Started jobs that were claimed longer ago than this are considered abandoned and can be claimed again.
+CLAIM_TIMEOUT = timedelta(minutes=5)
+
+SUBMISSION_DETAIL_ATTRS = ['id', 'uid', 'gid', 'time', 'problem_id', 'code', 'language']
+JOB_DETAIL_ATTRS = ['id', 'submission_id', 'creation_time', 'status', 'claim_time', 'completion_time', 'last_ran_case',
+                    'execution_time', 'execution_memory', 'verdict', 'version']
+PROBLEM_VERSION_ATTRS = ['test_cases', 'time_limit', 'memory_limit', 'generator_code', 'generator_language',
+                         'grader_code', 'grader_language', 'source_verifier_code', 'source_verifier_language']
+JOB_VERDICT_ATTRS = ['status', 'completion_time', 'last_ran_case', 'execution_time', 'execution_memory', 'verdict']
 
 
 class APIKey(db.Model):
@@ -48,10 +74,79 @@ class Problem(db.Model):
     grader_language = db.Column(db.Unicode(length=10), nullable=False)
     source_verifier_code = db.Column(db.UnicodeText)
     source_verifier_language = db.Column(db.Unicode(length=10))
+    supersede_policy = db.Column(db.Enum(constants.SupersedePolicy))  # None to use SUPERSEDE_POLICY
+    # Submissions per minute and burst per contestant, None to use the defaults, see ratelimit.py.
+    submission_rate = db.Column(db.Float)
+    submission_burst = db.Column(db.Integer)
+
+    @classmethod
+    def query_details(cls):
+        return db.session.query(*cls.__table__.columns)
+
+    def generate_details(self):
+        return serialize_problem(self)
+
+    # Identifies the test data the generator produces; it changes whenever the generator or the test case count does.
+    def generator_hash(self):
+        return util.hash_code('{}\0{}\0{}'.format(self.generator_language, self.test_cases, self.generator_code))
+
+    @staticmethod
+    def get_version_id(problem_id):
+        return problem_version_ids.get_or_load(problem_id, lambda: db.session.query(func.max(ProblemVersion.id))
+                                               .filter(ProblemVersion.problem_id == problem_id).scalar())
+
+    @staticmethod
+    def invalidate_cache(problem_id):
+        cache_bus.invalidate('problem_version_ids', problem_id)
+
+
+# An immutable snapshot of a problem, taken whenever it is created or modified. Jobs are judged against the version
+# that was current when they were created.
+class ProblemVersion(db.Model):
+    __tablename__ = 'problem_versions'
+    id = db.Column(db.Integer, primary_key=True)
+    problem_id = db.Column(db.Integer, db.ForeignKey('problems.id'), nullable=False, index=True)
+    problem = db.relationship('Problem')
+    creation_time = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    test_cases = db.Column(db.Integer, nullable=False)
+    time_limit = db.Column(db.Float, nullable=False)
+    memory_limit = db.Column(db.Integer, nullable=False)  # KB
+    generator_code = db.Column(db.UnicodeText, nullable=False)
+    generator_language = db.Column(db.Unicode(length=10), nullable=False)
+    grader_code = db.Column(db.UnicodeText, nullable=False)
+    grader_language = db.Column(db.Unicode(length=10), nullable=False)
+    source_verifier_code = db.Column(db.UnicodeText)
+    source_verifier_language = db.Column(db.Unicode(length=10))
+
+    generator_hash = Problem.generator_hash
+
+    # The generator hashes of every version of the problem; jobs pinned to an old version still use its test data.
+    @staticmethod
+    def generator_hashes(problem_id):
+        return {ProblemVersion.generator_hash(version) for version in db.session.query(
+            ProblemVersion.generator_language, ProblemVersion.test_cases, ProblemVersion.generator_code)
+            .filter(ProblemVersion.problem_id == problem_id).distinct()}
+
+    @classmethod
+    def create(cls, problem):
+        version = cls(problem=problem, **{attr: getattr(problem, attr) for attr in PROBLEM_VERSION_ATTRS})
+        db.session.add(version)
+        return version
+
+    @classmethod
+    def query_details(cls):
+        return db.session.query(*cls.__table__.columns)
+
+    # Versions never change, so these are cached without invalidation.
+    @staticmethod
+    def get_limits(version_id):
+        return problem_version_limits.get_or_load(version_id, lambda: db.session.query(
+            ProblemVersion.test_cases, ProblemVersion.time_limit).filter(ProblemVersion.id == version_id).one())
 
 
 class Submission(db.Model):
     __tablename__ = 'submissions'
+    __table_args__ = (db.Index('ix_submissions_problem_id_uid', 'problem_id', 'uid'),)
     id = db.Column(db.Integer, primary_key=True)
     uid = db.Column(db.Integer)
     gid = db.Column(db.Integer)
@@ -91,8 +186,20 @@ class Submission(db.Model):
     def last_job(self):
         return self.jobs[-1]
 
+    @classmethod
+    def query_details(cls):
+        return db.session.query(*[getattr(cls, attr) for attr in SUBMISSION_DETAIL_ATTRS])
+
+    # Same as generate_details on every matching submission, archived ones included, but works on column tuples and
+    # fetches the jobs of all submissions in a single query instead of hydrating ORM objects.
+    @classmethod
+    def list_details(cls, *criteria, return_jobs=True):
+        submissions = _list_submission_details(cls.__table__, Job.__table__, criteria, return_jobs) + \
+            _list_submission_details(archived_submissions, archived_jobs, to_archive(criteria), return_jobs)
+        return sorted(submissions, key=itemgetter('id'))
+
     def generate_details(self, return_jobs=True):
-        submission_details = util.get_attrs(self, ['id', 'uid', 'gid', 'time', 'problem_id', 'code', 'language'])
+        submission_details = serialize_submission(self)
         if return_jobs:
             submission_details['jobs'] = [job.generate_details() for job in self.jobs]
         return submission_details
@@ -105,7 +212,8 @@ class Job(db.Model):
     submission = db.relationship('Submission', backref=db.backref('jobs',
                                                                   lazy='joined', order_by='Job.creation_time.asc()'))
     creation_time = db.Column(db.DateTime, index=True)
-    status = db.Column(db.Enum(constants.JobStatus), nullable=False)
+    # Indexed for counting queued jobs on every submission when MAX_QUEUED_JOBS is set.
+    status = db.Column(db.Enum(constants.JobStatus), nullable=False, index=True)
     claim_time = db.Column(db.DateTime, index=True)
     completion_time = db.Column(db.DateTime, index=True)
 
@@ -119,6 +227,18 @@ class Job(db.Model):
 
     callback_url = db.Column(db.UnicodeText)
 
+    # Incremented by every state transition.
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    problem_version_id = db.Column(db.Integer, db.ForeignKey('problem_versions.id'))
+    problem_version = db.relationship('ProblemVersion')
+
+    # Queued jobs with the lowest schedule_key are claimed first, see calculate_schedule_key.
+    schedule_key = db.Column(db.Float, index=True)
+
+    # A second claim on a straggling job, see claim_hedge.
+    hedge_verification_code = db.Column(db.Integer)
+    hedge_claim_time = db.Column(db.DateTime)
+
     @classmethod
     def create(cls, submission, creation_time=None, status=constants.JobStatus.queued, callback_url=None, commit=True):
         if creation_time is None:
@@ -130,11 +250,43 @@ class Job(db.Model):
 
             callback_url=callback_url,
         )
+        problem = submission.problem
+        weight = current_app.config['SCHEDULING_COST_WEIGHT']
+        runtime = Job.estimate_runtime(problem, submission.language) if weight and problem.id is not None else 0
+        new_job.schedule_key = Job.calculate_schedule_key(creation_time, runtime, weight)
+        problem_version_id = Problem.get_version_id(problem.id) if problem.id is not None else None
+        if problem_version_id is None:
+            # Problems created without going through the API have no version yet.
+            new_job.problem_version = ProblemVersion.create(problem)
+        else:
+            new_job.problem_version_id = problem_version_id
         db.session.add(new_job)
         if commit:
             db.session.commit()
         return new_job
 
+    @classmethod
+    def query_details(cls):
+        return db.session.query(*[getattr(cls, attr) for attr in JOB_DETAIL_ATTRS])
+
+    @staticmethod
+    def query_archived_details():
+        return db.session.query(*[archived_jobs.c[attr] for attr in JOB_DETAIL_ATTRS])
+
+    # Serialized jobs, archived ones included, matching criteria on the columns of Job and Submission.
+    @classmethod
+    def list_details(cls, *criteria):
+        jobs = []
+        for jobs_table, submissions_table, table_criteria in [(cls.__table__, Submission.__table__, criteria),
+                                                              (archived_jobs, archived_submissions,
+                                                               to_archive(criteria))]:
+            query = db.session.query(*[jobs_table.c[attr] for attr in JOB_DETAIL_ATTRS])
+            if criteria:
+                query = query.join(submissions_table, jobs_table.c.submission_id == submissions_table.c.id) \
+                    .filter(*table_criteria)
+            jobs.extend(serialize_job(row) for row in query)
+        return sorted(jobs, key=itemgetter('id'))
+
     @property
     def is_started(self):
         return self.status == constants.JobStatus.started or self.status == constants.JobStatus.finished
@@ -146,28 +298,139 @@ class Job(db.Model):
                 Job.status == constants.JobStatus.queued,
                 and_(
                     Job.status == constants.JobStatus.started,
-                    Job.claim_time < datetime.utcnow() - timedelta(minutes=5)
+                    Job.claim_time < datetime.utcnow() - CLAIM_TIMEOUT,
+                    or_(Job.hedge_claim_time.is_(None), Job.hedge_claim_time < datetime.utcnow() - CLAIM_TIMEOUT),
                 )
             )
         )
 
+    @staticmethod
+    def claim_order():
+        return Job.schedule_key.asc(), Job.id.asc()
+
+    # Jobs are claimed as if they were created weight seconds later for every second they are expected to run, so short
+    # jobs overtake long ones, but only by so much: no job waits more than weight times its expected runtime longer
+    # than it would in first come, first served order. A weight of 0 is first come, first served.
+    @staticmethod
+    def calculate_schedule_key(creation_time, runtime, weight):
+        return creation_time.replace(tzinfo=timezone.utc).timestamp() + weight * runtime
+
+    # Expected seconds for a jury to run a job for the problem in language: its test cases times the mean time of the
+    # slowest case in recent finished jobs for the problem and language, or its time limit before there are any.
+    @staticmethod
+    def estimate_runtime(problem, language):
+        key = (problem.id, language)
+        cached = runtime_estimates.get(key)
+        if cached is None or time.monotonic() - cached[1] > RUNTIME_ESTIMATE_TTL:
+            recent = db.session.query(Job.execution_time).join(Job.submission).filter(
+                Submission.problem_id == problem.id,
+                Submission.language == language,
+                Job.status == constants.JobStatus.finished,
+                Job.execution_time.isnot(None),
+            ).order_by(Job.id.desc()).limit(RUNTIME_SAMPLE_SIZE).subquery()
+            cached = (db.session.query(func.avg(recent.c.execution_time)).scalar(), time.monotonic())
+            runtime_estimates.set(key, cached)
+        case_time = problem.time_limit if cached[0] is None else min(cached[0], problem.time_limit)
+        return problem.test_cases * case_time
+
+    # Cancels or deprioritizes the queued jobs of the contestant's earlier submissions to the problem, without
+    # committing, so that it happens in the same transaction as the new submission. Returns the affected job ids.
+    # Deprioritized jobs are claimed as if they were created SUPERSEDE_DELAY seconds later, so they still age to the
+    # front of the queue instead of waiting behind every job created after them.
+    @classmethod
+    def supersede(cls, problem_id, uid, gid, policy):
+        if policy == constants.SupersedePolicy.none or (uid is None and gid is None):
+            return []
+        job_ids = [job_id for job_id, in db.session.query(cls.id).join(cls.submission).filter(
+            Submission.problem_id == problem_id,
+            Submission.uid == uid,
+            Submission.gid == gid,
+            cls.status == constants.JobStatus.queued,
+        ).with_for_update()]
+        if not job_ids:
+            return []
+        if policy == constants.SupersedePolicy.cancel:
+            values = {'status': constants.JobStatus.cancelled}
+        else:
+            values = {'schedule_key': cls.schedule_key + current_app.config['SUPERSEDE_DELAY']}
+        cls.query.filter(cls.id.in_(job_ids), cls.status == constants.JobStatus.queued) \
+            .update(dict(values, version=cls.version + 1), synchronize_session=False)
+        return job_ids
+
+    @staticmethod
+    def generate_claim_values():
+        return {
+            'status': constants.JobStatus.started,
+            'claim_time': datetime.utcnow(),
+            'verification_code': random.randint(1, 1000000000),
+            'hedge_verification_code': None,
+            'hedge_claim_time': None,
+            'version': Job.version + 1,
+        }
+
+    # Applies values to the job in a single conditional UPDATE, provided that it is in one of statuses and, if given,
+    # that verification_code matches (the hedge's verification code if hedge is set). Returns whether the job was
+    # updated; on a conflict nothing is written.
+    @classmethod
+    def transition(cls, job_id, values, statuses, verification_code=None, hedge=False):
+        query = cls.query.filter(cls.id == job_id, cls.status.in_(statuses))
+        if hedge:
+            query = query.filter(cls.hedge_verification_code == verification_code)
+        elif verification_code is not None:
+            query = query.filter(or_(cls.verification_code == verification_code, cls.verification_code.is_(None)))
+        values = dict(values, version=cls.version + 1)
+        return query.update(values, synchronize_session=False) == 1
+
+    # Hands a running job that has taken longer than its time limit on every test case plus margin seconds to a second
+    # jury, while the first one keeps running it. Whichever reports a verdict first wins. Returns the job's claim
+    # details for the second jury, with the hedge's verification code, or None if no job is straggling.
+    @classmethod
+    def claim_hedge(cls, margin):
+        now = datetime.utcnow()
+        running = [constants.JobStatus.started, constants.JobStatus.awaiting_verdict]
+        candidates = db.session.query(cls.id, cls.claim_time, ProblemVersion.test_cases, ProblemVersion.time_limit) \
+            .join(cls.problem_version).filter(
+                cls.status.in_(running),
+                cls.hedge_verification_code.is_(None),
+                cls.claim_time < now - timedelta(seconds=margin),
+            ).order_by(cls.claim_time)
+        for job_id, claim_time, test_cases, time_limit in candidates:
+            if claim_time + timedelta(seconds=test_cases * time_limit + margin) > now:
+                continue
+            values = {
+                'hedge_verification_code': random.randint(1, 1000000000),
+                'hedge_claim_time': now,
+                'version': cls.version + 1,
+            }
+            updated = cls.query.filter(cls.id == job_id, cls.status.in_(running), cls.hedge_verification_code.is_(None),
+                                       cls.claim_time == claim_time).update(values, synchronize_session=False)
+            if updated:
+                job = cls.query.populate_existing().get(job_id)
+                return dict(job.generate_claim_details(), verification_code=job.hedge_verification_code, hedge=True)
+        return None
+
+    @staticmethod
+    def get_problem_version_id(job_id):
+        return job_problem_version_ids.get_or_load(job_id, lambda: db.session.query(Job.problem_version_id)
+                                                   .filter(Job.id == job_id).scalar())
+
     def generate_details(self):
-        return util.get_attrs(self, ['id', 'submission_id', 'creation_time', 'status', 'claim_time', 'completion_time',
-                                     'last_ran_case', 'execution_time', 'execution_memory', 'verdict'],
-                              include_none=False)
+        return serialize_job(self)
 
     def generate_claim_details(self):
         return {
             'id': self.id,
-            'problem_id': self.submission.problem.id,
+            'problem_id': self.submission.problem_id,
+            'problem_version_id': self.problem_version_id,
+            'generator_hash': self.problem_version.generator_hash(),
             'verification_code': self.verification_code,
             'code': self.submission.code,
+            'code_hash': util.hash_code(self.submission.code),
             'language': self.submission.language,
         }
 
     def generate_verdict_details(self):
-        return util.get_attrs(self, ['status', 'completion_time', 'last_ran_case', 'execution_time', 'execution_memory',
-                                     'verdict'], include_none=False)
+        return serialize_job_verdict(self)
 
     def calculate_status_display(self):
         if self.status == constants.JobStatus.started:
@@ -178,4 +441,128 @@ class Job(db.Model):
 
     # This should be called asynchronously.
     def fire_callback(self):
-        requests.post(self.callback_url, self.generate_details(), timeout=2)
+        try:
+            response = requests.post(self.callback_url, util.get_attrs(self, JOB_DETAIL_ATTRS, include_none=False),
+                                     timeout=2)
+            response.raise_for_status()
+        except requests.RequestException:
+            metrics.CALLBACKS.labels(result='failure').inc()
+            raise
+        metrics.CALLBACKS.labels(result='success').inc()
+
+
+# Append-only log of job and submission changes, which clients can resume reading from the last sequence number (id)
+# they have seen. See GET /events.
+class Event(db.Model):
+    __tablename__ = 'events'
+    id = db.Column(db.Integer, primary_key=True)
+    time = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+    name = db.Column(db.Unicode(length=32), nullable=False)  # as emitted over Socket.IO
+    job_id = db.Column(db.Integer)
+    submission_id = db.Column(db.Integer)
+    data = db.Column(db.UnicodeText)  # JSON
+
+    # Adds an event without committing, so that it commits together with the change it describes, and returns its
+    # sequence number.
+    @classmethod
+    def record(cls, name, job_id=None, submission_id=None, data=None):
+        result = db.session.execute(cls.__table__.insert().values(
+            name=name, job_id=job_id, submission_id=submission_id, data=None if data is None else json.dumps(data)))
+        return result.inserted_primary_key[0]
+
+    # Events after the sequence number since, oldest first.
+    #
+    # Sequence numbers are handed out when events are written but become visible when they commit, which need not be
+    # in the same order. The list stops short of a gap in the sequence numbers until the event after the gap is
+    # EVENT_GAP_TIMEOUT old, so that a client never resumes past an event that is still being committed. Gaps left by
+    # rolled back transactions are skipped once they are that old.
+    @classmethod
+    def list_details(cls, since, limit=None):
+        settled = datetime.utcnow() - EVENT_GAP_TIMEOUT
+        events = []
+        for event in cls.query.filter(cls.id > since).order_by(cls.id).limit(limit or EVENTS_LIMIT):
+            if event.id != since + 1 and event.time > settled:
+                break
+            since = event.id
+            events.append(serialize_event(event))
+        return events
+
+
+# The response to a request that created something, by the Idempotency-Key header it was sent with; see idempotency.py.
+class IdempotencyKey(db.Model):
+    __tablename__ = 'idempotency_keys'
+    __table_args__ = (db.Index('ix_idempotency_keys_api_key_id_key', 'api_key_id', 'key', unique=True),)
+    id = db.Column(db.Integer, primary_key=True)
+    api_key_id = db.Column(db.Integer, db.ForeignKey('apikeys.id'), nullable=False)
+    key = db.Column(db.String(length=64), nullable=False)
+    creation_time = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+    path = db.Column(db.Unicode(length=256), nullable=False)
+    request_hash = db.Column(db.String(length=64), nullable=False)  # of the form data
+    status = db.Column(db.Integer, nullable=False)
+    response = db.Column(db.UnicodeText)  # JSON
+
+
+def _list_submission_details(submissions_table, jobs_table, criteria, return_jobs):
+    submissions = [serialize_submission(row) for row in db.session.query(
+        *[submissions_table.c[attr] for attr in SUBMISSION_DETAIL_ATTRS]).filter(*criteria)]
+    if return_jobs and submissions:
+        jobs_by_submission = {}
+        for submission in submissions:
+            submission['jobs'] = jobs_by_submission[submission['id']] = []
+        jobs = db.session.query(*[jobs_table.c[attr] for attr in JOB_DETAIL_ATTRS]) \
+            .join(submissions_table, jobs_table.c.submission_id == submissions_table.c.id).filter(*criteria) \
+            .order_by(jobs_table.c.creation_time.asc(), jobs_table.c.id.asc())
+        for job in jobs:
+            jobs_by_submission[job.submission_id].append(serialize_job(job))
+    return submissions
+
+
+# Finished and cancelled jobs and their submissions are moved here once they are old, see archive.py. The columns are
+# the same, without foreign keys and with only the indexes that the read endpoints need.
+def archive_table(table, name, *indexes):
+    columns = [db.Column(column.name, column.type.copy(), primary_key=column.primary_key, autoincrement=False,
+                         nullable=column.nullable) for column in table.columns]
+    return db.Table(name, db.metadata, *columns, *indexes)
+
+
+archived_submissions = archive_table(Submission.__table__, 'archived_submissions',
+                                     db.Index('ix_archived_submissions_problem_id_uid', 'problem_id', 'uid'),
+                                     db.Index('ix_archived_submissions_uid', 'uid'),
+                                     db.Index('ix_archived_submissions_gid', 'gid'))
+archived_jobs = archive_table(Job.__table__, 'archived_jobs',
+                              db.Index('ix_archived_jobs_submission_id', 'submission_id'))
+ARCHIVE_TABLES = {Submission.__table__: archived_submissions, Job.__table__: archived_jobs}
+
+
+# Rewrites criteria on Submission and Job columns to the same criteria on the archive tables.
+def to_archive(criteria):
+    def replace(element):
+        table = getattr(element, 'table', None)
+        if isinstance(element, db.Column) and table in ARCHIVE_TABLES:
+            return ARCHIVE_TABLES[table].c[element.name]
+        return None
+
+    return [replacement_traverse(criterion, {}, replace) for criterion in criteria]
+
+
+# Per-process caches. A job's problem version and a version's limits never change; a problem's current version is
+# invalidated in every process when the problem is modified.
+job_problem_version_ids = util.LRUCache(maxsize=65536)
+problem_version_limits = util.LRUCache()
+runtime_estimates = util.LRUCache()  # (problem id, language) -> (mean case time or None, time.monotonic())
+problem_version_ids = cache_bus.register('problem_version_ids', util.LRUCache())
+
+# These accept ORM instances as well as the column tuples returned by the query_details queries.
+serialize_problem = util.compile_serializer(Problem)
+serialize_problem_version = util.compile_serializer(ProblemVersion)
+serialize_submission = util.compile_serializer(Submission, SUBMISSION_DETAIL_ATTRS)
+serialize_job = util.compile_serializer(Job, JOB_DETAIL_ATTRS, include_none=False)
+serialize_job_verdict = util.compile_serializer(Job, JOB_VERDICT_ATTRS, include_none=False)
+_serialize_event = util.compile_serializer(Event, include_none=False)
+
+
+def serialize_event(event):
+    details = _serialize_event(event)
+    if 'data' in details:
+        details['data'] = json.loads(details['data'])
+    return details
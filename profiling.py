@@ -0,0 +1,79 @@
+"""
+Opt-in request profiling and slow query logging.
+
+A request is profiled with cProfile when it is picked by PROFILE_SAMPLE_RATE or when it carries an X-Profile header
+along with a master API key. The profile covers the whole of api_view, including permission checks and JSON encoding,
+and is written to PROFILE_DIR in pstats format; the file name is returned in the X-Profile-Id response header.
+
+Queries slower than SLOW_QUERY_THRESHOLD seconds are logged together with the database's query plan.
+"""
+
+import cProfile
+import os
+import random
+import time
+
+from flask import current_app, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import metrics
+from models import APIKey, db
+
+EXPLAIN_PREFIXES = {
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+}
+
+
+def _requested_by_master():
+    if not request.headers.get('X-Profile') or 'api_key' not in request.headers:
+        return False
+    return db.session.query(
+        APIKey.query.filter_by(key=request.headers['api_key'], active=True, perm_master=True).exists()
+    ).scalar()
+
+
+def start_request_profile():
+    sample_rate = current_app.config['PROFILE_SAMPLE_RATE']
+    if not (sample_rate and random.random() < sample_rate) and not _requested_by_master():
+        return None
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def finish_request_profile(profiler):
+    profiler.disable()
+    profile_dir = current_app.config['PROFILE_DIR']
+    os.makedirs(profile_dir, exist_ok=True)
+    profile_id = '{}-{}-{}.prof'.format(int(time.time() * 1000), request.endpoint or 'none', os.getpid())
+    profiler.dump_stats(os.path.join(profile_dir, profile_id))
+    return profile_id
+
+
+def _explain(conn, cursor, statement, parameters):
+    prefix = EXPLAIN_PREFIXES.get(conn.dialect.name, 'EXPLAIN ')
+    explain_cursor = cursor.connection.cursor()
+    try:
+        explain_cursor.execute(prefix + statement, parameters)
+        return '\n'.join(' | '.join(str(column) for column in row) for row in explain_cursor.fetchall())
+    except Exception as e:
+        return 'EXPLAIN failed: {}'.format(e)
+    finally:
+        explain_cursor.close()
+
+
+# Timed by metrics.py.
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is None or not hasattr(context, 'query_start_time') or not has_app_context():
+        return
+    elapsed = metrics.query_elapsed(context)
+    threshold = current_app.config['SLOW_QUERY_THRESHOLD']
+    if not threshold or elapsed < threshold:
+        return
+
+    plan = None
+    if not executemany and statement.lstrip().upper().startswith('SELECT'):
+        plan = _explain(conn, cursor, statement, parameters)
+    current_app.logger.warning('Slow query ({:.3f}s): {} {!r}\n{}'.format(elapsed, statement, parameters, plan or ''))
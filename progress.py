@@ -0,0 +1,114 @@
+"""
+Write-behind buffer for the progress of running jobs.
+
+Juries report progress after every test case. When Redis is configured and PROGRESS_FLUSH_INTERVAL is positive, the
+latest report for a running job is kept in a Redis hash instead of being written to the jobs table each time. A report
+is written through to SQL when the job's last flush is older than PROGRESS_FLUSH_INTERVAL. Only last_ran_case and the
+execution time and memory are buffered: status changes (to awaiting a verdict, and the verdict) are always written to
+SQL directly and logged as events. Job reads overlay the buffered progress on the row, so clients see every update, and
+Socket.IO subscribers are notified of every report as before.
+
+A buffer is created when a job is claimed, holding the claim's verification code so that reports can be checked
+without touching SQL, and is dropped when the job is released, cancelled or finished.
+
+Crash safety: claims, releases, cancellations and verdicts are always committed to SQL before the buffer is touched,
+so only intermediate progress is ever at risk. A judge worker crashing loses nothing, since the buffer lives in Redis.
+If Redis loses the buffer, at most PROGRESS_FLUSH_INTERVAL seconds of intermediate progress are lost; the jury's next
+report finds no buffer, is written to SQL and recreates it. Buffers of abandoned jobs expire on their own.
+
+Buffered reports are checked against Redis only, so a report that races a cancellation (between its commit and the
+buffer being dropped, or when dropping it failed) is accepted with 200 rather than rejected with 409; the jury learns
+of the cancellation from a later report or the job_cancelled event. That is why the buffer is off by default.
+"""
+
+import time
+
+from flask import current_app
+
+import constants
+import redis_store
+from models import CLAIM_TIMEOUT
+
+KEY = 'judge:progress:{}'
+FIELDS = ['last_ran_case', 'execution_time', 'execution_memory']
+TTL = int(CLAIM_TIMEOUT.total_seconds() * 2)
+
+RUNNING_STATUSES = [constants.JobStatus.started.value, constants.JobStatus.awaiting_verdict.value]
+
+# Results of record()
+NOT_BUFFERED = 'not_buffered'
+REJECTED = 'rejected'
+BUFFERED = 'buffered'
+FLUSH_DUE = 'flush_due'
+
+
+def enabled():
+    return redis_store.get_redis() is not None and current_app.config['PROGRESS_FLUSH_INTERVAL'] > 0
+
+
+def start(job_id, verification_code):
+    if not enabled():
+        return
+    key = KEY.format(job_id)
+    pipeline = redis_store.get_redis().pipeline()
+    pipeline.delete(key)
+    pipeline.hset(key, mapping={'verification_code': verification_code, 'flushed_at': time.time()})
+    pipeline.expire(key, TTL)
+    pipeline.execute()
+
+
+def discard(job_id):
+    if enabled():
+        redis_store.get_redis().delete(KEY.format(job_id))
+
+
+def record(job_id, verification_code, values):
+    key = KEY.format(job_id)
+    interval = current_app.config['PROGRESS_FLUSH_INTERVAL']
+
+    def update(pipeline):
+        buffered = pipeline.hgetall(key)
+        if not buffered:
+            return NOT_BUFFERED
+        if int(buffered[b'verification_code']) != verification_code:
+            return REJECTED
+
+        now = time.time()
+        flush_due = now - float(buffered[b'flushed_at']) >= interval
+        mapping = {field: values[field] for field in FIELDS}
+        if flush_due:
+            mapping['flushed_at'] = now
+        pipeline.multi()
+        pipeline.hset(key, mapping=mapping)
+        pipeline.expire(key, TTL)
+        return FLUSH_DUE if flush_due else BUFFERED
+
+    return redis_store.get_redis().transaction(update, key, value_from_callable=True)
+
+
+def _decode(buffered):
+    last_ran_case, execution_time, execution_memory = buffered
+    return {
+        'last_ran_case': int(last_ran_case),
+        'execution_time': float(execution_time),
+        'execution_memory': int(execution_memory),
+    }
+
+
+# Updates serialized job details in place with buffered progress.
+def overlay(jobs):
+    running = [job for job in jobs if job.get('status') in RUNNING_STATUSES]
+    if not running or not enabled():
+        return jobs
+    pipeline = redis_store.get_redis().pipeline(transaction=False)
+    for job in running:
+        pipeline.hmget(KEY.format(job['id']), FIELDS)
+    for job, buffered in zip(running, pipeline.execute()):
+        if buffered[0] is not None:
+            job.update(_decode(buffered))
+    return jobs
+
+
+def overlay_submissions(submissions):
+    overlay([job for submission in submissions for job in submission.get('jobs', [])])
+    return submissions
@@ -0,0 +1,196 @@
+"""
+Job queue backends, selected with QUEUE_BACKEND.
+
+The jobs table is always the system of record for job state; a backend only decides which job a claiming jury gets.
+
+- SQLQueue ('sql') locks the first claimable row in Job.claim_order with SELECT ... FOR UPDATE.
+- RedisStreamQueue ('redis') hands out job ids from a consumer group on a Redis stream, so claims take no row locks.
+  The claimed row is switched to started with one conditional UPDATE, which also weeds out entries whose job was
+  cancelled while queued. Entries stay in the group's pending list until the job is finished or cancelled; pending
+  entries idle for longer than CLAIM_TIMEOUT are handed out again, matching Job.query_can_claim. Released jobs keep
+  their place in line, and deprioritized ones are moved to the back of the stream. Jobs are handed out in the order
+  they were enqueued, so Job.claim_order (and with it SCHEDULING_COST_WEIGHT) only applies when the stream is rebuilt.
+
+If the stream disappears, e.g. after a Redis restart, the next claim rebuilds it from Job.query_can_claim. Whenever the
+stream runs dry, claimable jobs that have no stream entry (because Redis was unreachable when they were created, or
+because they were running during a rebuild and have since timed out) are swept back in.
+"""
+
+from collections import namedtuple
+
+import redis
+from flask import current_app
+from sqlalchemy import func
+
+import constants
+import redis_store
+from models import CLAIM_TIMEOUT, db, Job
+
+ClaimedJob = namedtuple('ClaimedJob', ['id', 'creation_time', 'claim_time', 'details'])
+
+
+def init_app(app):
+    backends = {
+        'sql': SQLQueue,
+        'redis': RedisStreamQueue,
+    }
+    app.extensions['job_queue'] = backends[app.config['QUEUE_BACKEND']]()
+
+
+def get_queue():
+    return current_app.extensions['job_queue']
+
+
+class SQLQueue:
+    def enqueue(self, job_id):
+        pass
+
+    def claim(self, consumer):
+        job = Job.query_can_claim().with_for_update().order_by(*Job.claim_order()).first()
+        if job is None:
+            return None
+        for attr, value in Job.generate_claim_values().items():
+            setattr(job, attr, value)
+        return ClaimedJob(job.id, job.creation_time, job.claim_time, job.generate_claim_details())
+
+    def release(self, job_id):
+        pass
+
+    # Number of jobs waiting to be claimed.
+    def depth(self):
+        return db.session.query(func.count(Job.id)).filter(Job.status == constants.JobStatus.queued).scalar()
+
+    def deprioritize(self, job_id):
+        pass
+
+    def remove(self, job_id):
+        pass
+
+    def rebuild(self):
+        pass
+
+
+class RedisStreamQueue:
+    STREAM = 'judge:jobs'
+    GROUP = 'juries'
+    ENTRIES = 'judge:jobs:entries'  # job id -> stream entry id
+    RELEASED = 'judge:jobs:released'
+    REBUILD_LOCK = 'judge:jobs:rebuild'
+    SWEEP_LOCK = 'judge:jobs:sweep'
+
+    SWEEP_INTERVAL = 10  # seconds
+    SWEEP_BATCH = 500
+
+    @property
+    def redis(self):
+        return redis_store.get_redis()
+
+    def enqueue(self, job_id):
+        # Without a stream there is no consumer group either; the job is picked up when the next claim rebuilds both.
+        entry_id = self.redis.xadd(self.STREAM, {'job_id': job_id}, nomkstream=True)
+        if entry_id is not None:
+            self.redis.hset(self.ENTRIES, job_id, entry_id)
+
+    def claim(self, consumer):
+        if not self.redis.exists(self.STREAM):
+            self.rebuild()
+            if not self.redis.exists(self.STREAM):
+                return None
+
+        while True:
+            entry = self._next_entry(consumer)
+            if entry is None:
+                if self._sweep():
+                    continue
+                return None
+
+            entry_id, job_id = entry
+            claim_values = Job.generate_claim_values()
+            updated = Job.query_can_claim().filter(Job.id == job_id).update(claim_values, synchronize_session=False)
+            if updated:
+                job = Job.query.populate_existing().get(job_id)
+                return ClaimedJob(job.id, job.creation_time, job.claim_time, job.generate_claim_details())
+
+            status = db.session.query(Job.status).filter(Job.id == job_id).scalar()
+            if status in (None, constants.JobStatus.cancelled, constants.JobStatus.finished):
+                self._delete(job_id, entry_id)
+
+    def release(self, job_id):
+        self.redis.rpush(self.RELEASED, job_id)
+
+    # Entries not handed out to a jury yet, plus released ones.
+    def depth(self):
+        pipeline = self.redis.pipeline(transaction=False)
+        pipeline.hlen(self.ENTRIES)
+        pipeline.xpending(self.STREAM, self.GROUP)
+        pipeline.llen(self.RELEASED)
+        try:
+            entries, pending, released = pipeline.execute()
+        except redis.ResponseError:  # no stream yet
+            return 0
+        return entries - pending['pending'] + released
+
+    # Moves the job to the back of the stream.
+    def deprioritize(self, job_id):
+        self.remove(job_id)
+        self.enqueue(job_id)
+
+    def remove(self, job_id):
+        entry_id = self.redis.hget(self.ENTRIES, job_id)
+        if entry_id is not None:
+            self._delete(job_id, entry_id)
+
+    def rebuild(self):
+        if not self.redis.set(self.REBUILD_LOCK, 1, nx=True, ex=60):
+            return
+        try:
+            self.redis.delete(self.STREAM, self.ENTRIES, self.RELEASED)
+            self.redis.xgroup_create(self.STREAM, self.GROUP, id='0', mkstream=True)
+            for job_id, in Job.query_can_claim().order_by(*Job.claim_order()).with_entities(Job.id):
+                self.enqueue(job_id)
+        finally:
+            self.redis.delete(self.REBUILD_LOCK)
+
+    def _next_entry(self, consumer):
+        job_id = self.redis.lpop(self.RELEASED)
+        while job_id is not None:
+            entry_id = self.redis.hget(self.ENTRIES, job_id)
+            if entry_id is not None and self.redis.xclaim(self.STREAM, self.GROUP, consumer, 0, [entry_id]):
+                return entry_id, int(job_id)
+            job_id = self.redis.lpop(self.RELEASED)
+
+        timeout = int(CLAIM_TIMEOUT.total_seconds() * 1000)
+        for pending in self.redis.xpending_range(self.STREAM, self.GROUP, min='-', max='+', count=1, idle=timeout):
+            entries = self.redis.xclaim(self.STREAM, self.GROUP, consumer, timeout, [pending['message_id']])
+            if entries:
+                return self._parse_entry(entries[0])
+
+        for _, entries in self.redis.xreadgroup(self.GROUP, consumer, {self.STREAM: '>'}, count=1):
+            if entries:
+                return self._parse_entry(entries[0])
+        return None
+
+    def _sweep(self):
+        if not self.redis.set(self.SWEEP_LOCK, 1, nx=True, ex=self.SWEEP_INTERVAL):
+            return False
+        job_ids = [job_id for job_id, in Job.query_can_claim().order_by(*Job.claim_order())
+                   .with_entities(Job.id).limit(self.SWEEP_BATCH)]
+        if not job_ids:
+            return False
+        missing = [job_id for job_id, entry_id in zip(job_ids, self.redis.hmget(self.ENTRIES, job_ids))
+                   if entry_id is None]
+        for job_id in missing:
+            self.enqueue(job_id)
+        return bool(missing)
+
+    def _delete(self, job_id, entry_id):
+        pipeline = self.redis.pipeline()
+        pipeline.xack(self.STREAM, self.GROUP, entry_id)
+        pipeline.xdel(self.STREAM, entry_id)
+        pipeline.hdel(self.ENTRIES, job_id)
+        pipeline.execute()
+
+    @staticmethod
+    def _parse_entry(entry):
+        entry_id, fields = entry
+        return entry_id, int(fields[b'job_id'])
@@ -0,0 +1,122 @@
+"""
+Admission control for new jobs: per-contestant and per-API key token buckets, and a limit on the number of queued jobs.
+
+A bucket holds up to burst tokens and refills at rate tokens per minute; every new submission takes one token from the
+bucket of its contestant (uid and gid, as in Job.supersede) and one from the bucket of the API key that created it.
+Problems can override the contestant limits with their submission_rate and submission_burst, and get buckets of their
+own then; a submission_rate of 0 lifts the contestant limit for the problem. Rejected requests get a 429 with
+Retry-After and are counted in judge_submissions_rejected_total.
+
+The buckets are kept in Redis, so that the limits hold across all processes, or per process without Redis.
+"""
+
+import math
+import threading
+import time
+from collections import namedtuple
+
+import redis
+from flask import current_app
+
+import metrics
+import queues
+import redis_store
+import util
+
+KEY = 'judge:ratelimit:{}'
+BUCKET_TTL = 3600  # seconds; a bucket untouched for this long is full again anyway, unless its rate is very low
+QUEUE_FULL_RETRY_AFTER = 10  # seconds
+
+# reason is the label of rejections by this bucket in judge_submissions_rejected_total.
+Bucket = namedtuple('Bucket', ['reason', 'name', 'rate', 'burst'])
+
+local_buckets = util.LRUCache(maxsize=65536)
+local_lock = threading.Lock()
+
+
+# Returns the tokens in a bucket at now, from its stored (tokens, time) state.
+def _refill(state, rate, burst, now):
+    if state is None:
+        return burst
+    tokens, updated = state
+    return min(burst, tokens + (now - updated) * rate / 60)
+
+
+# Takes a token from every bucket, given as Bucket tuples, or from none of them if one is empty. Returns None on
+# success, otherwise the empty bucket that takes the longest to refill and the seconds until it has a token again.
+def take(buckets):
+    now = time.time()
+    redis_client = redis_store.get_redis()
+    if redis_client is None:
+        with local_lock:
+            return _take(buckets, [local_buckets.get(bucket.name) for bucket in buckets], local_buckets.set, now)
+
+    keys = [KEY.format(bucket.name) for bucket in buckets]
+
+    def attempt(pipeline):
+        states = []
+        for key in keys:
+            tokens, updated = pipeline.hmget(key, 'tokens', 'time')
+            states.append(None if tokens is None else (float(tokens), float(updated)))
+        pipeline.multi()
+
+        def store(name, state):
+            key = KEY.format(name)
+            pipeline.hset(key, mapping={'tokens': state[0], 'time': state[1]})
+            pipeline.expire(key, BUCKET_TTL)
+
+        return _take(buckets, states, store, now)
+
+    return redis_client.transaction(attempt, *keys, value_from_callable=True)
+
+
+def _take(buckets, states, store, now):
+    tokens = [_refill(state, bucket.rate, bucket.burst, now) for state, bucket in zip(states, buckets)]
+    empty = [((1 - available) * 60 / bucket.rate, bucket) for available, bucket in zip(tokens, buckets)
+             if available < 1]
+    if empty:
+        retry_after, bucket = max(empty, key=lambda wait: wait[0])
+        return bucket, retry_after
+    for available, bucket in zip(tokens, buckets):
+        store(bucket.name, (available - 1, now))
+    return None
+
+
+def reject(reason, retry_after):
+    metrics.SUBMISSIONS_REJECTED.labels(reason=reason).inc()
+    retry_after = math.ceil(retry_after)
+    return 429, 'Too many submissions, retry in {} seconds.'.format(retry_after), {'Retry-After': str(retry_after)}
+
+
+# Returns None if a new job for problem, from the contestant uid/gid (if any) and api_key, may be created, otherwise the
+# 429 response to reject it with.
+def admit(problem, uid, gid, api_key):
+    config = current_app.config
+    if config['MAX_QUEUED_JOBS'] and queues.get_queue().depth() >= config['MAX_QUEUED_JOBS']:
+        return reject('queue_full', QUEUE_FULL_RETRY_AFTER)
+
+    buckets = []
+    if uid is not None or gid is not None:
+        if problem.submission_rate is not None:
+            buckets.append(Bucket('contestant', 'problem:{}:contestant:{}:{}'.format(problem.id, uid, gid),
+                                  problem.submission_rate,
+                                  problem.submission_burst or config['CONTESTANT_SUBMISSION_BURST']))
+        elif config['CONTESTANT_SUBMISSION_RATE']:
+            buckets.append(Bucket('contestant', 'contestant:{}:{}'.format(uid, gid),
+                                  config['CONTESTANT_SUBMISSION_RATE'], config['CONTESTANT_SUBMISSION_BURST']))
+    if config['API_KEY_SUBMISSION_RATE']:
+        buckets.append(Bucket('api_key', 'api_key:{}'.format(api_key.id), config['API_KEY_SUBMISSION_RATE'],
+                              config['API_KEY_SUBMISSION_BURST']))
+    buckets = [bucket for bucket in buckets if bucket.rate > 0]
+    if not buckets:
+        return None
+
+    try:
+        empty = take(buckets)
+    except redis.RedisError:
+        current_app.logger.warning('Rate limiting failed, admitting the submission', exc_info=True)
+        return None
+    if empty is None:
+        return None
+    bucket, retry_after = empty
+    return reject(bucket.reason, retry_after)
@@ -0,0 +1,16 @@
+"""
+Shared Redis connection for judge state that every worker has to see, such as the job stream.
+
+The client lives in app.extensions and is created from REDIS_URI, so tests can swap in an in-process fake.
+"""
+
+import redis
+from flask import current_app
+
+
+def init_app(app):
+    app.extensions['redis'] = redis.StrictRedis.from_url(app.config['REDIS_URI']) if app.config['REDIS_URI'] else None
+
+
+def get_redis():
+    return current_app.extensions['redis']
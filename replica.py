@@ -0,0 +1,159 @@
+"""
+Routing of read-only database work to a read replica, configured with REPLICA_DATABASE_URI.
+
+SELECTs go to the replica when the code running them has marked itself read-only with use_replica(): the reader views
+decorated with read_only do so for GET requests, and the Socket.IO subscription handlers for their snapshot loads.
+Everything else goes to the primary, including any statement issued after the session flushed a write, the API key
+lookup in require_perms (so that new and revoked keys take effect right away), and every endpoint juries use (so that
+they never miss a problem version or test data that was just written).
+
+The primary is used instead when
+- the replica lags the primary by more than REPLICA_MAX_LAG seconds (checked at most once per
+  REPLICA_LAG_CHECK_INTERVAL seconds per process), or the lag check fails, or
+- the API key making the request wrote something in the last REPLICA_MAX_LAG seconds, so clients read their own
+  writes. Writes are remembered in Redis, or per process without Redis.
+"""
+
+from functools import wraps
+import time
+
+from flask import current_app, g, has_app_context, request
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import create_engine, orm
+from sqlalchemy.sql.selectable import Select
+
+import metrics
+import redis_store
+import util
+
+RECENT_WRITE_KEY = 'judge:recent-write:{}'
+
+LAG_QUERIES = {
+    'postgresql': 'SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+                  'ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END',
+}
+
+
+def init_app(app):
+    uri = app.config['REPLICA_DATABASE_URI']
+    app.extensions['replica'] = Replica(create_engine(uri), app.config) if uri else None
+
+
+class Replica:
+    def __init__(self, engine, config):
+        self.engine = engine
+        self.max_lag = config['REPLICA_MAX_LAG']
+        self.lag_check_interval = config['REPLICA_LAG_CHECK_INTERVAL']
+        self.lag_checked_at = None
+        self.lag_ok = False
+        self.recent_writes = util.LRUCache(maxsize=65536)  # used without Redis
+
+    def measure_lag(self):
+        with self.engine.connect() as conn:
+            if conn.dialect.name == 'mysql':
+                status = conn.execute('SHOW SLAVE STATUS').first()
+                return 0 if status is None else status['Seconds_Behind_Master']
+            if conn.dialect.name in LAG_QUERIES:
+                return conn.execute(LAG_QUERIES[conn.dialect.name]).scalar()
+            return 0
+
+    def is_lag_ok(self):
+        now = time.monotonic()
+        if self.lag_checked_at is None or now - self.lag_checked_at >= self.lag_check_interval:
+            self.lag_checked_at = now
+            try:
+                lag = self.measure_lag()
+            except Exception:
+                current_app.logger.warning('Replica lag check failed', exc_info=True)
+                lag = None
+            self.lag_ok = lag is not None and lag <= self.max_lag
+        return self.lag_ok
+
+    def record_write(self, api_key_id):
+        redis = redis_store.get_redis()
+        if redis is not None:
+            redis.set(RECENT_WRITE_KEY.format(api_key_id), 1, px=int(self.max_lag * 1000))
+        else:
+            self.recent_writes.set(api_key_id, time.monotonic())
+
+    def wrote_recently(self, api_key_id):
+        redis = redis_store.get_redis()
+        if redis is not None:
+            return bool(redis.exists(RECENT_WRITE_KEY.format(api_key_id)))
+        written_at = self.recent_writes.get(api_key_id)
+        return written_at is not None and time.monotonic() - written_at < self.max_lag
+
+
+def get_replica():
+    return current_app.extensions['replica']
+
+
+def use_replica():
+    g.read_only = True
+    g.pop('replica_routing', None)
+
+
+def use_primary():
+    g.read_only = False
+
+
+# Lets a view's GET requests read from the replica. Goes under require_perms, so that the API key is looked up before.
+def read_only(func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if request.method in ('GET', 'HEAD'):
+            use_replica()
+        return func(*args, **kwargs)
+
+    return wrapper
+
+
+# Called after a request that may have written, with the API key that made it. Only keys with the reader permission
+# can make read_only reads, so writes by jury keys, i.e. every claim and progress report, are not recorded.
+def record_write(api_key):
+    replica = get_replica()
+    if replica is not None and api_key is not None and api_key.perm_reader:
+        replica.record_write(api_key.id)
+
+
+# Decided once per request or Socket.IO event, and again once require_perms has identified the API key.
+def _replica_engine():
+    api_key = g.get('api_key')
+    api_key_id = api_key.id if api_key is not None else None
+    routing = g.get('replica_routing')
+    if routing is None or routing[0] != api_key_id:
+        replica = get_replica()
+        engine = None
+        if api_key_id is not None and replica.wrote_recently(api_key_id):
+            metrics.READ_ROUTING.labels(target='primary', reason='recent_write').inc()
+        elif not replica.is_lag_ok():
+            metrics.READ_ROUTING.labels(target='primary', reason='lag').inc()
+        else:
+            metrics.READ_ROUTING.labels(target='replica', reason='read_only').inc()
+            engine = replica.engine
+        g.replica_routing = (api_key_id, engine)
+    return g.replica_routing[1]
+
+
+class RoutingSession(SignallingSession):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wrote = False
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or not isinstance(clause, Select):
+            self.wrote = self.wrote or self._flushing or clause is not None
+        elif not self.wrote and has_app_context() and g.get('read_only') and get_replica() is not None:
+            engine = _replica_engine()
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper, clause)
+
+    def close(self):
+        super().close()
+        self.wrote = False
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
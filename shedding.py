@@ -0,0 +1,96 @@
+"""
+Load shedding that keeps the jury path fast when the judge is overloaded.
+
+Every API request is put in a class by its method and endpoint (see require_perms): jury for the endpoints juries work
+through, master for API key management, writer for the other writes such as submissions, and reader for the other
+reads, in that order of priority. Each class has its own limit of requests running at once in a process (READER_,
+WRITER_ and JURY_CONCURRENCY, 0 for no limit), and requests over it are shed right away with 503 and Retry-After, rather
+than queue up in front of claims and progress reports. The reader limit is meant to be the tight one, so that reads are
+shed before writes. Reader queries also get a statement timeout (READER_STATEMENT_TIMEOUT, on PostgreSQL, MySQL 5.7+
+and MariaDB 10.1+), and a reader request whose query runs out of time is shed the same way.
+
+Shed requests are counted in judge_requests_shed_total.
+"""
+
+import threading
+
+from flask import current_app, g, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import metrics
+
+CLASSES = ['jury', 'master', 'writer', 'reader']  # by priority
+# Endpoints of the blueprint by class, the rest are writer or reader by method. Problem reads are on the jury path.
+ENDPOINTS = {
+    'jury': {'jobs_claim', 'jobs_submit', 'jobs_release', 'artifacts_upload', 'blobs_get', 'problems_list',
+             'problems_get', 'problems_version_get', 'problems_test_data_upload', 'problems_test_data_get'},
+    'master': {'generate_api_key'},
+}
+READ_METHODS = ['GET', 'HEAD', 'OPTIONS']
+RETRY_AFTER = 1  # seconds
+
+running = {request_class: 0 for request_class in CLASSES}
+running_lock = threading.Lock()
+
+
+# The class of a request to endpoint with method.
+def classify(method, endpoint):
+    endpoint = (endpoint or '').rpartition('.')[2]
+    for request_class, endpoints in ENDPOINTS.items():
+        if endpoint in endpoints:
+            return request_class
+    return 'reader' if method in READ_METHODS else 'writer'
+
+
+def limit(request_class):
+    return current_app.config.get('{}_CONCURRENCY'.format(request_class.upper()), 0)
+
+
+# Counts a request of request_class as running, unless its class is at its limit. Returns whether it was admitted.
+def acquire(request_class):
+    with running_lock:
+        if limit(request_class) and running[request_class] >= limit(request_class):
+            return False
+        running[request_class] += 1
+    g.request_class = request_class
+    if request_class == 'reader':
+        g.statement_timeout = current_app.config['READER_STATEMENT_TIMEOUT']
+    return True
+
+
+def release(request_class):
+    with running_lock:
+        running[request_class] -= 1
+    g.statement_timeout = 0
+
+
+# Whether an OperationalError is a query cancelled by the statement timeout (query_canceled on PostgreSQL,
+# ER_QUERY_TIMEOUT on MySQL, ER_STATEMENT_TIMEOUT on MariaDB).
+def is_statement_timeout(error):
+    return getattr(error.orig, 'pgcode', None) == '57014' or getattr(error.orig, 'args', ())[:1] in [(3024,), (1969,)]
+
+
+def shed(request_class, reason):
+    metrics.REQUESTS_SHED.labels(request_class=request_class, reason=reason).inc()
+    return 503, 'The judge is overloaded, retry in {} seconds.'.format(RETRY_AFTER), {'Retry-After': str(RETRY_AFTER)}
+
+
+# SQLAlchemy 1.4 has is_mariadb, older versions _is_mariadb.
+def _is_mariadb(dialect):
+    return getattr(dialect, 'is_mariadb', False) or getattr(dialect, '_is_mariadb', False)
+
+
+# Statement timeouts are set per connection, and reset once it is used by a request without one.
+@event.listens_for(Engine, 'before_cursor_execute')
+def _set_statement_timeout(conn, cursor, statement, parameters, context, executemany):
+    timeout = g.get('statement_timeout', 0) if has_app_context() else 0
+    if conn.info.get('statement_timeout', 0) == timeout:
+        return
+    if conn.dialect.name == 'postgresql':
+        cursor.execute('SET statement_timeout = {:d}'.format(int(timeout * 1000)))
+    elif conn.dialect.name == 'mysql' and _is_mariadb(conn.dialect):
+        cursor.execute('SET SESSION max_statement_time = {:f}'.format(timeout))
+    elif conn.dialect.name == 'mysql':
+        cursor.execute('SET SESSION max_execution_time = {:d}'.format(int(timeout * 1000)))
+    conn.info['statement_timeout'] = timeout
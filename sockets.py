@@ -7,15 +7,36 @@ keep a buffer of updates to apply to the object when it is received if the objec
 Because of the race potential between update emissions and initial objects, the object is queried for existence
 (and potentially permission) once from the SQL database, then the subscriber is added to the room, and then
 the object is queried for again and emitted to the subscriber.
+
+Every change to a job's or submission's status is also recorded in the event log (see Event and GET /events), and its
+update carries the event's sequence number as the last argument. Progress within a test run is not logged, and its
+updates carry no sequence number. A client that reconnects subscribes again and then sends resume with the
+last sequence number it has seen; the acknowledgement is the JSON list of the events it missed, oldest first. If the
+list is EVENTS_LIMIT long there may be more, and it resumes again from the last one. Updates with a sequence number
+the client has already seen are duplicates of events it caught up on.
 """
 
 from flask import current_app, json
 from flask_socketio import SocketIO, emit, leave_room, join_room
+from sqlalchemy import or_
 
-from models import db, Job, Submission
+import constants
+import progress
+import replica
+from models import archived_jobs, archived_submissions, db, Event, Job, Submission, serialize_job
 
 socketio = SocketIO()
 
+# Namespace of the jury protocol (jury_protocol.py), and the room of its juries that are waiting for work.
+JURY_NAMESPACE = '/jury'
+JURY_WAITING_ROOM = 'jury_waiting'
+
+
+@socketio.on('resume')
+def resume(since):
+    replica.use_primary()  # a lagging replica would skip events
+    return json.dumps(Event.list_details(int(since)))
+
 
 @socketio.on('sub_monitor')
 def sub_monitor():
@@ -32,19 +53,29 @@ def unsub_jobs():
     leave_room('jobs')
 
 
+# Snapshots are loaded from the replica, unless it has not caught up with the object yet.
+def exists(query):
+    replica.use_replica()
+    if db.session.query(query.exists()).scalar():
+        return True
+    replica.use_primary()
+    return db.session.query(query.exists()).scalar()
+
+
 @socketio.on('sub_job')
 def sub_job(job_id):
-    job_exists = db.session.query(Job.query.filter_by(id=job_id).exists()).scalar()
-    if not job_exists:
+    if not exists(Job.query.filter_by(id=job_id)) and \
+            not exists(db.session.query(archived_jobs).filter(archived_jobs.c.id == job_id)):
         emit('error', 'sub_job', 'Job does not exist!')
         return
     join_room('job_{}'.format(int(job_id)))
-    job = Job.query.get(job_id)
+    job = Job.query_details().filter(Job.id == job_id).first() or \
+        Job.query_archived_details().filter(archived_jobs.c.id == job_id).first()
     if not job:
         current_app.logger.warning('Job {} disappeared after existence check in sub_job'.format(job_id))
         emit('error', 'sub_job', 'Job does not exist!')
         return
-    emit('job_init', json.dumps(job.generate_details()))
+    emit('job_init', json.dumps(progress.overlay([serialize_job(job)])[0]))
 
 
 @socketio.on('unsub_job')
@@ -52,6 +83,27 @@ def unsub_job(job):
     leave_room('job_{}'.format(int(job)))
 
 
+# Juries subscribe to the jobs they are running to be told when they are cancelled, and can stop judging right away.
+@socketio.on('sub_jury_job')
+def sub_jury_job(job_id, verification_code):
+    # A second jury running a straggling job holds the hedge's verification code, see Job.claim_hedge.
+    holder = or_(Job.verification_code == verification_code, Job.hedge_verification_code == verification_code)
+    job_exists = db.session.query(Job.query.filter(Job.id == job_id, holder).exists()).scalar()
+    if not job_exists:
+        emit('error', 'sub_jury_job', 'Job does not exist!')
+        return
+    join_room('jury_job_{}'.format(int(job_id)))
+    # The job may have been cancelled before the jury joined the room.
+    status = db.session.query(Job.status).filter(Job.id == job_id).scalar()
+    if status == constants.JobStatus.cancelled:
+        emit('job_cancelled', int(job_id))
+
+
+@socketio.on('unsub_jury_job')
+def unsub_jury_job(job_id):
+    leave_room('jury_job_{}'.format(int(job_id)))
+
+
 @socketio.on('sub_submissions')
 def sub_submissions():
     join_room('submissions')
@@ -64,17 +116,17 @@ def unsub_submissions():
 
 @socketio.on('sub_submission')
 def sub_submission(submission_id):
-    submission_exists = db.session.query(Submission.query.filter_by(id=submission_id).exists()).scalar()
-    if not submission_exists:
+    if not exists(Submission.query.filter_by(id=submission_id)) and \
+            not exists(db.session.query(archived_submissions).filter(archived_submissions.c.id == submission_id)):
         emit('error', 'sub_submission', 'Submission does not exist!')
         return
     join_room('submission_{}'.format(int(submission_id)))
-    submission = Submission.query.get(submission_id)
-    if not submission:
+    submissions = progress.overlay_submissions(Submission.list_details(Submission.id == submission_id))
+    if not submissions:
         current_app.logger.warning('Submission {} disappeared after existence check in sub_submission'.format(submission_id))
         emit('error', 'sub_submission', 'Submission does not exist!')
         return
-    emit('submission_init', json.dumps(submission.generate_details()))
+    emit('submission_init', json.dumps(submissions[0]))
 
 
 @socketio.on('unsub_submission')
@@ -1,7 +1,30 @@
-from flask import json, url_for
+from datetime import datetime, timedelta
+import gzip
+import io
+import os
+import time
+import types
 
+import pytest
+import redis
+from flask import g, json, url_for
+from prometheus_client import REGISTRY
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+
+import archive
+import blobstore
+import cache_bus
+import constants
+import idempotency
+import metrics
+import models
+import queues
+import replica
+import shedding
+import util
 import views
-from models import APIKey
+from models import APIKey, Event, Job, JOB_DETAIL_ATTRS, Problem, ProblemVersion, Submission, serialize_job
 
 
 def test_sanity_check(client):
@@ -68,3 +91,882 @@ def test_require_multiple_perms(app, db):
     with app.test_request_context(headers=dict()):
         result = v()
         assert result == (403, None)
+
+
+def test_metrics(app, client, db, monkeypatch):
+    client.get(url_for('api.sanity_check'))
+    master_key = APIKey.new(perm_master=True).key
+    jury_key = APIKey.new(perm_jury=True).key
+    monkeypatch.setitem(app.config, 'METRICS_TOKEN', 'scrape')
+
+    assert client.get(url_for('api.metrics_export')).status_code == 403
+    assert client.get(url_for('api.metrics_export'), headers={'api_key': jury_key}).status_code == 403
+    assert client.get(url_for('api.metrics_export'), headers={'Authorization': 'Bearer wrong'}).status_code == 403
+    assert client.get(url_for('api.metrics_export'), headers={'Authorization': 'Bearer scrape'}).status_code == 200
+    response = client.get(url_for('api.metrics_export'), headers={'api_key': master_key})
+    assert response.status_code == 200
+    body = response.data.decode('utf-8')
+    assert 'judge_request_latency_seconds_count{endpoint="api.sanity_check"}' in body
+    assert 'judge_queue_depth{status="queued"}' in body
+
+    # Queue depth is counted once per QUEUE_DEPTH_TTL, however often it is scraped.
+    counts = []
+    collector = metrics.QueueDepthCollector(lambda: counts.append(1) or [])
+    list(collector.collect())
+    list(collector.collect())
+    assert len(counts) == 1
+
+
+def test_request_profile(app, client, db, tmpdir):
+    master_key = APIKey(perm_master=True)
+    db.session.add(master_key)
+    db.session.commit()
+    app.config['PROFILE_DIR'] = str(tmpdir)
+
+    response = client.get(url_for('api.sanity_check'), headers={'api_key': master_key.key})
+    assert 'X-Profile-Id' not in response.headers
+
+    response = client.get(url_for('api.sanity_check'), headers={'api_key': master_key.key, 'X-Profile': '1'})
+    assert tmpdir.join(response.headers['X-Profile-Id']).check()
+
+
+def test_slow_query_log(app, db, caplog):
+    app.config['SLOW_QUERY_THRESHOLD'] = 1e-9
+    try:
+        APIKey.query.filter_by(key='nonexistent').first()
+    finally:
+        app.config['SLOW_QUERY_THRESHOLD'] = 0
+    messages = [record.getMessage() for record in caplog.records]
+    assert any('Slow query' in message and 'SCAN apikeys' in message for message in messages)
+
+    # A failing statement leaves no timing state behind on the pooled connection.
+    with db.engine.connect() as connection:
+        with pytest.raises(OperationalError):
+            connection.execute('SELECT * FROM nonexistent')
+        assert not any('start_time' in key for key in connection.info)
+
+
+def test_compiled_serializer(request_context):
+    job = Job(id=1, submission_id=2, creation_time=datetime(2017, 3, 13, 16, 31, 43),
+              status=constants.JobStatus.finished, last_ran_case=3, verdict=constants.JobVerdict.accepted)
+
+    expected = json.dumps(util.get_attrs(job, JOB_DETAIL_ATTRS, include_none=False), cls=util.JSONEncoder)
+    assert json.dumps(job.generate_details(), cls=util.JSONEncoder) == expected
+    assert views.encode_json(job.generate_details()) == expected
+
+
+def test_json_bytes(app, request_context, monkeypatch):
+    @views.api_view
+    def v():
+        return 200, {'b': 'caf\u00e9', 'a': [1.5, None]}
+
+    # By default, responses are byte for byte what Flask's encoder produces.
+    assert v().data == b'{"a": [1.5, null], "b": "caf\\u00e9"}'
+    if util.orjson is not None:
+        monkeypatch.setitem(app.config, 'FAST_JSON', True)
+        assert v().data == '{"a":[1.5,null],"b":"caf\u00e9"}'.encode('utf-8')
+
+
+# The current value of a metric, 0 if it has not been touched yet.
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def create_problem(db, problem_id, test_cases=3):
+    problem = Problem(id=problem_id, test_cases=test_cases, time_limit=1, memory_limit=65536, generator_code='',
+                      generator_language='python3', grader_code='', grader_language='python3')
+    db.session.add(problem)
+    db.session.commit()
+    return problem
+
+
+def test_list_details(db):
+    problem = create_problem(db, 1)
+    for uid in [1, 1, 2]:
+        submission, _ = Submission.create_with_new_job(code='print(1)', language='python3', uid=uid, problem=problem)
+        Job.create(submission=submission)
+
+    submissions = Submission.query.filter_by(uid=1).order_by(Submission.id)
+    expected = [submission.generate_details() for submission in submissions]
+    assert Submission.list_details(Submission.uid == 1) == expected
+    assert [serialize_job(job) for job in Job.query_details().order_by(Job.id)] == \
+        [job.generate_details() for job in Job.query.order_by(Job.id)]
+
+
+@pytest.fixture
+def fake_redis(app):
+    fakeredis = pytest.importorskip('fakeredis')
+    original = app.extensions['redis']
+    app.extensions['redis'] = fakeredis.FakeStrictRedis()
+    yield app.extensions['redis']
+    app.extensions['redis'] = original
+
+
+@pytest.fixture
+def redis_queue(app, fake_redis):
+    original = app.extensions['job_queue']
+    app.extensions['job_queue'] = queues.RedisStreamQueue()
+    yield app.extensions['job_queue']
+    app.extensions['job_queue'] = original
+
+
+def create_keys(db):
+    reader_key = APIKey(perm_reader=True)
+    jury_key = APIKey(perm_jury=True)
+    db.session.add(reader_key)
+    db.session.add(jury_key)
+    db.session.commit()
+    return {'api_key': reader_key.key}, {'api_key': jury_key.key}
+
+
+def test_redis_queue(client, db, redis_queue):
+    create_problem(db, 1)
+    reader, jury = create_keys(db)
+
+    job_ids = []
+    for _ in range(3):
+        response = client.post(url_for('api.submissions_create'), headers=reader,
+                               data={'problem_id': 1, 'language': 'python3', 'code': 'print(1)'})
+        job_ids.append(json.loads(response.data.decode('utf-8'))['job_id'])
+    assert client.delete(url_for('api.jobs_cancel', job_id=job_ids[1]), headers=reader).status_code == 200
+
+    first = json.loads(client.post(url_for('api.jobs_claim'), headers=jury).data.decode('utf-8'))
+    assert first['id'] == job_ids[0]
+    response = client.post(url_for('api.jobs_release', job_id=job_ids[0]), headers=jury,
+                           data={'verification_code': first['verification_code']})
+    assert response.status_code == 200
+    assert redis_queue.depth() == 2
+
+    # Simulate a Redis restart; the queue is rebuilt from SQL and the released job keeps its place.
+    redis_queue.redis.flushall()
+    claimed = [json.loads(client.post(url_for('api.jobs_claim'), headers=jury).data.decode('utf-8'))['id']
+               for _ in range(2)]
+    assert claimed == [job_ids[0], job_ids[2]]
+    assert client.post(url_for('api.jobs_claim'), headers=jury).status_code == 204
+
+
+def test_job_transitions(client, db):
+    problem = create_problem(db, 1, test_cases=2)
+    reader, jury = create_keys(db)
+    _, job = Submission.create_with_new_job(code='print(1)', language='python3', problem=problem)
+    job_id = job.id
+
+    claim = json.loads(client.post(url_for('api.jobs_claim'), headers=jury).data.decode('utf-8'))
+    submit_url = url_for('api.jobs_submit', job_id=job_id)
+    progress = {'verification_code': claim['verification_code'], 'execution_time': 0.5, 'execution_memory': 1024,
+                'last_ran_case': 1}
+
+    assert client.post(submit_url, headers=jury, data=dict(progress, verification_code=1)).status_code == 403
+    assert client.post(submit_url, headers=jury, data=progress).status_code == 200
+    # With the problem cached, a progress update is the API key lookup plus a single UPDATE.
+    assert client.post(submit_url, headers=jury, data=progress).status_code == 200
+    assert g.query_count == 2
+
+    assert client.post(submit_url, headers=jury, data=dict(progress, last_ran_case=2)).status_code == 200
+    assert Job.query.get(job_id).status == constants.JobStatus.awaiting_verdict
+    # A late report within the test run does not move the job back to started.
+    assert client.post(submit_url, headers=jury, data=progress).status_code == 200
+    db.session.expire_all()
+    assert Job.query.get(job_id).status == constants.JobStatus.awaiting_verdict
+    assert client.post(submit_url, headers=jury, data=dict(progress, last_ran_case=2, verdict='AC')).status_code == 200
+    db.session.expire_all()
+    job = Job.query.get(job_id)
+    assert job.status == constants.JobStatus.finished and job.verdict == constants.JobVerdict.accepted
+    assert job.version == 7
+
+    assert client.post(submit_url, headers=jury, data=progress).status_code == 409
+    assert client.delete(url_for('api.jobs_cancel', job_id=job_id), headers=reader).status_code == 409
+    assert client.delete(url_for('api.jobs_cancel', job_id=job_id + 1), headers=reader).status_code == 404
+
+
+def test_progress_buffer(app, client, db, fake_redis, monkeypatch):
+    monkeypatch.setitem(app.config, 'PROGRESS_FLUSH_INTERVAL', 5)
+    problem = create_problem(db, 1, test_cases=3)
+    reader, jury = create_keys(db)
+    _, job = Submission.create_with_new_job(code='print(1)', language='python3', problem=problem)
+    job_id = job.id
+
+    claim = json.loads(client.post(url_for('api.jobs_claim'), headers=jury).data.decode('utf-8'))
+    submit_url = url_for('api.jobs_submit', job_id=job_id)
+    progress = {'verification_code': claim['verification_code'], 'execution_time': 0.5, 'execution_memory': 1024}
+
+    for case in [1, 2]:
+        assert client.post(submit_url, headers=jury, data=dict(progress, last_ran_case=case)).status_code == 200
+    assert g.query_count == 1  # With the problem cached, only the API key lookup
+    assert client.post(submit_url, headers=jury, data=dict(progress, last_ran_case=1, verification_code=1)) \
+        .status_code == 403
+
+    db.session.expire_all()
+    assert Job.query.get(job_id).last_ran_case is None
+    details = json.loads(client.get(url_for('api.jobs_status', job_id=job_id), headers=reader).data.decode('utf-8'))
+    assert details['last_ran_case'] == 2 and details['execution_memory'] == 1024
+
+    # Status changes are not buffered, so they are logged as events.
+    assert client.post(submit_url, headers=jury, data=dict(progress, last_ran_case=3)).status_code == 200
+    db.session.expire_all()
+    assert Job.query.get(job_id).status == constants.JobStatus.awaiting_verdict
+    event = Event.query.order_by(Event.id.desc()).first()
+    assert event.name == 'job_updated' and json.loads(event.data)['status'] == 'awaiting_verdict'
+    details = json.loads(client.get(url_for('api.jobs_status', job_id=job_id), headers=reader).data.decode('utf-8'))
+    assert details['status'] == 'awaiting_verdict' and details['last_ran_case'] == 3
+
+    response = client.post(submit_url, headers=jury, data=dict(progress, last_ran_case=3, verdict='WA'))
+    assert response.status_code == 200
+    db.session.expire_all()
+    job = Job.query.get(job_id)
+    assert job.last_ran_case == 3 and job.verdict == constants.JobVerdict.wrong_answer
+    assert not fake_redis.exists('judge:progress:{}'.format(job_id))
+
+
+def test_cancel_running_job(app, client, db):
+    from sockets import socketio
+    problem = create_problem(db, 1, test_cases=4)
+    reader, jury = create_keys(db)
+    _, job = Submission.create_with_new_job(code='print(1)', language='python3', problem=problem)
+    job_id = job.id
+
+    claim = json.loads(client.post(url_for('api.jobs_claim'), headers=jury).data.decode('utf-8'))
+    submit_url = url_for('api.jobs_submit', job_id=job_id)
+    progress = {'verification_code': claim['verification_code'], 'execution_time': 0.5, 'execution_memory': 1024,
+                'last_ran_case': 1}
+    assert client.post(submit_url, headers=jury, data=progress).status_code == 200
+
+    jury_socket = socketio.test_client(app)
+    jury_socket.emit('sub_jury_job', job_id, claim['verification_code'])
+    assert jury_socket.get_received() == []
+
+    before = sample('judge_jury_seconds_saved_total')
+    assert client.delete(url_for('api.jobs_cancel', job_id=job_id), headers=reader).status_code == 200
+    received = jury_socket.get_received()
+    assert [event['name'] for event in received] == ['job_cancelled']
+    assert received[0]['args'] == [job_id, Event.query.order_by(Event.id.desc()).first().id]
+    assert sample('judge_jury_seconds_saved_total') - before == 3
+
+    assert json.loads(client.post(submit_url, headers=jury, data=progress).data.decode('utf-8')) == 'Job cancelled!'
+    jury_socket.emit('sub_jury_job', job_id, claim['verification_code'])
+    assert [event['name'] for event in jury_socket.get_received()] == ['job_cancelled']
+
+
+@pytest.mark.parametrize('policy', [constants.SupersedePolicy.cancel, constants.SupersedePolicy.deprioritize])
+def test_supersede(app, client, db, policy):
+    problem = create_problem(db, 1)
+    problem.supersede_policy = policy
+    db.session.commit()
+    reader, jury = create_keys(db)
+
+    def submit(uid, gid=1):
+        data = {'problem_id': 1, 'gid': gid, 'language': 'python3', 'code': 'print(1)'}
+        if uid is not None:
+            data['uid'] = uid
+        return json.loads(client.post(url_for('api.submissions_create'), headers=reader, data=data).data
+                          .decode('utf-8'))['job_id']
+
+    # Team submissions without a uid supersede each other too.
+    first, other, team_first, second, team_second = submit(1), submit(2), submit(None, 3), submit(1), submit(None, 3)
+    db.session.expire_all()
+    if policy == constants.SupersedePolicy.cancel:
+        assert Job.query.get(first).status == constants.JobStatus.cancelled
+        assert Job.query.get(team_first).status == constants.JobStatus.cancelled
+        claimed = [other, second, team_second]
+    else:
+        # Deprioritized jobs are pushed back in the queue, not behind every later job.
+        assert Job.query.get(first).status == constants.JobStatus.queued
+        assert Job.query.get(first).schedule_key == \
+            Job.calculate_schedule_key(Job.query.get(first).creation_time, 0, 0) + app.config['SUPERSEDE_DELAY']
+        claimed = [other, second, team_second, first, team_first]
+        late = Submission.create(code='print(1)', language='python3', problem=problem, commit=False)
+        late_time = datetime.utcnow() + timedelta(seconds=2 * app.config['SUPERSEDE_DELAY'])
+        claimed.append(Job.create(submission=late, creation_time=late_time).id)
+    assert Job.query.get(other).status == constants.JobStatus.queued
+
+    for job_id in claimed:
+        claim = json.loads(client.post(url_for('api.jobs_claim'), headers=jury).data.decode('utf-8'))
+        assert claim['id'] == job_id
+    assert client.post(url_for('api.jobs_claim'), headers=jury).status_code == 204
+
+
+@pytest.fixture
+def blob_store(app, tmpdir):
+    original = app.extensions['blobstore']
+    app.extensions['blobstore'] = blobstore.BlobStore(str(tmpdir), 1024)
+    yield app.extensions['blobstore']
+    app.extensions['blobstore'] = original
+
+
+def test_blob_store_eviction(blob_store):
+    digests = []
+    for i in range(3):
+        digest, size = blob_store.put(io.BytesIO(bytes([i]) * 400))
+        assert size == 400
+        digests.append(digest)
+        os.utime(blob_store.get(digest), (i, i))
+    blob_store.set_ref('first', digests[0])
+
+    assert blob_store.get(digests[0]) is None
+    assert blob_store.get_ref('first') is None
+    assert all(blob_store.get(digest) for digest in digests[1:])
+    assert blob_store.size == 800
+
+    # Writes that keep the store under its limit only update the running total.
+    blob_store.evict = None
+    assert blob_store.put(io.BytesIO(bytes([2]) * 400)) == (digests[2], 400)
+    assert blob_store.put(io.BytesIO(b'x' * 200))[1] == 200
+    assert blob_store.size == 1000
+
+
+def test_artifact_cache(client, db, blob_store):
+    problem = create_problem(db, 1)
+    reader, jury = create_keys(db)
+    Submission.create_with_new_job(code='int main() {}', language='cxx', problem=problem)
+    Submission.create_with_new_job(code='int main() {}', language='cxx', problem=problem)
+
+    claim = json.loads(client.post(url_for('api.jobs_claim'), headers=jury, data={'toolchain': 'gcc-12'}).data
+                       .decode('utf-8'))
+    assert claim['code_hash'] == util.hash_code('int main() {}') and 'artifact' not in claim
+
+    upload_url = url_for('api.artifacts_upload', code_hash=claim['code_hash'], language='cxx', toolchain='gcc-12')
+    response = client.put(upload_url, headers=jury, data=b'\x7fELF binary')
+    assert response.status_code == 201
+    digest = json.loads(response.data.decode('utf-8'))['digest']
+
+    claim = json.loads(client.post(url_for('api.jobs_claim'), headers=jury, data={'toolchain': 'gcc-12'}).data
+                       .decode('utf-8'))
+    assert claim['artifact'] == digest
+
+    response = client.get(url_for('api.blobs_get', digest=digest), headers=dict(jury, Range='bytes=1-3'))
+    assert response.status_code == 206 and response.data == b'ELF'
+    assert response.headers['ETag'] == '"{}"'.format(digest) and response.cache_control.max_age == 365 * 24 * 3600
+    response = client.get(url_for('api.blobs_get', digest=digest), headers=dict(jury, **{'If-None-Match': digest}))
+    assert response.status_code == 304
+    assert client.get(url_for('api.blobs_get', digest=digest), headers=reader).status_code == 403
+
+
+def test_test_data_cache(client, db, blob_store):
+    problem = create_problem(db, 1)
+    ProblemVersion.create(problem)
+    db.session.commit()
+    reader, jury = create_keys(db)
+    for _ in range(2):
+        Submission.create_with_new_job(code='print(1)', language='python3', problem=problem)
+
+    claim = json.loads(client.post(url_for('api.jobs_claim'), headers=jury).data.decode('utf-8'))
+    assert 'test_data' not in claim
+    test_data_url = url_for('api.problems_test_data_get', problem_id=1)
+    assert client.get(test_data_url, headers=jury).status_code == 404
+
+    upload_url = url_for('api.problems_test_data_upload', problem_id=1, generator_hash=claim['generator_hash'])
+    assert client.put(upload_url, headers=jury, data=b'case data').status_code == 201
+    claim = json.loads(client.post(url_for('api.jobs_claim'), headers=jury).data.decode('utf-8'))
+    response = client.get(test_data_url, headers=dict(jury, Range='bytes=5-'))
+    assert response.status_code == 206 and response.data == b'data'
+    assert response.headers['ETag'].strip('"') == claim['test_data']
+
+    # Jobs pinned to the old version still upload and download the old test data by the hash in their claim.
+    client.put(url_for('api.problems_modify', problem_id=1), headers=reader, data={'generator_code': 'print(2)'})
+    assert client.get(test_data_url, headers=jury).status_code == 404
+    old_test_data_url = url_for('api.problems_test_data_get', problem_id=1, generator_hash=claim['generator_hash'])
+    response = client.get(old_test_data_url, headers=jury)
+    assert response.status_code == 200 and response.data == b'case data'
+    assert response.headers['X-Generator-Hash'] == claim['generator_hash']
+    assert client.put(upload_url, headers=jury, data=b'case data').status_code == 201
+    bad_upload_url = url_for('api.problems_test_data_upload', problem_id=1, generator_hash='0' * 64)
+    assert client.put(bad_upload_url, headers=jury, data=b'case data').status_code == 409
+
+
+def test_problem_versions(client, db):
+    reader, jury = create_keys(db)
+    data = {'id': 1, 'test_cases': 2, 'time_limit': 1, 'memory_limit': 65536, 'generator_code': 'print(1)',
+            'generator_language': 'python3', 'grader_code': 'print(1)', 'grader_language': 'python3'}
+    assert client.post(url_for('api.problems_create'), headers=reader, data=data).status_code == 201
+    _, old_job = Submission.create_with_new_job(code='print(1)', language='python3', problem=Problem.query.get(1))
+    old_job_id = old_job.id
+
+    client.put(url_for('api.problems_modify', problem_id=1), headers=reader, data={'test_cases': 3})
+    _, new_job = Submission.create_with_new_job(code='print(1)', language='python3', problem=Problem.query.get(1))
+    new_job_id = new_job.id
+
+    claims = [json.loads(client.post(url_for('api.jobs_claim'), headers=jury).data.decode('utf-8')) for _ in range(2)]
+    assert [claim['id'] for claim in claims] == [old_job_id, new_job_id]
+    assert claims[0]['problem_version_id'] != claims[1]['problem_version_id']
+    assert claims[0]['generator_hash'] != claims[1]['generator_hash']
+
+    response = client.get(url_for('api.problems_version_get', problem_id=1,
+                                  version_id=claims[0]['problem_version_id']), headers=jury)
+    assert json.loads(response.data.decode('utf-8'))['test_cases'] == 2
+    assert 'immutable' in response.headers['Cache-Control']
+
+    # The old job finishes after 2 test cases, as it is judged against the version it was created with.
+    submit = {'verification_code': claims[0]['verification_code'], 'execution_time': 0.5, 'execution_memory': 1024,
+              'last_ran_case': 2}
+    client.post(url_for('api.jobs_submit', job_id=old_job_id), headers=jury, data=submit)
+    assert Job.query.get(old_job_id).status == constants.JobStatus.awaiting_verdict
+
+
+def test_jury_protocol(app, client, db, monkeypatch):
+    import msgpack
+    from sockets import socketio
+    problem = create_problem(db, 1, test_cases=2)
+    reader, jury = create_keys(db)
+
+    assert not socketio.test_client(app, namespace='/jury', auth={'api_key': reader['api_key']}) \
+        .is_connected('/jury')
+    jury_socket = socketio.test_client(app, namespace='/jury', auth={'api_key': jury['api_key']})
+
+    def call(event, **message):
+        return msgpack.unpackb(jury_socket.emit(event, msgpack.packb(message), namespace='/jury', callback=True))
+
+    assert call('claim') == {'status': 204}
+    _, job = Submission.create_with_new_job(code='print(1)', language='python3', problem=problem)
+    job_id = job.id
+    client.post(url_for('api.submissions_job_create', submission_id=job.submission_id), headers=reader)
+    assert [event['name'] for event in jury_socket.get_received('/jury')] == ['job_available']
+
+    claim = call('claim')
+    assert claim['status'] == 200 and claim['job']['id'] == job_id
+    report = {'id': job_id, 'verification_code': claim['job']['verification_code'], 'execution_time': 0.5,
+              'execution_memory': 1024}
+    assert call('progress', **dict(report, verification_code=1, last_ran_case=1))['status'] == 403
+    assert call('progress', **dict(report, last_ran_case=1)) == {'status': 200}
+    assert call('progress', **dict(report, last_ran_case=2, verdict='AC')) == {'status': 200}
+    db.session.expire_all()
+    assert Job.query.get(job_id).verdict == constants.JobVerdict.accepted
+
+    claim = call('claim')
+    assert call('release', id=claim['job']['id'], verification_code=claim['job']['verification_code']) == \
+        {'status': 200}
+    claim = call('claim')
+    client.delete(url_for('api.jobs_cancel', job_id=claim['job']['id']), headers=reader)
+    received = jury_socket.get_received('/jury')
+    assert [event['name'] for event in received] == ['job_cancelled']
+    assert msgpack.unpackb(received[0]['args'][0]) == {'id': claim['job']['id']}
+
+    # The key is not looked up again on every message; once it is due for a check, a deactivated key is cut off.
+    APIKey.query.filter_by(key=jury['api_key']).update({'active': False})
+    db.session.commit()
+    assert call('claim') == {'status': 204}
+    monkeypatch.setitem(app.config, 'JURY_KEY_CHECK_INTERVAL', 0)
+    assert call('claim') == {'status': 403}
+    assert not jury_socket.is_connected('/jury')
+
+
+def test_response_negotiation(client, db):
+    import msgpack
+    reader, _ = create_keys(db)
+    create_problem(db, 1)
+    Problem.query.get(1).grader_code = 'print(1)\n' * 1000
+    db.session.commit()
+    url = url_for('api.problems_get', problem_id=1)
+
+    response = client.get(url, headers=reader)
+    assert 'Content-Encoding' not in response.headers
+    plain = json.loads(response.data.decode('utf-8'))
+
+    response = client.get(url, headers=dict(reader, **{'Accept-Encoding': 'gzip', 'Accept': 'application/msgpack'}))
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['Content-Type'] == 'application/msgpack'
+    assert msgpack.unpackb(gzip.decompress(response.data)) == plain
+
+    # Small responses are not compressed.
+    response = client.get(url_for('api.jobs_list'), headers=dict(reader, **{'Accept-Encoding': 'gzip'}))
+    assert 'Content-Encoding' not in response.headers and json.loads(response.data.decode('utf-8')) == []
+
+
+def test_cache_invalidation(db, fake_redis):
+    pubsub = fake_redis.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(cache_bus.CHANNEL)
+    ProblemVersion.create(create_problem(db, 1))
+    db.session.commit()
+    version_id = Problem.get_version_id(1)
+    assert version_id is not None and models.problem_version_ids.get(1) == version_id
+
+    Problem.invalidate_cache(1)
+    assert models.problem_version_ids.get(1) is None
+    # Another process receiving the message drops its copy as well.
+    models.problem_version_ids.set(1, version_id)
+    messages = [pubsub.get_message(timeout=1) for _ in range(2)]
+    cache_bus._apply(next(message for message in messages if message))
+    assert models.problem_version_ids.get(1) is None
+
+    # A value loaded before an invalidation arrives is not stored, as it may be the stale one.
+    def load_during_invalidation():
+        cache_bus._apply({'data': json.dumps(['problem_version_ids', 1]).encode('utf-8')})
+        return version_id
+
+    assert models.problem_version_ids.get_or_load(1, load_during_invalidation) == version_id
+    assert models.problem_version_ids.get(1) is None
+    assert Problem.get_version_id(1) == version_id and models.problem_version_ids.get(1) == version_id
+
+
+@pytest.fixture
+def read_replica(app, db, tmpdir):
+    original = app.extensions['replica']
+    engine = create_engine('sqlite:///{}'.format(tmpdir.join('replica.db')))
+    db.Model.metadata.create_all(engine)
+    app.extensions['replica'] = replica.Replica(engine, app.config)
+    yield app.extensions['replica']
+    app.extensions['replica'] = original
+
+
+def test_read_replica(client, db, read_replica):
+    reader, jury = create_keys(db)
+    other_reader, _ = create_keys(db)
+    problem = create_problem(db, 1)
+    submission, _ = Submission.create_with_new_job(code='print(1)', language='python3', problem=problem)
+    submission_id = submission.id
+    db.session.remove()  # as at the end of a request
+
+    # Reads go to the replica, which does not have the submission yet. API keys are looked up on the primary, which
+    # the replica has not caught up with either, and juries read from the primary.
+    details_url = url_for('api.submissions_details', submission_id=submission_id)
+    assert client.get(details_url, headers=reader).status_code == 404
+    assert client.get(url_for('api.problems_get', problem_id=1), headers=jury).status_code == 200
+    db.session.remove()
+
+    # After writing, a client reads from the primary.
+    data = {'problem_id': 1, 'language': 'python3', 'code': 'print(2)'}
+    assert client.post(url_for('api.submissions_create'), headers=reader, data=data).status_code == 201
+    assert client.get(details_url, headers=reader).status_code == 200
+    db.session.remove()
+    assert client.get(details_url, headers=other_reader).status_code == 404
+    # Juries never read from the replica, so their writes are not recorded.
+    assert client.post(url_for('api.jobs_claim'), headers=jury).status_code == 200
+    assert not read_replica.recent_writes.get(APIKey.query.filter_by(key=jury['api_key']).one().id)
+
+    # So does everyone while the replica lags behind.
+    read_replica.lag_checked_at = time.monotonic()
+    read_replica.lag_ok = False
+    assert client.get(details_url, headers=other_reader).status_code == 200
+
+
+def test_archive(app, client, db):
+    from sockets import socketio
+    problem = create_problem(db, 1)
+    reader, _ = create_keys(db)
+    old = datetime(2020, 1, 1)
+    archived, _ = Submission.create_with_new_job(code='print(1)', language='python3', uid=1, problem=problem, time=old)
+    archived.jobs[0].creation_time = old
+    archived.jobs[0].status = constants.JobStatus.finished
+    archived.jobs[0].verdict = constants.JobVerdict.accepted
+    # Not archived, as one of its jobs is still queued.
+    active, _ = Submission.create_with_new_job(code='print(2)', language='python3', uid=1, problem=problem, time=old)
+    active.jobs[0].creation_time = old
+    active.jobs[0].status = constants.JobStatus.cancelled
+    Job.create(submission=active, creation_time=old)
+    # Not archived either, as it holds the highest ids, which would be handed out again.
+    newest, newest_job = Submission.create_with_new_job(code='print(3)', language='python3', uid=1, problem=problem,
+                                                        time=old)
+    newest_job.creation_time = old
+    newest_job.status = constants.JobStatus.finished
+    db.session.commit()
+    archived_id, archived_job_id, active_id, newest_id = archived.id, archived.jobs[0].id, active.id, newest.id
+    before = client.get(url_for('api.submissions_list_by_uid', uid=1), headers=reader).data
+
+    assert archive.archive(datetime(2021, 1, 1), batch_size=1) == 1
+    assert Submission.query.get(archived_id) is None and Job.query.get(archived_job_id) is None
+    assert Submission.query.get(active_id) is not None and Submission.query.get(newest_id) is not None
+
+    # Reads are unchanged.
+    assert client.get(url_for('api.submissions_list_by_uid', uid=1), headers=reader).data == before
+    response = client.get(url_for('api.jobs_status', job_id=archived_job_id), headers=reader)
+    assert json.loads(response.data.decode('utf-8'))['verdict'] == 'AC'
+    response = client.get(url_for('api.jobs_list_by_problem', problem_id=1), headers=reader)
+    assert len(json.loads(response.data.decode('utf-8'))) == 4
+    socket = socketio.test_client(app)
+    socket.emit('sub_job', archived_job_id)
+    assert [event['name'] for event in socket.get_received()] == ['job_init']
+
+    # Rejudging brings the submission back.
+    client.post(url_for('api.submissions_job_create', submission_id=archived_id), headers=reader)
+    assert len(Submission.query.get(archived_id).jobs) == 2
+
+
+def test_events(app, client, db):
+    from sockets import socketio
+    create_problem(db, 1, test_cases=1)
+    reader, jury = create_keys(db)
+    since = 0
+
+    response = client.post(url_for('api.submissions_create'), headers=reader,
+                           data={'problem_id': 1, 'language': 'python3', 'code': 'print(1)', 'uid': 1})
+    job_id = json.loads(response.data.decode('utf-8'))['job_id']
+    claim = json.loads(client.post(url_for('api.jobs_claim'), headers=jury).data.decode('utf-8'))
+    client.post(url_for('api.jobs_submit', job_id=job_id), headers=jury,
+                data={'verification_code': claim['verification_code'], 'execution_time': 0.5,
+                      'execution_memory': 1024, 'last_ran_case': 1, 'verdict': 'AC'})
+
+    events = json.loads(client.get(url_for('api.events_list', since=since), headers=reader).data.decode('utf-8'))
+    assert [event['name'] for event in events] == ['submission_new', 'job_new', 'job_claimed', 'job_updated']
+    assert [event['id'] for event in events] == list(range(since + 1, since + 5))
+    assert events[3]['job_id'] == job_id and events[3]['data']['verdict'] == 'AC'
+
+    response = client.get(url_for('api.events_list', since=events[1]['id'], limit=1), headers=reader)
+    assert json.loads(response.data.decode('utf-8')) == events[2:3]
+
+    # A reconnecting client catches up on what it missed.
+    socket = socketio.test_client(app)
+    assert json.loads(socket.emit('resume', events[2]['id'], callback=True)) == events[3:]
+
+    # An event after a gap in the sequence is held back until the gap is unlikely to be filled by a commit anymore.
+    last_id = events[-1]['id']
+    db.session.execute(Event.__table__.insert().values(id=last_id + 2, name='job_new', time=datetime.utcnow()))
+    db.session.commit()
+    assert Event.list_details(last_id) == []
+    Event.query.filter(Event.id == last_id + 2).update({'time': datetime.utcnow() - models.EVENT_GAP_TIMEOUT})
+    db.session.commit()
+    assert [event['id'] for event in Event.list_details(last_id)] == [last_id + 2]
+
+    # Pruning keeps the newest event, so that its sequence number is not handed out again.
+    archive.prune_events(datetime.utcnow() + timedelta(days=1), batch_size=2)
+    assert [event.id for event in Event.query] == [last_id + 2]
+
+
+def test_rate_limits(app, client, db, fake_redis):
+    create_problem(db, 1)
+    unlimited = create_problem(db, 2)
+    unlimited.submission_rate = 0
+    db.session.commit()
+    reader, _ = create_keys(db)
+    original = dict(app.config)
+    app.config.update(CONTESTANT_SUBMISSION_RATE=1, CONTESTANT_SUBMISSION_BURST=2)
+
+    def submit(problem_id, uid):
+        return client.post(url_for('api.submissions_create'), headers=reader,
+                           data={'problem_id': problem_id, 'language': 'python3', 'code': 'print(1)', 'uid': uid})
+
+    try:
+        before = sample('judge_submissions_rejected_total', reason='contestant')
+        assert [submit(1, 1).status_code for _ in range(3)] == [201, 201, 429]
+        response = submit(1, 1)
+        assert response.status_code == 429 and 30 <= int(response.headers['Retry-After']) <= 60
+        assert sample('judge_submissions_rejected_total', reason='contestant') - before == 2
+        assert submit(1, 2).status_code == 201
+        assert submit(2, 1).status_code == 201
+
+        app.config['MAX_QUEUED_JOBS'] = queues.get_queue().depth()
+        response = submit(2, 1)
+        assert response.status_code == 429 and response.headers['Retry-After'] == '10'
+    finally:
+        app.config.update(original)
+
+
+def test_load_shedding(app, client, db):
+    reader, jury = create_keys(db)
+    original = dict(app.config)
+    app.config.update(READER_CONCURRENCY=1, JURY_CONCURRENCY=1)
+    try:
+        before = sample('judge_requests_shed_total', request_class='reader', reason='concurrency')
+        shedding.running['reader'] = 1  # a reader request is running
+        response = client.get(url_for('api.jobs_list'), headers=reader)
+        assert response.status_code == 503 and response.headers['Retry-After'] == '1'
+        assert sample('judge_requests_shed_total', request_class='reader', reason='concurrency') == \
+            before + 1
+        # Juries are not held up by readers, and problem reads are on the jury path.
+        create_problem(db, 1)
+        assert client.get(url_for('api.problems_get', problem_id=1), headers=jury).status_code == 200
+        assert client.post(url_for('api.jobs_claim'), headers=jury).status_code == 204
+        # Writes by a reader key are classified by method, not permission, and not shed with the reads.
+        assert shedding.classify('POST', 'api.submissions_create') == 'writer'
+        data = {'problem_id': 1, 'language': 'python3', 'code': 'print(1)'}
+        assert client.post(url_for('api.submissions_create'), headers=reader, data=data).status_code == 201
+
+        shedding.running['reader'] = 0
+        assert client.get(url_for('api.jobs_list'), headers=reader).status_code == 200
+        assert shedding.running == {'jury': 0, 'master': 0, 'writer': 0, 'reader': 0}
+    finally:
+        shedding.running['reader'] = 0
+        app.config.update(original)
+
+
+def test_statement_timeout(app, client, db, monkeypatch):
+    reader, _ = create_keys(db)
+
+    class DatabaseError(Exception):
+        pgcode = None
+
+    def timed_out(*args):
+        error = DatabaseError(*args)
+        return OperationalError('SELECT', {}, error)
+
+    postgres_error = timed_out()
+    postgres_error.orig.pgcode = '57014'
+    assert all(shedding.is_statement_timeout(error) for error in [postgres_error, timed_out(3024), timed_out(1969)])
+    assert not shedding.is_statement_timeout(timed_out(2006))
+
+    # The timeout is set on the connection in the way of each database.
+    executed = []
+    cursor = types.SimpleNamespace(execute=executed.append)
+    g.statement_timeout = 2
+    try:
+        for name, is_mariadb in [('postgresql', False), ('mysql', False), ('mysql', True), ('sqlite', False)]:
+            conn = types.SimpleNamespace(info={}, dialect=types.SimpleNamespace(name=name, is_mariadb=is_mariadb))
+            shedding._set_statement_timeout(conn, cursor, 'SELECT 1', {}, None, False)
+    finally:
+        g.statement_timeout = 0
+    assert executed == ['SET statement_timeout = 2000', 'SET SESSION max_execution_time = 2000',
+                        'SET SESSION max_statement_time = 2.000000']
+
+    # A reader request whose query runs out of time is shed.
+    def list_jobs(*criteria):
+        assert g.statement_timeout == 2
+        raise timed_out(1969)
+
+    monkeypatch.setattr(views, 'list_jobs', list_jobs)
+    monkeypatch.setitem(app.config, 'READER_STATEMENT_TIMEOUT', 2)
+    before = sample('judge_requests_shed_total', request_class='reader', reason='statement_timeout')
+    response = client.get(url_for('api.jobs_list'), headers=reader)
+    assert response.status_code == 503 and response.headers['Retry-After'] == '1'
+    assert sample('judge_requests_shed_total', request_class='reader', reason='statement_timeout') == before + 1
+    assert g.statement_timeout == 0
+
+    # Writes get no statement timeout.
+    timeouts = []
+    monkeypatch.setattr(idempotency, 'replay', lambda: timeouts.append(g.statement_timeout) or (200, None))
+    assert client.post(url_for('api.submissions_create'), headers=reader).status_code == 200
+    assert timeouts == [0]
+
+
+def test_cost_aware_scheduling(app, client, db):
+    big = Problem(id=1, test_cases=50, time_limit=5, memory_limit=65536, generator_code='',
+                  generator_language='python3', grader_code='', grader_language='python3')
+    db.session.add(big)
+    small = create_problem(db, 2, test_cases=3)
+    _, jury = create_keys(db)
+    app.config['SCHEDULING_COST_WEIGHT'] = 10
+    try:
+        assert Job.estimate_runtime(small, 'python3') == 3
+        _, finished = Submission.create_with_new_job(code='print(1)', language='python3', problem=small)
+        finished.status, finished.execution_time = constants.JobStatus.finished, 0.2
+        db.session.commit()
+        models.runtime_estimates.clear()
+        assert Job.estimate_runtime(small, 'python3') == pytest.approx(0.6)
+
+        _, big_job = Submission.create_with_new_job(code='print(1)', language='python3', problem=big)
+        _, small_job = Submission.create_with_new_job(code='print(1)', language='python3', problem=small)
+        big_job_id, small_job_id = big_job.id, small_job.id
+        claimed = [json.loads(client.post(url_for('api.jobs_claim'), headers=jury).data.decode('utf-8'))['id']
+                   for _ in range(2)]
+        assert claimed == [small_job_id, big_job_id]
+    finally:
+        app.config['SCHEDULING_COST_WEIGHT'] = 0
+
+
+def test_hedged_stragglers(app, client, db):
+    problem = create_problem(db, 1, test_cases=3)
+    _, jury = create_keys(db)
+    _, job = Submission.create_with_new_job(code='print(1)', language='python3', problem=problem)
+    job_id = job.id
+    app.config.update(HEDGE_STRAGGLERS=True, HEDGE_MARGIN=30)
+    try:
+        first = json.loads(client.post(url_for('api.jobs_claim'), headers=jury).data.decode('utf-8'))
+        assert client.post(url_for('api.jobs_claim'), headers=jury).status_code == 204  # not straggling yet
+
+        # 3 test cases of 1 second plus the margin
+        Job.query.filter(Job.id == job_id).update({'claim_time': datetime.utcnow() - timedelta(seconds=34)})
+        db.session.commit()
+        issued, won = sample('judge_hedges_issued_total'), sample('judge_hedges_won_total')
+        hedge = json.loads(client.post(url_for('api.jobs_claim'), headers=jury).data.decode('utf-8'))
+        assert hedge['id'] == job_id and hedge['hedge'] and hedge['verification_code'] != first['verification_code']
+        assert client.post(url_for('api.jobs_claim'), headers=jury).status_code == 204
+        assert sample('judge_hedges_issued_total') == issued + 1
+
+        submit_url = url_for('api.jobs_submit', job_id=job_id)
+        progress = {'execution_time': 0.5, 'execution_memory': 1024, 'last_ran_case': 1,
+                    'verification_code': first['verification_code']}
+        assert client.post(submit_url, headers=jury, data=progress).status_code == 200
+        # The hedge's progress is dropped, and its verdict wins.
+        hedge_progress = dict(progress, verification_code=hedge['verification_code'], last_ran_case=2)
+        response = client.post(submit_url, headers=jury, data=hedge_progress)
+        assert response.status_code == 200 and response.data == b''
+        db.session.expire_all()
+        assert Job.query.get(job_id).last_ran_case == 1
+        assert client.post(submit_url, headers=jury, data=dict(progress, verification_code=hedge['verification_code'],
+                                                               last_ran_case=3, verdict='AC')).status_code == 200
+        assert client.post(submit_url, headers=jury, data=dict(progress, last_ran_case=3, verdict='WA')) \
+            .status_code == 409
+        db.session.expire_all()
+        job = Job.query.get(job_id)
+        assert job.verdict == constants.JobVerdict.accepted and job.hedge_verification_code is None
+        assert sample('judge_hedges_won_total') == won + 1
+    finally:
+        app.config.update(HEDGE_STRAGGLERS=False)
+
+
+def test_idempotency_keys(client, db):
+    create_problem(db, 1)
+    reader, _ = create_keys(db)
+
+    def submit(key, problem_id=1):
+        return client.post(url_for('api.submissions_create'), headers=dict(reader, **{'Idempotency-Key': key}),
+                           data={'problem_id': problem_id, 'language': 'python3', 'code': 'print(1)'})
+
+    response = submit('a')
+    assert response.status_code == 201
+    created = json.loads(response.data.decode('utf-8'))
+    replayed = submit('a')
+    assert replayed.status_code == 201 and json.loads(replayed.data.decode('utf-8')) == created
+    assert Submission.query.count() == 1
+    assert submit('b').status_code == 201 and Submission.query.count() == 2
+    response = client.post(url_for('api.submissions_create'), headers=dict(reader, **{'Idempotency-Key': 'a'}),
+                           data={'problem_id': 1, 'language': 'python3', 'code': 'print(2)'})
+    assert response.status_code == 422 and Submission.query.count() == 2
+
+    create_job_url = url_for('api.submissions_job_create', submission_id=created['id'])
+    assert client.post(create_job_url, headers=dict(reader, **{'Idempotency-Key': 'a'})).status_code == 422
+    job_ids = [json.loads(client.post(create_job_url, headers=dict(reader, **{'Idempotency-Key': 'c'})).data
+                          .decode('utf-8'))['job_id'] for _ in range(2)]
+    assert job_ids[0] == job_ids[1]
+    assert submit('x' * 65).status_code == 400
+
+    # Expired keys count as absent even before they are pruned.
+    models.IdempotencyKey.query.update({'creation_time': datetime(2000, 1, 1)})
+    db.session.commit()
+    assert submit('a').status_code == 201 and Submission.query.count() == 3
+    assert archive.prune_idempotency_keys(datetime(2001, 1, 1), 2) == 2
+
+
+def test_multiget(client, db):
+    problem = create_problem(db, 1)
+    reader, _ = create_keys(db)
+    submission_ids, job_ids = zip(*[(submission.id, job.id) for submission, job in [
+        Submission.create_with_new_job(code='print(1)', language='python3', problem=problem) for _ in range(2)]])
+
+    def get(endpoint, ids):
+        response = client.get(url_for(endpoint, ids=ids), headers=reader)
+        assert response.status_code == 200
+        return json.loads(response.data.decode('utf-8'))
+
+    jobs = get('api.jobs_list', '{},{}'.format(*job_ids))
+    assert [job['id'] for job in jobs] == list(job_ids)
+    versions = ','.join('{}:{}'.format(job['id'], job['version']) for job in jobs)
+    assert get('api.jobs_list', versions) == []
+    assert client.delete(url_for('api.jobs_cancel', job_id=job_ids[1]), headers=reader).status_code == 200
+    changed = get('api.jobs_list', versions)
+    assert [job['id'] for job in changed] == [job_ids[1]] and changed[0]['status'] == 'cancelled'
+
+    submissions = get('api.submissions_list', ','.join(map(str, submission_ids)))
+    versions = ','.join('{}:{}'.format(submission['id'], submission['version']) for submission in submissions)
+    assert get('api.submissions_list', versions) == []
+    client.post(url_for('api.submissions_job_create', submission_id=submission_ids[0]), headers=reader)
+    assert [submission['id'] for submission in get('api.submissions_list', versions)] == [submission_ids[0]]
+
+    assert client.get(url_for('api.jobs_list', ids='1:a'), headers=reader).status_code == 400
+
+
+def test_queue_failure_after_commit(client, db, redis_queue, monkeypatch):
+    create_problem(db, 1)
+    reader, jury = create_keys(db)
+    assert client.post(url_for('api.jobs_claim'), headers=jury).status_code == 204  # creates the stream
+
+    def unreachable(*args, **kwargs):
+        raise redis.ConnectionError()
+
+    monkeypatch.setattr(redis_queue.redis, 'xadd', unreachable)
+    response = client.post(url_for('api.submissions_create'), headers=reader,
+                           data={'problem_id': 1, 'language': 'python3', 'code': 'print(1)'})
+    assert response.status_code == 201
+    monkeypatch.undo()
+
+    # The job has no stream entry, and is swept in once the sweep is due.
+    redis_queue.redis.delete(redis_queue.SWEEP_LOCK)
+    claim = json.loads(client.post(url_for('api.jobs_claim'), headers=jury).data.decode('utf-8'))
+    assert claim['id'] == json.loads(response.data.decode('utf-8'))['job_id']
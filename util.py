@@ -1,22 +1,91 @@
 import datetime
 import enum
+import gzip
+import hashlib
+import operator
 import random
+import threading
+from collections import OrderedDict
 from json import JSONEncoder as BaseJSONEncoder
-from typing import Any, List, Dict
+from typing import Any, Callable, List, Dict
+
+import msgpack
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 def generate_hex_string(length):
     return '%x' % random.SystemRandom().getrandbits(length * 4)
 
 
+def hash_code(code):
+    return hashlib.sha256(code.encode('utf-8')).hexdigest()
+
+
 def get_attrs(obj: object, attrs: List[str], include_none=True) -> Dict[str, Any]:
-    return {attr: getattr(obj, attr) for attr in attrs if include_none or getattr(obj, attr) is not None}
+    if include_none:
+        return {attr: getattr(obj, attr) for attr in attrs}
+    result = {}
+    for attr in attrs:
+        value = getattr(obj, attr)
+        if value is not None:
+            result[attr] = value
+    return result
 
 
 def column_dict(obj, include_none=True) -> Dict[str, Any]:
     return get_attrs(obj, [column.name for column in obj.__table__.columns], include_none=include_none)
 
 
+def _column_converter(column_type):
+    if getattr(column_type, 'enum_class', None) is not None:
+        return operator.attrgetter('value')
+    try:
+        python_type = column_type.python_type
+    except NotImplementedError:
+        return None
+    if issubclass(python_type, datetime.datetime):
+        return datetime.datetime.timestamp
+    return None
+
+
+# Builds a function turning a model instance, or any row with the same attribute names such as a column tuple from
+# Query(*columns), into a dict of JSON-native values. Conversions are picked once from the column types instead of
+# per value in JSONEncoder.default, and the output encodes to exactly the same JSON as get_attrs would.
+def compile_serializer(model, attrs: List[str] = None, include_none=True) -> Callable[[object], Dict[str, Any]]:
+    columns = model.__table__.columns
+    if attrs is None:
+        attrs = [column.name for column in columns]
+    fields = [(attr, _column_converter(columns[attr].type)) for attr in attrs]
+    if len(attrs) == 1:
+        attr_getter = operator.attrgetter(attrs[0])
+        getter = lambda obj: (attr_getter(obj),)
+    else:
+        getter = operator.attrgetter(*attrs)
+
+    def serialize(obj):
+        result = {}
+        for (attr, convert), value in zip(fields, getter(obj)):
+            if value is None:
+                if include_none:
+                    result[attr] = None
+            elif convert is None:
+                result[attr] = value
+            else:
+                result[attr] = convert(value)
+        return result
+
+    return serialize
+
+
 # This doesn't play well with deserialization
 class JSONEncoder(BaseJSONEncoder):
     def default(self, obj: object):
@@ -27,6 +96,43 @@ class JSONEncoder(BaseJSONEncoder):
         return BaseJSONEncoder.default(self, obj)
 
 
+def encode_default(obj: object):
+    if isinstance(obj, enum.Enum):
+        return obj.value
+    elif isinstance(obj, datetime.datetime):
+        return obj.timestamp()
+    raise TypeError
+
+
+# Same JSON as JSONEncoder with sorted keys, but compact and not ASCII-escaped. Requires orjson.
+def fast_json_dumps(obj: object) -> bytes:
+    return orjson.dumps(obj, default=encode_default, option=orjson.OPT_SORT_KEYS | orjson.OPT_PASSTHROUGH_DATETIME)
+
+
+def msgpack_dumps(obj: object) -> bytes:
+    return msgpack.packb(obj, default=encode_default)
+
+
+# Content-Encodings supported by compress, in order of preference.
+COMPRESSION_ENCODINGS = ['zstd', 'gzip'] if zstandard is not None else ['gzip']
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    return gzip.compress(data, compresslevel=6)
+
+
+# Attribute access to a dict of values, with None for anything missing. Lets the compiled serializers run on values
+# that were never loaded into a model instance.
+class Record:
+    def __init__(self, values: Dict[str, Any]):
+        self.__dict__.update(values)
+
+    def __getattr__(self, name):
+        return None
+
+
 def partial(func, *args, **kwargs):
     def newfunc(*fargs, **fkwargs):
         newkwargs = kwargs.copy()
@@ -36,3 +142,53 @@ def partial(func, *args, **kwargs):
     newfunc.args = args
     newfunc.kwargs = kwargs
     return newfunc
+
+
+# A small thread-safe LRU mapping for per-process caches of database values.
+class LRUCache:
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        # Bumped by every invalidation, so that get_or_load does not store a value loaded before one.
+        self._generation = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._set(key, value)
+
+    def _set(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    # An invalidation that arrives while load() runs may be for the value being loaded, which is then returned but not
+    # stored. The generation is per cache rather than per key: invalidations are rare, so this costs a few misses.
+    def get_or_load(self, key, load):
+        value = self.get(key)
+        if value is None:
+            generation = self._generation
+            value = load()
+            if value is not None:
+                with self._lock:
+                    if generation == self._generation:
+                        self._set(key, value)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+            self._generation += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._generation += 1
@@ -1,28 +1,100 @@
-import random
 from datetime import datetime
 from functools import wraps
+import hmac
+from operator import itemgetter
+import os
 import threading
+import time
 
-from flask import current_app, Blueprint, json, make_response, render_template, request
+import msgpack
+import redis
+from flask import abort, current_app, Blueprint, g, json, make_response, render_template, request, Response
+from sqlalchemy.exc import OperationalError
+from werkzeug.wsgi import wrap_file
 
+import archive
+import blobstore
 import config
 import constants
+import idempotency
+import metrics
+import profiling
+import progress
+import queues
+import ratelimit
+import replica
+import shedding
 import util
-from models import APIKey, db, Job, Problem, Submission
-from sockets import socketio
+from models import APIKey, archived_jobs, db, Event, EVENTS_LIMIT, Job, PROBLEM_VERSION_ATTRS, Problem, \
+    ProblemVersion, Submission, serialize_job, serialize_job_verdict, serialize_problem, serialize_problem_version
+from sockets import JURY_NAMESPACE, JURY_WAITING_ROOM, socketio
 
 blueprint = Blueprint('api', __name__)
 
 
+def encode_json(obj):
+    if current_app.config['FAST_JSON'] and util.orjson is not None:
+        return util.fast_json_dumps(obj)
+    return json.dumps(obj, cls=util.JSONEncoder)
+
+
+RESPONSE_TYPES = ['application/json', 'application/msgpack']
+
+# Most ids fetched by one GET /jobs?ids= or GET /submissions?ids= request.
+MULTIGET_LIMIT = 1000
+
+
+# Encodes a view's body as JSON or, if the client prefers it in its Accept header, msgpack.
+def encode_body(obj):
+    if request.accept_mimetypes.best_match(RESPONSE_TYPES, default='application/json') == 'application/msgpack':
+        return util.msgpack_dumps(obj), 'application/msgpack'
+    return encode_json(obj), 'application/json; charset=utf-8'
+
+
+def compress_response(response):
+    response.vary.add('Accept-Encoding')
+    if not current_app.config['COMPRESS_RESPONSES'] or 'Content-Encoding' in response.headers:
+        return
+    data = response.get_data()
+    if len(data) < current_app.config['COMPRESSION_MIN_SIZE']:
+        return
+    encoding = request.accept_encodings.best_match(util.COMPRESSION_ENCODINGS)
+    if encoding is None:
+        return
+    response.set_data(util.compress(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+
+
 def api_view(func):
     @wraps(func)
     def wrapper(*args, **kwargs):
-        view_result = func(*args, **kwargs)
-        return make_response(
-            json.dumps(view_result[1], cls=util.JSONEncoder) if view_result[1] is not None else '',
-            view_result[0],
-            {'Content-Type': 'application/json; charset=utf-8'},
-        )
+        start_time = time.perf_counter()
+        metrics.reset_query_stats()
+        profiler = profiling.start_request_profile()
+        read_only = request.method in ('GET', 'HEAD')
+        replica.use_primary()  # until require_perms has let the request in, see replica.read_only
+        try:
+            view_result = func(*args, **kwargs)
+            if isinstance(view_result, Response):  # e.g. file downloads
+                response = view_result
+            else:
+                if view_result[1] is not None:
+                    body, content_type = encode_body(view_result[1])
+                else:
+                    body, content_type = '', 'application/json; charset=utf-8'
+                response = make_response(body, view_result[0], {'Content-Type': content_type})
+                response.vary.add('Accept')
+                if len(view_result) > 2:
+                    response.headers.extend(view_result[2])
+                compress_response(response)
+        finally:
+            profile_id = profiling.finish_request_profile(profiler) if profiler else None
+        if profile_id:
+            response.headers['X-Profile-Id'] = profile_id
+        if not read_only and response.status_code < 400:
+            replica.record_write(g.get('api_key'))
+        metrics.observe_request(request.endpoint, response.status_code, time.perf_counter() - start_time)
+        return response
 
     return wrapper
 
@@ -47,7 +119,20 @@ def require_perms(*perms):
                             allowed = True
                     if not allowed:
                         return 403, None
-            return func(*args, **kwargs)
+            g.api_key = api_key
+
+            request_class = shedding.classify(request.method, request.endpoint)
+            if not shedding.acquire(request_class):
+                return shedding.shed(request_class, 'concurrency')
+            try:
+                return func(*args, **kwargs)
+            except OperationalError as e:
+                if not g.get('statement_timeout') or not shedding.is_statement_timeout(e):
+                    raise
+                db.session.rollback()
+                return shedding.shed(request_class, 'statement_timeout')
+            finally:
+                shedding.release(request_class)
 
         return wrapper
 
@@ -62,10 +147,37 @@ def need_send(obj):
     return True
 
 
+# Status code for a failed Job.transition: 409 if the job is not in one of statuses anymore, otherwise the verification
+# code did not match.
+def transition_conflict(job_id, statuses):
+    job = Job.query.get_or_404(job_id)
+    if job.status not in statuses:
+        return 409
+    return 403
+
+
+# Whether verification_code is the code of a second jury running a straggling job; see Job.claim_hedge.
+def is_hedge(job_id, verification_code):
+    return db.session.query(Job.query.filter(Job.id == job_id, Job.hedge_verification_code == verification_code)
+                            .exists()).scalar()
+
+
+# Queue operations run once the change to the job is committed. If Redis is unreachable, the queue catches up on its
+# own (claims skip entries of jobs that cannot be claimed, and jobs without an entry are swept back in, see queues.py),
+# so the request still succeeds instead of making the client retry a change that was already made.
+def update_queue(operation, job_id):
+    try:
+        operation(job_id)
+    except redis.RedisError:
+        current_app.logger.warning('Queue update for job {} failed, leaving it to the queue'.format(job_id),
+                                   exc_info=True)
+
+
 def socketio_emit(command, *args, rooms=None):
     if not current_app.config['ENABLE_SOCKETIO']:
         return
 
+    metrics.SOCKETIO_EMITS.labels(event=command).inc()
     if rooms:
         for room in rooms + ['monitor']:
             socketio.emit(command, args, room=room)
@@ -73,6 +185,59 @@ def socketio_emit(command, *args, rooms=None):
         socketio.emit(command, args)
 
 
+# Tells juries connected through jury_protocol.py that are waiting for work to claim a job.
+def notify_juries():
+    if current_app.config['ENABLE_SOCKETIO']:
+        metrics.SOCKETIO_EMITS.labels(event='job_available').inc()
+        socketio.emit('job_available', room=JURY_WAITING_ROOM, namespace=JURY_NAMESPACE)
+
+
+def list_jobs(*criteria):
+    return progress.overlay(Job.list_details(*criteria))
+
+
+def list_submissions(*criteria):
+    return progress.overlay_submissions(Submission.list_details(*criteria))
+
+
+# Parses the ids argument of a multiget, e.g. 1:3,2 for ids 1 and 2 where the client has version 3 of the first one.
+# Returns {id: version or None}, or None if the argument is invalid.
+def parse_multiget_ids(ids):
+    versions = {}
+    try:
+        for entry in ids.split(','):
+            entry_id, _, version = entry.partition(':')
+            versions[int(entry_id)] = int(version) if version else None
+    except ValueError:
+        return None
+    if len(versions) > MULTIGET_LIMIT:
+        return None
+    return versions
+
+
+# Adds a version to serialized submission details: the sum of the versions of its jobs, which goes up whenever one of
+# them changes or a job is added.
+def add_submission_version(submission):
+    submission['version'] = sum(job['version'] for job in submission['jobs'])
+    return submission
+
+
+# Fetches the entries with the given ids and leaves out the ones the client already has the version of. Progress kept
+# in the write-behind buffer does not bump versions, so entries with a running job are always included while the
+# buffer is in use; see progress.py.
+def multiget(list_details, column, jobs_of, add_version=None):
+    versions = parse_multiget_ids(request.args['ids'])
+    if versions is None:
+        return 400, 'ids must be at most {} comma-separated ids, each optionally followed by :version.'.format(
+            MULTIGET_LIMIT)
+    entries = list_details(column.in_(list(versions)))
+    if add_version is not None:
+        entries = [add_version(entry) for entry in entries]
+    buffered = progress.enabled()
+    return 200, [entry for entry in entries if entry['version'] != versions[entry['id']] or
+                 (buffered and any(job['status'] in progress.RUNNING_STATUSES for job in jobs_of(entry)))]
+
+
 def gen_errorhandler(error_code):
     @api_view
     def errorhandler(e):
@@ -100,6 +265,27 @@ def monitor():
     return render_template('monitor.html')
 
 
+queue_depth = metrics.QueueDepthCollector(
+    lambda: db.session.query(Job.status, db.func.count(Job.id)).group_by(Job.status).all())
+
+
+# Scrapers authenticate with METRICS_TOKEN as a bearer token, or with a master API key.
+def is_metrics_scraper():
+    token = current_app.config['METRICS_TOKEN']
+    if token and hmac.compare_digest(request.headers.get('Authorization', '').encode('utf-8'),
+                                     'Bearer {}'.format(token).encode('utf-8')):
+        return True
+    key = request.headers.get('api_key')
+    return key is not None and APIKey.query.filter_by(key=key, active=True, perm_master=True).first() is not None
+
+
+@blueprint.route('/metrics')
+def metrics_export():
+    if not is_metrics_scraper():
+        abort(403)
+    return make_response(metrics.generate(queue_depth), 200, {'Content-Type': metrics.CONTENT_TYPE})
+
+
 @blueprint.route('/api_key', methods=['POST'])
 @api_view
 @require_perms('master')
@@ -118,63 +304,79 @@ def generate_api_key():
 @blueprint.route('/submissions', methods=['GET'])
 @api_view
 @require_perms('reader')
+@replica.read_only
 def submissions_list():
-    return 200, [submission.generate_details() for submission in Submission.query.all()]
+    if 'ids' in request.args:
+        return multiget(list_submissions, Submission.id, itemgetter('jobs'), add_submission_version)
+    return 200, list_submissions()
 
 
 @blueprint.route('/jobs', methods=['GET'])
 @api_view
 @require_perms('reader')
+@replica.read_only
 def jobs_list():
-    return 200, [job.generate_details() for job in Job.query.all()]
+    if 'ids' in request.args:
+        return multiget(list_jobs, Job.id, lambda job: [job])
+    return 200, list_jobs()
 
 
 @blueprint.route('/submissions/uid/<int:uid>', methods=['GET'])
 @api_view
 @require_perms('reader')
+@replica.read_only
 def submissions_list_by_uid(uid: int):
-    return 200, [submission.generate_details() for submission in Submission.query.filter_by(uid=uid).all()]
+    return 200, list_submissions(Submission.uid == uid)
 
 
 @blueprint.route('/jobs/uid/<int:uid>', methods=['GET'])
 @api_view
 @require_perms('reader')
+@replica.read_only
 def jobs_list_by_uid(uid: int):
-    return 200, [job.generate_details() for job in Job.query.join(Job.submission).filter_by(uid=uid).all()]
+    return 200, list_jobs(Submission.uid == uid)
 
 
 @blueprint.route('/submissions/gid/<int:gid>', methods=['GET'])
 @api_view
 @require_perms('reader')
+@replica.read_only
 def submissions_list_by_gid(gid: int):
-    return 200, [submission.generate_details() for submission in Submission.query.filter_by(gid=gid).all()]
+    return 200, list_submissions(Submission.gid == gid)
 
 
 @blueprint.route('/jobs/gid/<int:gid>', methods=['GET'])
 @api_view
 @require_perms('reader')
+@replica.read_only
 def jobs_list_by_gid(gid: int):
-    return 200, [job.generate_details() for job in Job.query.join(Job.submission).filter_by(gid=gid).all()]
+    return 200, list_jobs(Submission.gid == gid)
 
 
 @blueprint.route('/submissions/problem/<int:problem_id>', methods=['GET'])
 @api_view
 @require_perms('reader')
+@replica.read_only
 def submissions_list_by_problem(problem_id: int):
-    return 200, [submission.generate_details() for submission in Submission.query.filter_by(problem_id=problem_id).all()]
+    return 200, list_submissions(Submission.problem_id == problem_id)
 
 
 @blueprint.route('/jobs/problem/<int:problem_id>', methods=['GET'])
 @api_view
 @require_perms('reader')
+@replica.read_only
 def jobs_list_by_problem(problem_id: int):
-    return 200, [job.generate_details() for job in Job.query.join(Job.submission).filter_by(problem_id=problem_id).all()]
+    return 200, list_jobs(Submission.problem_id == problem_id)
 
 
 @blueprint.route('/submissions', methods=['POST'])
 @api_view
 @require_perms('reader')
 def submissions_create():
+    replayed = idempotency.replay()
+    if replayed is not None:
+        return replayed
+
     if not Problem.query.get(int(request.form['problem_id'])):
         return 400, 'Problem %d does not exist.' % int(request.form['problem_id'])
 
@@ -184,159 +386,413 @@ def submissions_create():
     if 'callback_url' in request.form and len(request.form['callback_url']) > 256:
         return 400, 'Callback URL too long!'
 
+    problem = Problem.query.get(int(request.form['problem_id']))
+    uid = int(request.form['uid']) if 'uid' in request.form else None
+    gid = int(request.form['gid']) if 'gid' in request.form else None
+    rejection = ratelimit.admit(problem, uid, gid, g.api_key)
+    if rejection is not None:
+        return rejection
+    supersede_policy = problem.supersede_policy or constants.SupersedePolicy(current_app.config['SUPERSEDE_POLICY'])
+    superseded_job_ids = Job.supersede(problem.id, uid, gid, supersede_policy)
+
     new_submission, new_job = Submission.create_with_new_job(
-        uid=int(request.form['uid']) if 'uid' in request.form else None,
-        gid=int(request.form['gid']) if 'gid' in request.form else None,
+        uid=uid,
+        gid=gid,
         time=datetime.utcnow(),
-        problem=Problem.query.get(int(request.form['problem_id'])),
+        problem=problem,
         code=request.form['code'],
         language=request.form['language'],
 
         callback_url=request.form.get('callback_url', None),
+        commit=False,
     )
+    db.session.flush()
+    cancel_event_ids = {}
+    if supersede_policy == constants.SupersedePolicy.cancel:
+        cancel_event_ids = {job_id: Event.record('job_cancelled', job_id=job_id) for job_id in superseded_job_ids}
+    submission_event_id = Event.record('submission_new', submission_id=new_submission.id)
+    job_event_id = Event.record('job_new', job_id=new_job.id, submission_id=new_submission.id)
+    response = {'id': new_submission.id, 'job_id': new_job.id}
+    replayed = idempotency.commit(201, response)
+    if replayed is not None:
+        return replayed
+
+    queue = queues.get_queue()
+    update_queue(queue.enqueue, new_job.id)
+    if superseded_job_ids:
+        metrics.JOBS_SUPERSEDED.labels(policy=supersede_policy.value).inc(len(superseded_job_ids))
+    for job_id in superseded_job_ids:
+        if supersede_policy == constants.SupersedePolicy.cancel:
+            update_queue(queue.remove, job_id)
+            socketio_emit('job_cancelled', job_id, cancel_event_ids[job_id], rooms=['job_{}'.format(job_id)])
+        else:
+            update_queue(queue.deprioritize, job_id)
 
-    socketio_emit('submission_new', new_submission.id, rooms=['submissions'])
-    socketio_emit('job_new', new_job.id, rooms=['jobs'])
+    socketio_emit('submission_new', new_submission.id, submission_event_id, rooms=['submissions'])
+    socketio_emit('job_new', new_job.id, job_event_id, rooms=['jobs'])
+    notify_juries()
 
-    return 201, {'id': new_submission.id, 'job_id': new_job.id}
+    return 201, response
 
 
 @blueprint.route('/submissions/<int:submission_id>/create_job', methods=['POST'])
 @api_view
 @require_perms('reader')
 def submissions_job_create(submission_id):
-    submission = Submission.query.get_or_404(submission_id)
+    replayed = idempotency.replay()
+    if replayed is not None:
+        return replayed
+
+    submission = Submission.query.get(submission_id)
+    if submission is None and archive.restore_submission(submission_id):
+        submission = Submission.query.get(submission_id)
+    if submission is None:
+        abort(404)
 
     if 'callback_url' in request.form and len(request.form['callback_url']) > 256:
         return 400, 'Callback URL too long!'
 
+    # Rejudges count against the API key, not the contestant.
+    rejection = ratelimit.admit(submission.problem, None, None, g.api_key)
+    if rejection is not None:
+        return rejection
+
     new_job = Job.create(
         submission=submission,
 
         callback_url=request.form.get('callback_url', None),
+        commit=False,
     )
+    db.session.flush()
+    event_id = Event.record('job_new', job_id=new_job.id, submission_id=submission_id)
+    response = {'job_id': new_job.id}
+    replayed = idempotency.commit(201, response)
+    if replayed is not None:
+        return replayed
+
+    update_queue(queues.get_queue().enqueue, new_job.id)
+
+    socketio_emit('job_new', new_job.id, event_id, rooms=['jobs', 'submission_{}'.format(submission_id)])
+    notify_juries()
+
+    return 201, response
+
+
+# The jury operations are shared between the HTTP endpoints and the Socket.IO jury protocol (jury_protocol.py).
+def claim_job(consumer, toolchain=None):
+    job = queues.get_queue().claim(consumer)
+    if job is not None:
+        details = job.details
+        event = 'job_claimed'
+        event_id = Event.record(event, job_id=job.id)
+        db.session.commit()
+        progress.start(job.id, details['verification_code'])
+        metrics.JOB_QUEUE_WAIT.observe((job.claim_time - job.creation_time).total_seconds())
+    elif current_app.config['HEDGE_STRAGGLERS']:
+        # Juries with nothing queued to run get a second claim on a straggling job; see Job.claim_hedge.
+        details = Job.claim_hedge(current_app.config['HEDGE_MARGIN'])
+        if details is None:
+            db.session.rollback()
+            return None
+        event = 'job_hedged'
+        event_id = Event.record(event, job_id=details['id'])
+        db.session.commit()
+        metrics.HEDGES_ISSUED.inc()
+    else:
+        return None
 
-    socketio_emit('job_new', new_job.id, rooms=['jobs', 'submission_{}'.format(submission_id)])
+    # Juries that send their toolchain id get the digest of a matching compiled artifact, if one was uploaded.
+    if toolchain is not None:
+        artifact = blobstore.get_blobstore().get_ref(
+            artifact_ref(details['code_hash'], details['language'], toolchain))
+        metrics.ARTIFACT_LOOKUPS.labels(result='hit' if artifact else 'miss').inc()
+        if artifact:
+            details['artifact'] = artifact
+    test_data = blobstore.get_blobstore().get_ref(
+        test_data_ref(details['problem_id'], details['generator_hash']))
+    metrics.TEST_DATA_LOOKUPS.labels(result='hit' if test_data else 'miss').inc()
+    if test_data:
+        details['test_data'] = test_data
 
-    return 201, {'job_id': new_job.id}
+    socketio_emit(event, details['id'], event_id, rooms=['job_{}'.format(details['id'])])
+
+    return details
 
 
 @blueprint.route('/jobs/claim', methods=['POST'])
 @api_view
 @require_perms('jury')
 def jobs_claim():
-    job = Job.query_can_claim().with_for_update().order_by(Job.creation_time.asc(), Job.id.asc()).first()
-    if job is None:
+    details = claim_job('jury-{}'.format(g.api_key.id), request.form.get('toolchain'))
+    if details is None:
         return 204, None
-    job.status = constants.JobStatus.started
-    job.claim_time = datetime.utcnow()
-    verification_code = random.randint(1, 1000000000)
-    job.verification_code = verification_code
+    return 200, details
+
+
+def artifact_ref(code_hash, language, toolchain):
+    return 'artifact:{}:{}:{}'.format(code_hash, language, toolchain)
+
+
+def test_data_ref(problem_id, generator_hash):
+    return 'test_data:{}:{}'.format(problem_id, generator_hash)
+
+
+# make_conditional handles If-None-Match and Range requests. The response is built by hand rather than with send_file,
+# whose ETag and caching arguments differ between Flask versions.
+def send_blob(digest, max_age=None):
+    path = blobstore.get_blobstore().get(digest)
+    if path is None:
+        return None
+    f = open(path, 'rb')
+    size = os.fstat(f.fileno()).st_size
+    response = current_app.response_class(wrap_file(request.environ, f), mimetype='application/octet-stream',
+                                          direct_passthrough=True)
+    response.content_length = size
+    response.set_etag(digest)
+    if max_age is not None:
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+    return response.make_conditional(request, accept_ranges=True, complete_length=size)
+
+
+@blueprint.route('/artifacts/<code_hash>/<language>/<toolchain>', methods=['PUT'])
+@api_view
+@require_perms('jury')
+def artifacts_upload(code_hash, language, toolchain):
+    if not blobstore.is_digest(code_hash):
+        return 400, 'Invalid code hash!'
+    if language not in config.SUPPORTED_LANGUAGES:
+        return 400, 'Language %s not supported' % language
+    store = blobstore.get_blobstore()
+    if request.content_length is not None and request.content_length > store.max_bytes:
+        return 413, None
+
+    digest, size = store.put(request.stream)
+    store.set_ref(artifact_ref(code_hash, language, toolchain), digest)
+    return 201, {'digest': digest, 'size': size}
+
+
+@blueprint.route('/blobs/<digest>', methods=['GET'])
+@api_view
+@require_perms('jury')
+def blobs_get(digest):
+    # Blobs never change, so they can be cached forever.
+    response = send_blob(digest, max_age=365 * 24 * 3600) if blobstore.is_digest(digest) else None
+    if response is None:
+        return 404, None
+    return response
+
+
+def release_job(job_id, verification_code):
+    if current_app.config['HEDGE_STRAGGLERS'] and \
+            db.session.query(Job.hedge_verification_code).filter(Job.id == job_id).scalar() is not None:
+        released = release_hedge(job_id, verification_code)
+        if released is not None:
+            return released
+
+    values = {'status': constants.JobStatus.queued, 'claim_time': None}
+    if not Job.transition(job_id, values, [constants.JobStatus.started], verification_code):
+        return transition_conflict(job_id, [constants.JobStatus.started]), None
+    event_id = Event.record('job_released', job_id=job_id)
     db.session.commit()
-    job_details = job.generate_claim_details()
 
-    socketio_emit('job_claimed', job.id, rooms=['job_{}'.format(job.id)])
+    progress.discard(job_id)
+    update_queue(queues.get_queue().release, job_id)
+
+    socketio_emit('job_released', job_id, event_id, rooms=['job_{}'.format(job_id)])
+    notify_juries()
 
-    return 200, job_details
+    return 200, None
+
+
+# Releases a hedged job without queueing it again: either jury that gives it up leaves it to the other one. Returns
+# None if the job has no hedge or verification_code is neither of its codes.
+def release_hedge(job_id, verification_code):
+    running = [constants.JobStatus.started, constants.JobStatus.awaiting_verdict]
+    values = {'hedge_verification_code': None, 'hedge_claim_time': None}
+    if not Job.transition(job_id, values, running, verification_code, hedge=True):
+        handover = dict(values, verification_code=Job.hedge_verification_code, claim_time=Job.hedge_claim_time)
+        if not Job.query.filter(Job.id == job_id, Job.status.in_(running), Job.verification_code == verification_code,
+                                Job.hedge_verification_code.isnot(None)) \
+                .update(dict(handover, version=Job.version + 1), synchronize_session=False):
+            db.session.rollback()
+            return None
+        # Progress from now on comes from the hedge, under its verification code.
+        progress.discard(job_id)
+    db.session.commit()
+    return 200, None
 
 
 @blueprint.route('/jobs/<int:job_id>/release', methods=['POST'])
 @api_view
 @require_perms('jury')
 def jobs_release(job_id: int):
-    job = Job.query.with_for_update().get_or_404(job_id)
-    if job.status != constants.JobStatus.started:
-        return 409, None
-
     try:
-        if job.verification_code and int(request.form['verification_code']) != job.verification_code:
-            return 403, None
+        verification_code = int(request.form['verification_code'])
     except (ValueError, AttributeError):
         return 400, None
 
-    job.status = constants.JobStatus.queued
-    job.claim_time = None
-    db.session.commit()
+    return release_job(job_id, verification_code)
 
-    socketio_emit('job_released', job.id, rooms=['job_{}'.format(job.id)])
 
-    return 200, None
+@blueprint.route('/events', methods=['GET'])
+@api_view
+@require_perms('reader')
+def events_list():
+    try:
+        since = int(request.args.get('since', 0))
+        limit = min(max(int(request.args.get('limit', EVENTS_LIMIT)), 1), EVENTS_LIMIT)
+    except ValueError:
+        return 400, None
+    return 200, Event.list_details(since, limit)
 
 
 @blueprint.route('/submissions/<int:submission_id>', methods=['GET'])
 @api_view
 @require_perms('reader')
+@replica.read_only
 def submissions_details(submission_id: int):
-    submission = Submission.query.get_or_404(submission_id)
-    return 200, submission.generate_details()
+    submissions = list_submissions(Submission.id == submission_id)
+    if not submissions:
+        abort(404)
+    return 200, submissions[0]
 
 
 @blueprint.route('/jobs/<int:job_id>', methods=['GET'])
 @api_view
 @require_perms('reader')
+@replica.read_only
 def jobs_status(job_id: int):
-    job = Job.query.get_or_404(job_id)
-    return 200, job.generate_details()
+    job = Job.query_details().filter(Job.id == job_id).first() or \
+        Job.query_archived_details().filter(archived_jobs.c.id == job_id).first_or_404()
+    return 200, progress.overlay([serialize_job(job)])[0]
 
 
 @blueprint.route('/jobs/<int:job_id>', methods=['DELETE'])
 @api_view
 @require_perms('reader')
 def jobs_cancel(job_id: int):
-    job = Job.query.with_for_update().get_or_404(job_id)
-    if job.status == constants.JobStatus.finished or job.status == constants.JobStatus.cancelled:
-        return 409, None
-    job.status = constants.JobStatus.cancelled
+    statuses = [constants.JobStatus.queued, constants.JobStatus.started, constants.JobStatus.awaiting_verdict]
+    if not Job.transition(job_id, {'status': constants.JobStatus.cancelled}, statuses):
+        return transition_conflict(job_id, statuses), None
+    event_id = Event.record('job_cancelled', job_id=job_id)
     db.session.commit()
 
-    socketio_emit('job_cancelled', job.id, ['job_{}'.format(job.id)])
-
-    return 200, None
+    # Juries running the job are told right away through their jury_job_<id> room (see sockets.py), rather than on
+    # their next progress report.
+    job = progress.overlay([serialize_job(Job.query_details().filter(Job.id == job_id).one())])[0]
+    if 'claim_time' in job:
+        test_cases, time_limit = ProblemVersion.get_limits(Job.get_problem_version_id(job_id))
+        metrics.RUNNING_JOBS_CANCELLED.inc()
+        metrics.JURY_SECONDS_SAVED.inc(max(test_cases - job.get('last_ran_case', 0), 0) * time_limit)
 
+    progress.discard(job_id)
+    update_queue(queues.get_queue().remove, job_id)
 
-@blueprint.route('/jobs/<int:job_id>/submit', methods=['POST'])
-@api_view
-@require_perms('jury')
-def jobs_submit(job_id: int):
-    job = Job.query.with_for_update().get_or_404(job_id)
+    socketio_emit('job_cancelled', job_id, event_id, rooms=['job_{}'.format(job_id), 'jury_job_{}'.format(job_id)])
+    if current_app.config['ENABLE_SOCKETIO']:
+        socketio.emit('job_cancelled', msgpack.packb({'id': job_id}), room='jury_job_{}'.format(job_id),
+                      namespace=JURY_NAMESPACE)
 
-    if job.status != constants.JobStatus.started and job.status != constants.JobStatus.awaiting_verdict:
-        return 409, 'Job not available for submission!'
+    return 200, None
 
-    # TODO: Log warning is job can be submitted but does not have verification code.
-    if job.verification_code and int(request.form['verification_code']) != job.verification_code:
-        return 403, 'Incorrect verification code!'
 
-    job.execution_time = float(request.form['execution_time'])
-    job.execution_memory = int(request.form['execution_memory'])
-    job.last_ran_case = int(request.form['last_ran_case'])
+# report holds the fields of a /jobs/<id>/submit form.
+def submit_job(job_id, report):
+    problem_version_id = Job.get_problem_version_id(job_id)
+    if problem_version_id is None:
+        abort(404)
 
-    # If cases already run await verdict.
-    if job.last_ran_case == job.submission.problem.test_cases:
-        job.status = constants.JobStatus.awaiting_verdict
+    # TODO: Log warning is job can be submitted but does not have verification code.
+    verification_code = int(report['verification_code'])
+    values = {
+        'execution_time': float(report['execution_time']),
+        'execution_memory': int(report['execution_memory']),
+        'last_ran_case': int(report['last_ran_case']),
+    }
+
+    # A report within a test run leaves the status as it is, so a late one does not move a job awaiting its verdict back
+    # to started. If cases already run await verdict.
+    if values['last_ran_case'] == ProblemVersion.get_limits(problem_version_id).test_cases:
+        values['status'] = constants.JobStatus.awaiting_verdict
 
     # Jury sends verdict to judge when judging is complete such as on TLE or AC.
     # Jury MUST send verdict after finishing all test cases.
-    if 'verdict' in request.form and request.form['verdict']:
-        job.verdict = constants.JobVerdict(request.form['verdict'])
-        job.status = constants.JobStatus.finished
-        job.completion_time = datetime.utcnow()
-        job.verification_code = None
+    if report.get('verdict'):
+        values['verdict'] = constants.JobVerdict(report['verdict'])
+        values['status'] = constants.JobStatus.finished
+        values['completion_time'] = datetime.utcnow()
+        values['verification_code'] = None
+        values['hedge_verification_code'] = None
+    status = values.get('status')
+
+    # Intermediate progress goes to the write-behind buffer unless a flush to SQL is due; see progress.py. Status
+    # changes always go to SQL, so that they are logged as events.
+    buffered = progress.NOT_BUFFERED
+    if status is None and progress.enabled():
+        buffered = progress.record(job_id, verification_code, values)
+        if buffered == progress.REJECTED:
+            if is_hedge(job_id, verification_code):
+                return 200, None
+            return 403, 'Incorrect verification code!'
+
+    event_id = None
+    if buffered != progress.BUFFERED:
+        statuses = [constants.JobStatus.started, constants.JobStatus.awaiting_verdict]
+        if not Job.transition(job_id, values, statuses, verification_code):
+            if status != constants.JobStatus.finished and is_hedge(job_id, verification_code):
+                # Only the verdict of a hedge counts; its progress is dropped while the first jury keeps reporting.
+                return 200, None
+            if status == constants.JobStatus.finished and \
+                    Job.transition(job_id, values, statuses, verification_code, hedge=True):
+                metrics.HEDGES_WON.inc()
+            else:
+                progress.discard(job_id)
+                if transition_conflict(job_id, statuses) == 409:
+                    if Job.query.get(job_id).status == constants.JobStatus.cancelled:
+                        return 409, 'Job cancelled!'
+                    return 409, 'Job not available for submission!'
+                return 403, 'Incorrect verification code!'
+        # Progress within a test run is not logged, as the next report supersedes it; status changes are.
+        if status is not None:
+            event_id = Event.record('job_updated', job_id=job_id, data=serialize_job_verdict(util.Record(values)))
+        db.session.commit()
+
+    if status == constants.JobStatus.finished:
+        progress.discard(job_id)
+        update_queue(queues.get_queue().remove, job_id)
+
+        job = Job.query.get(job_id)
+        if job.claim_time:
+            metrics.JOB_RUN_TIME.observe((job.completion_time - job.claim_time).total_seconds())
+        if job.callback_url:
+            threading.Thread(target=job.fire_callback).start()
+        verdict_details = job.generate_verdict_details()
+    else:
+        if buffered == progress.NOT_BUFFERED:
+            progress.start(job_id, verification_code)
+        verdict_details = serialize_job_verdict(util.Record(values))
 
-        threading.Thread(target=job.fire_callback).start()
+    args = [job_id, json.dumps(verdict_details)]
+    if event_id is not None:  # progress within a test run has no event
+        args.append(event_id)
+    socketio_emit('job_updated', *args, rooms=['job_{}'.format(job_id)])
 
-    db.session.commit()
+    return 200, None
 
-    socketio_emit('job_updated', job.id, json.dumps(job.generate_verdict_details()), rooms=['job_{}'.format(job.id)])
 
-    return 200, None
+@blueprint.route('/jobs/<int:job_id>/submit', methods=['POST'])
+@api_view
+@require_perms('jury')
+def jobs_submit(job_id: int):
+    return submit_job(job_id, request.form)
 
 
 @blueprint.route('/problems', methods=['GET'])
 @api_view
 @require_perms(('jury', 'reader'))
 def problems_list():
-    return 200, [util.column_dict(problem) for problem in Problem.query.all()]
+    return 200, [serialize_problem(problem) for problem in Problem.query_details()]
 
 
 @blueprint.route('/problems', methods=['POST'])
@@ -365,6 +821,7 @@ def problems_create():
             setattr(new_problem, field.name, request.form[field.name])
 
     db.session.add(new_problem)
+    ProblemVersion.create(new_problem)
     db.session.commit()
 
     return 201, None
@@ -374,13 +831,57 @@ def problems_create():
 @api_view
 @require_perms(('jury', 'reader'))
 def problems_get(problem_id: int):
-    problem = Problem.query.get_or_404(problem_id)
+    problem = Problem.query_details().filter(Problem.id == problem_id).first_or_404()
     if need_send(problem):
-        return 200, util.column_dict(problem)
+        return 200, serialize_problem(problem)
     else:
         return 304, None
 
 
+# Juries upload the test data they generated once, and other juries download it instead of running the generator.
+@blueprint.route('/problems/<int:problem_id>/test_data/<generator_hash>', methods=['PUT'])
+@api_view
+@require_perms('jury')
+def problems_test_data_upload(problem_id: int, generator_hash):
+    problem = Problem.query.get_or_404(problem_id)
+    if generator_hash != problem.generator_hash() and generator_hash not in ProblemVersion.generator_hashes(problem_id):
+        return 409, 'Generator changed!'
+    store = blobstore.get_blobstore()
+    if request.content_length is not None and request.content_length > store.max_bytes:
+        return 413, None
+
+    digest, size = store.put(request.stream)
+    store.set_ref(test_data_ref(problem_id, generator_hash), digest)
+    return 201, {'digest': digest, 'size': size}
+
+
+# Jobs pinned to an older version download by the generator hash in their claim; without one, the current hash is used.
+@blueprint.route('/problems/<int:problem_id>/test_data', methods=['GET'])
+@blueprint.route('/problems/<int:problem_id>/test_data/<generator_hash>', methods=['GET'])
+@api_view
+@require_perms('jury')
+def problems_test_data_get(problem_id: int, generator_hash=None):
+    problem = Problem.query.get_or_404(problem_id)
+    if generator_hash is None:
+        generator_hash = problem.generator_hash()
+    digest = blobstore.get_blobstore().get_ref(test_data_ref(problem_id, generator_hash))
+    response = send_blob(digest) if digest else None
+    if response is None:
+        return 404, None
+    response.headers['X-Generator-Hash'] = generator_hash
+    return response
+
+
+# Versions are immutable, so clients can cache them forever without revalidating.
+@blueprint.route('/problems/<int:problem_id>/versions/<int:version_id>', methods=['GET'])
+@api_view
+@require_perms(('jury', 'reader'))
+def problems_version_get(problem_id: int, version_id: int):
+    version = ProblemVersion.query_details() \
+        .filter(ProblemVersion.id == version_id, ProblemVersion.problem_id == problem_id).first_or_404()
+    return 200, serialize_problem_version(version), {'Cache-Control': 'public, max-age=31536000, immutable'}
+
+
 @blueprint.route('/problems/<int:problem_id>', methods=['PUT'])
 @api_view
 @require_perms('reader')
@@ -392,5 +893,9 @@ def problems_modify(problem_id: int):
         if field.name in request.form:
             setattr(problem, field.name, request.form[field.name])
 
+    if any(attr in request.form for attr in PROBLEM_VERSION_ATTRS):
+        ProblemVersion.create(problem)
     db.session.commit()
+    Problem.invalidate_cache(problem_id)
+    # The old test data is kept for jobs still pinned to the old version; it is left to eviction.
     return 200, None